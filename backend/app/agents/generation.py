@@ -2,8 +2,13 @@
 Generation Agent
 Handles personalized message generation using LLMs
 """
+import asyncio
+import hashlib
+import json
 import logging
-from typing import Dict, Any
+import re
+from datetime import datetime
+from typing import Any, AsyncIterator, Dict, List, Optional, Tuple, Union
 import uuid
 
 from app.models.schemas import (
@@ -11,78 +16,297 @@ from app.models.schemas import (
     GenerationResponse,
     MessageVariant
 )
+from app.utils.azure_clients import AzureOpenAIClient
 from app.utils.config import settings
+from app.utils.rate_limit import estimate_tokens
+from app.utils.result_cache import ResultCache, build_cache
+from app.utils.template_renderer import VariantRenderer
 
 logger = logging.getLogger(__name__)
 
+TEMPLATES = [
+    {
+        "subject": "Exclusive Offer Just for You",
+        "content": "Hi there! We noticed you've been eyeing our premium collection. Here's a special 20% discount just for valued customers like you."
+    },
+    {
+        "subject": "Your Personalized Recommendations",
+        "content": "Based on your recent purchases, we thought you'd love these hand-picked items. Check them out with our exclusive member pricing!"
+    },
+    {
+        "subject": "Don't Miss Out on This Limited Offer",
+        "content": "As one of our top customers, you get early access to our seasonal sale. Shop now before items sell out!"
+    }
+]
+
+
+def build_prompt(request: GenerationRequest, template: Dict[str, str]) -> str:
+    """LLM prompt asking to adapt a template to the request's segment and context"""
+    return (
+        f"Write a marketing message for customer segment {request.segment_id}.\n"
+        f"Personalization level: {request.personalization_level}.\n"
+        f"Customer context: {json.dumps(request.context, sort_keys=True, default=str)}\n\n"
+        "Adapt the template below. Reply with a first line \"Subject: <subject>\", "
+        "a blank line, then the message body. Keep {{placeholders}} exactly as written; "
+        "they are filled in per customer.\n\n"
+        f"Subject: {template['subject']}\n\n{template['content']}"
+    )
+
+
+def parse_completion(text: str, template: Dict[str, str]) -> Tuple[str, str]:
+    """(subject, content) from a completion; keeps the template subject when none is given"""
+    text = text.strip()
+    first_line, _, rest = text.partition("\n")
+    if first_line.lower().startswith("subject:"):
+        return first_line[len("subject:"):].strip(), rest.strip()
+    return template["subject"], text
+
 
 class GenerationAgent:
     """
     Agent responsible for generating personalized messages
     Uses LLMs (OpenAI/Azure OpenAI) for content generation
     """
-    
-    def __init__(self):
+
+    def __init__(
+        self,
+        client: Optional[AzureOpenAIClient] = None,
+        result_cache: Optional[ResultCache] = None
+    ):
         self.model = settings.OPENAI_MODEL
+        self.client = client or AzureOpenAIClient(
+            settings.AZURE_OPENAI_ENDPOINT,
+            settings.AZURE_OPENAI_API_KEY,
+            settings.AZURE_OPENAI_DEPLOYMENT,
+            api_version=settings.AZURE_OPENAI_API_VERSION,
+            completion_concurrency=settings.GENERATION_MAX_CONCURRENCY,
+            completion_tokens_per_minute=settings.GENERATION_TOKENS_PER_MINUTE
+        )
+        self.result_cache = result_cache or build_cache(
+            settings.GENERATION_CACHE_BACKEND,
+            prefix="generation:",
+            max_entries=settings.GENERATION_CACHE_MAX_ENTRIES
+        )
         logger.info("Generation Agent initialized")
-    
+
+    def _cache_key(self, prompt: str) -> str:
+        """Fingerprint of everything that determines a completion: model, prompt and token limit"""
+        payload = {"model": self.model, "prompt": prompt, "max_tokens": settings.GENERATION_MAX_TOKENS}
+        return hashlib.sha256(json.dumps(payload, sort_keys=True).encode("utf-8")).hexdigest()
+
+    async def _cached_variants(
+        self,
+        request: GenerationRequest,
+        prompts: List[str]
+    ) -> List[Optional[Dict[str, Any]]]:
+        """Cached {"subject", "content", "tokens"} per prompt, all None when the request opts out"""
+        if not request.use_cache:
+            return [None] * len(prompts)
+        values = await self.result_cache.get_many([self._cache_key(prompt) for prompt in prompts])
+        return [None if value is None else json.loads(value) for value in values]
+
+    async def _store_variants(self, request: GenerationRequest, entries: List[Tuple[str, Dict[str, Any]]]):
+        if request.use_cache and entries:
+            await self.result_cache.set_many(
+                [(self._cache_key(prompt), json.dumps(entry)) for prompt, entry in entries],
+                ttl=settings.GENERATION_CACHE_TTL_SECONDS
+            )
+
+    def _variant(self, request: GenerationRequest, i: int, subject: str, content: str) -> MessageVariant:
+        return MessageVariant(
+            variant_id=f"var_{uuid.uuid4().hex[:8]}",
+            content=content,
+            subject=subject,
+            metadata={
+                "segment_id": request.segment_id,
+                "template_id": request.template_id or f"template_{i}",
+                "personalization_level": request.personalization_level,
+                "context_used": list(request.context.keys())
+            },
+            confidence=0.85 - (i * 0.05)
+        )
+
+    async def _generate_variant(self, prompt: str, i: int) -> Dict[str, Any]:
+        """Subject, content and tokens spent for variant i"""
+        template = TEMPLATES[i]
+        if self.client.endpoint:
+            completion = await self.client.generate_completion(prompt, max_tokens=settings.GENERATION_MAX_TOKENS)
+            subject, content = parse_completion(completion.text, template)
+            tokens = completion.total_tokens
+        else:
+            # Mock implementation - no LLM configured, use the template as-is,
+            # still one completion slot at a time like a real call
+            async with self.client.completion_slots:
+                subject, content = template["subject"], template["content"]
+                tokens = 0  # no LLM call, so caching it saves nothing
+        return {"subject": subject, "content": content, "tokens": tokens}
+
+    async def _stream_variant(
+        self,
+        prompt: str,
+        i: int,
+        events: "asyncio.Queue[Tuple[str, Dict[str, Any]]]"
+    ) -> Dict[str, Any]:
+        """Put variant i's text deltas on `events`; returns its subject, content and tokens spent"""
+        template = TEMPLATES[i]
+        if self.client.endpoint:
+            deltas = self.client.stream_completion(prompt, max_tokens=settings.GENERATION_MAX_TOKENS)
+            tokens = estimate_tokens(prompt)
+        else:
+            # Mock implementation - stream the template word by word, holding a
+            # completion slot like a real call
+            async def template_words():
+                async with self.client.completion_slots:
+                    for word in re.findall(r"\S+\s*", f"Subject: {template['subject']}\n\n{template['content']}"):
+                        yield word
+            deltas, tokens = template_words(), 0
+        parts = []
+        async for delta in deltas:
+            parts.append(delta)
+            await events.put(("token", {"variant_index": i, "text": delta}))
+        if self.client.endpoint:
+            tokens += len(parts)
+        subject, content = parse_completion("".join(parts), template)
+        return {"subject": subject, "content": content, "tokens": tokens}
+
     async def generate_messages(
         self,
         request: GenerationRequest
     ) -> GenerationResponse:
         """
         Generate personalized message variants
+
+        A variant whose prompt was already completed with the same model is
+        served from the result cache unless the request sets use_cache=False;
+        generation_metadata reports the tokens this saved.
         """
         logger.info(f"Generating {request.variants} variants for segment {request.segment_id}")
-        
-        # Mock implementation - in production, use OpenAI/Azure OpenAI
-        # This would make actual API calls to generate content
-        
-        variants = []
-        
-        templates = [
-            {
-                "subject": "Exclusive Offer Just for You",
-                "content": "Hi there! We noticed you've been eyeing our premium collection. Here's a special 20% discount just for valued customers like you."
-            },
-            {
-                "subject": "Your Personalized Recommendations",
-                "content": "Based on your recent purchases, we thought you'd love these hand-picked items. Check them out with our exclusive member pricing!"
-            },
-            {
-                "subject": "Don't Miss Out on This Limited Offer",
-                "content": "As one of our top customers, you get early access to our seasonal sale. Shop now before items sell out!"
-            }
-        ]
-        
-        for i in range(min(request.variants, len(templates))):
-            template = templates[i]
-            variant = MessageVariant(
-                variant_id=f"var_{uuid.uuid4().hex[:8]}",
-                content=template["content"],
-                subject=template["subject"],
-                metadata={
-                    "segment_id": request.segment_id,
-                    "template_id": request.template_id or f"template_{i}",
-                    "personalization_level": request.personalization_level,
-                    "context_used": list(request.context.keys())
-                },
-                confidence=0.85 - (i * 0.05)
-            )
-            variants.append(variant)
-        
-        logger.info(f"Generated {len(variants)} message variants")
-        
+
+        count = min(request.variants, len(TEMPLATES))
+        prompts = [build_prompt(request, TEMPLATES[i]) for i in range(count)]
+        entries = await self._cached_variants(request, prompts)
+        misses = [i for i, entry in enumerate(entries) if entry is None]
+        tokens_saved = sum(entry["tokens"] for entry in entries if entry is not None)
+        # Variants are independent LLM calls; the client bounds how many run at once
+        generated = await asyncio.gather(*(self._generate_variant(prompts[i], i) for i in misses))
+        await self._store_variants(request, [(prompts[i], entry) for i, entry in zip(misses, generated)])
+        for i, entry in zip(misses, generated):
+            entries[i] = entry
+        variants = [self._variant(request, i, entry["subject"], entry["content"]) for i, entry in enumerate(entries)]
+
+        logger.info(f"Generated {len(variants)} message variants ({len(variants) - len(misses)} cached)")
+
         return GenerationResponse(
             variants=variants,
             segment_id=request.segment_id,
             generation_metadata={
                 "model": self.model,
-                "timestamp": "2024-01-01T00:00:00Z",
-                "tokens_used": 150 * len(variants)
+                "timestamp": datetime.utcnow().isoformat() + "Z",
+                "tokens_used": sum(entry["tokens"] for entry in generated),
+                "tokens_saved": tokens_saved,
+                "cached_variants": len(variants) - len(misses)
             }
         )
 
+    async def stream_messages(self, request: GenerationRequest) -> AsyncIterator[Tuple[str, Dict[str, Any]]]:
+        """
+        Generate variants concurrently, yielding (event, data) as they progress
+
+        Events are "token" (a text delta of the raw completion, which
+        includes its "Subject:" line), "variant" (a finished MessageVariant;
+        cached variants arrive as this event alone), "error" (a variant that
+        failed) and a final "done" carrying the generation metadata. Each
+        variant's events arrive in order; variants interleave. Variants
+        still running are cancelled if the consumer stops early.
+        """
+        logger.info(f"Streaming {request.variants} variants for segment {request.segment_id}")
+        events: "asyncio.Queue[Tuple[str, Dict[str, Any]]]" = asyncio.Queue()
+        count = min(request.variants, len(TEMPLATES))
+        prompts = [build_prompt(request, TEMPLATES[i]) for i in range(count)]
+        entries = await self._cached_variants(request, prompts)
+
+        async def run(i: int) -> Optional[Dict[str, Any]]:
+            try:
+                entry = entries[i] or await self._stream_variant(prompts[i], i, events)
+            except Exception as e:
+                logger.error(f"Variant {i} for segment {request.segment_id} failed: {e}")
+                await events.put(("error", {"variant_index": i, "error": str(e)}))
+                return None
+            variant = self._variant(request, i, entry["subject"], entry["content"])
+            await events.put(("variant", {"variant_index": i, **variant.model_dump()}))
+            return entry
+
+        tasks = [asyncio.create_task(run(i)) for i in range(count)]
+        finished = 0
+        try:
+            while finished < count:
+                event, data = await events.get()
+                finished += event in ("variant", "error")
+                yield event, data
+            generated = await asyncio.gather(*tasks)  # each has put its last event
+            fresh = [
+                (prompts[i], entry) for i, entry in enumerate(generated)
+                if entry is not None and entries[i] is None
+            ]
+            await self._store_variants(request, fresh)
+            yield "done", {
+                "segment_id": request.segment_id,
+                "model": self.model,
+                "timestamp": datetime.utcnow().isoformat() + "Z",
+                "tokens_used": sum(entry["tokens"] for _, entry in fresh),
+                "tokens_saved": sum(entry["tokens"] for entry in entries if entry is not None),
+                "cached_variants": sum(entry is not None for entry in entries)
+            }
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    def renderer(self, variant: MessageVariant) -> VariantRenderer:
+        """
+        Per-customer renderer for a variant's {{field:type|default}} placeholders
+
+        Compiled forms are cached by text, so rendering the same variant
+        for many batches of customers compiles it once.
+        """
+        return VariantRenderer(variant.subject, variant.content)
+
+    async def generate_many(
+        self,
+        requests: List[GenerationRequest]
+    ) -> AsyncIterator[Tuple[int, Union[GenerationResponse, Exception]]]:
+        """
+        Generate several requests concurrently, yielding (index, response) as each finishes
+
+        As many workers as the LLM client's concurrency limit take requests
+        in order, so a large batch never has more than that many requests
+        (and their variants) in flight; the client further throttles the
+        variants to its concurrency limit and token budget. A failed request
+        yields its exception instead of a response; the others carry on.
+        Requests still running are cancelled if the consumer stops early.
+        """
+        results: "asyncio.Queue[Tuple[int, Union[GenerationResponse, Exception]]]" = asyncio.Queue()
+        queued = iter(enumerate(requests))
+
+        async def worker():
+            for i, request in queued:
+                try:
+                    response = await self.generate_messages(request)
+                except Exception as e:
+                    logger.error(f"Generation for segment {request.segment_id} failed: {e}")
+                    response = e
+                await results.put((i, response))
+
+        workers = [
+            asyncio.create_task(worker())
+            for _ in range(min(len(requests), self.client.completion_concurrency))
+        ]
+        try:
+            for _ in requests:
+                yield await results.get()
+        finally:
+            for task in workers:
+                task.cancel()
+
 
 # Global instance
 generation_agent = GenerationAgent()
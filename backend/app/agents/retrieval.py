@@ -2,26 +2,141 @@
 Retrieval Agent
 Handles context retrieval for personalization using RAG
 """
+import asyncio
+import hashlib
+import json
 import logging
-from typing import List, Dict, Any
+import uuid
+from collections import OrderedDict
+from datetime import datetime
+from typing import AsyncIterator, List, Dict, Any, Optional, Set, Tuple
 import numpy as np
 
 from app.models.schemas import RetrievalRequest, RetrievalResponse
+from app.utils.azure_clients import AzureOpenAIClient
+from app.utils.config import settings
+from app.utils.document_store import DocumentStore
+from app.utils.embedding_cache import EmbeddingCache
+from app.utils.lexical_index import LexicalIndex, reciprocal_rank_fusion
+from app.utils.metadata_index import MetadataIndex
+from app.utils.result_cache import ResultCache, build_cache
+from app.utils.retrieval_snapshot import RetrievalSnapshotStore
+from app.utils.vector_index import IVFIndex, QuantizedVectorIndex, VECTOR_DTYPE, VectorIndex
 
 logger = logging.getLogger(__name__)
 
+RETRIEVAL_METHODS = {
+    "semantic": "semantic_search",
+    "lexical": "lexical_bm25",
+    "hybrid": "hybrid_rrf"
+}
+
+
+def build_index(kind: str, storage: str = "float32") -> VectorIndex:
+    """Create the configured vector index (exact scan or IVF approximate)"""
+    if storage not in ("float32", "float16", "int8"):
+        raise ValueError(f"Unsupported vector storage: {storage}")
+    if kind == "exact":
+        if storage == "float32":
+            return VectorIndex()
+        return QuantizedVectorIndex(storage=storage, rerank_factor=settings.RETRIEVAL_RERANK_FACTOR)
+    if kind == "ivf":
+        if storage != "float32":
+            raise ValueError("Quantized vector storage is only supported with the exact index")
+        return IVFIndex(nlist=settings.RETRIEVAL_IVF_NLIST, nprobe=settings.RETRIEVAL_IVF_NPROBE)
+    raise ValueError(f"Unsupported retrieval index: {kind}")
+
+
+def restore_index(params: Dict[str, Any], arrays: Dict[str, np.ndarray]) -> VectorIndex:
+    """Rebuild a snapshotted vector index of whichever kind was saved"""
+    if params["kind"] == "ivf":
+        return IVFIndex.restore(params, arrays)
+    if params["storage"] == "float32":
+        return VectorIndex.restore(params, arrays)
+    return QuantizedVectorIndex.restore(params, arrays)
+
+
+def describe_snapshot(meta: Dict[str, Any]) -> Dict[str, Any]:
+    """Snapshot summary without the bulky vocabulary and value lists"""
+    return {
+        "version": meta["version"],
+        "created_at": meta["created_at"],
+        "documents": meta["documents"],
+        "index": meta["index"]
+    }
+
 
 class RetrievalAgent:
     """
     Agent responsible for retrieving relevant context
     Uses vector search and semantic similarity
     """
-    
-    def __init__(self):
-        self.embeddings_cache = {}
-        self.document_store = []
+
+    def __init__(
+        self,
+        embedding_client: Optional[AzureOpenAIClient] = None,
+        index: Optional[VectorIndex] = None,
+        cache_dir: Optional[str] = None,
+        result_cache: Optional[ResultCache] = None,
+        snapshot_dir: Optional[str] = None
+    ):
+        self.embeddings_cache = EmbeddingCache(
+            cache_dir or settings.EMBEDDING_CACHE_PATH,
+            max_memory_entries=settings.EMBEDDING_CACHE_MEMORY_ENTRIES
+        )
+        self.document_store = DocumentStore()  # row i <-> index position i
+        self.index = index if index is not None else build_index(
+            settings.RETRIEVAL_INDEX, settings.RETRIEVAL_VECTOR_STORAGE
+        )
+        self.result_cache = result_cache or build_cache(
+            settings.RETRIEVAL_CACHE_BACKEND,
+            prefix="retrieval:",
+            max_entries=settings.RETRIEVAL_CACHE_MAX_ENTRIES
+        )
+        self.metadata_index = MetadataIndex(settings.RETRIEVAL_FILTER_FIELDS)
+        self.lexical_index = LexicalIndex()
+        # Searches only see positions below this watermark; a batch becomes
+        # visible all at once when it is raised
+        self.published = 0
+        self.snapshots = RetrievalSnapshotStore(
+            snapshot_dir or settings.RETRIEVAL_SNAPSHOT_PATH,
+            retention=settings.RETRIEVAL_SNAPSHOT_RETENTION
+        )
+        self.base_snapshot: Optional[str] = None  # version the state was loaded from
+        # New on every load and publish, so result cache keys shared with other
+        # processes (or a restarted one) never match a different index state
+        self.generation = uuid.uuid4().hex
+        self.lock = asyncio.Lock()  # serializes writers; searches never wait on it
+        self.ingestions: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self._ingest_tasks: Set[asyncio.Task] = set()
+        self.embedding_client = embedding_client or AzureOpenAIClient(
+            settings.AZURE_OPENAI_ENDPOINT,
+            settings.AZURE_OPENAI_API_KEY,
+            settings.AZURE_OPENAI_DEPLOYMENT,
+            embedding_deployment=settings.AZURE_OPENAI_EMBEDDING_DEPLOYMENT,
+            api_version=settings.AZURE_OPENAI_API_VERSION,
+            embedding_batch_size=settings.EMBEDDING_BATCH_SIZE,
+            embedding_batch_max_wait=settings.EMBEDDING_BATCH_MAX_WAIT_MS / 1000
+        )
         logger.info("Retrieval Agent initialized")
-    
+
+    async def _embed(self, texts: List[str]) -> np.ndarray:
+        """Embed texts as one (n, dim) float32 matrix, reusing cached vectors"""
+        model = settings.OPENAI_EMBEDDING_MODEL
+        vectors = self.embeddings_cache.get_many(model, texts)
+        # Each distinct uncached text is embedded once, however often it repeats
+        missing = list(dict.fromkeys(text for text, vector in zip(texts, vectors) if vector is None))
+        if missing:
+            if len(missing) == 1:
+                # Lone texts (typically queries) are coalesced with concurrent requests
+                embedded = [await self.embedding_client.generate_embedding(missing[0])]
+            else:
+                embedded = await self.embedding_client.generate_embeddings(missing)
+            self.embeddings_cache.put_many(model, missing, embedded)
+            by_text = dict(zip(missing, embedded))
+            vectors = [by_text[text] if vector is None else vector for text, vector in zip(texts, vectors)]
+        return np.asarray(vectors, dtype=VECTOR_DTYPE)
+
     async def retrieve_context(
         self,
         request: RetrievalRequest
@@ -30,55 +145,326 @@ class RetrievalAgent:
         Retrieve relevant context for message generation
         """
         logger.info(f"Retrieving context for query: {request.query[:50]}...")
-        
-        # Mock implementation - in production, use vector DB
-        # like Azure Cognitive Search, Pinecone, or Weaviate
-        
-        mock_results = [
-            {
-                "id": "doc_1",
-                "content": "Premium customers prefer exclusive offers",
-                "source": "customer_insights",
-                "segment": request.segment_id or "general"
-            },
-            {
-                "id": "doc_2",
-                "content": "Personalized subject lines increase open rates by 26%",
-                "source": "best_practices",
-                "segment": request.segment_id or "general"
-            },
-            {
-                "id": "doc_3",
-                "content": "Product recommendations based on purchase history",
-                "source": "recommendations",
-                "segment": request.segment_id or "general"
-            }
+        [response] = await self.retrieve_many([request])
+        return response
+
+    def _filters(self, request: RetrievalRequest) -> Dict[str, Any]:
+        """Request filters with segment_id folded in as a "segment" filter"""
+        filters = dict(request.filters or {})
+        if request.segment_id is not None:
+            filters["segment"] = request.segment_id
+        return filters
+
+    @property
+    def index_version(self) -> str:
+        """Identifies what searches can see: the loaded snapshot, the watermark and the generation"""
+        return f"{self.base_snapshot or 'empty'}+{self.published}@{self.generation}"
+
+    def _cache_key(self, request: RetrievalRequest, index_version: str) -> str:
+        """
+        Result cache key: whitespace-normalized query, effective filters,
+        top_k, mode and the index version, so publishing documents
+        invalidates every earlier entry
+        """
+        payload = {
+            "query": " ".join(request.query.split()),
+            "filters": self._filters(request),
+            "top_k": request.top_k,
+            "mode": request.mode,
+            "index_version": index_version
+        }
+        return hashlib.sha256(json.dumps(payload, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+    async def retrieve_many(
+        self,
+        requests: List[RetrievalRequest]
+    ) -> List[RetrievalResponse]:
+        """
+        Answer several queries, serving repeated ones from the result cache
+        """
+        if not requests:
+            return []
+        keys = [self._cache_key(request, self.index_version) for request in requests]
+        cached = await self.result_cache.get_many(keys)
+        responses: List[Optional[RetrievalResponse]] = [
+            None if value is None else RetrievalResponse.model_validate_json(value) for value in cached
         ]
-        
-        # Mock similarity scores
-        scores = [0.92, 0.87, 0.83]
-        
-        # Return top k results
-        top_results = mock_results[:request.top_k]
-        top_scores = scores[:request.top_k]
-        
-        logger.info(f"Retrieved {len(top_results)} relevant documents")
-        
-        return RetrievalResponse(
-            results=top_results,
-            scores=top_scores,
-            metadata={
-                "query": request.query,
-                "segment_id": request.segment_id,
-                "retrieval_method": "semantic_search"
+        for response in responses:
+            if response is not None:
+                response.metadata["cached"] = True
+
+        misses = [i for i, response in enumerate(responses) if response is None]
+        if misses:
+            fresh = await self._search([requests[i] for i in misses])
+            for i, response in zip(misses, fresh):
+                responses[i] = response
+            await self.result_cache.set_many(
+                [(keys[i], response.model_dump_json()) for i, response in zip(misses, fresh)],
+                ttl=settings.RETRIEVAL_CACHE_TTL_SECONDS
+            )
+        return responses
+
+    async def _search(
+        self,
+        requests: List[RetrievalRequest]
+    ) -> List[RetrievalResponse]:
+        """
+        Answer several queries with batched scoring passes over the indexes
+
+        Metadata filters are resolved to candidate positions first, so
+        scoped queries only score matching documents; queries sharing the
+        same filters are scored together. Lexical-mode queries skip the
+        embedding call entirely; hybrid queries fuse both rankings.
+        """
+        if not requests:
+            return []
+        groups: Dict[str, List[int]] = {}
+        group_filters: Dict[str, Dict[str, Any]] = {}
+        for i, request in enumerate(requests):
+            filters = self._filters(request)
+            key = json.dumps(filters, sort_keys=True, default=str)
+            groups.setdefault(key, []).append(i)
+            group_filters[key] = filters
+        # Resolve filters before embedding so bad field names fail fast
+        group_candidates = {key: self.metadata_index.lookup(filters) for key, filters in group_filters.items()}
+        semantic = [i for i, request in enumerate(requests) if request.mode != "lexical"]
+        queries = await self._embed([requests[i].query for i in semantic]) if semantic else None
+        query_rows = {i: row for row, i in enumerate(semantic)}
+        published = self.published
+
+        responses: List[Optional[RetrievalResponse]] = [None] * len(requests)
+        for key, members in groups.items():
+            candidates = group_candidates[key]
+            if candidates is not None:
+                candidates = candidates[:np.searchsorted(candidates, published)]
+            searched = published if candidates is None else len(candidates)
+            pools = {
+                i: requests[i].top_k if requests[i].mode == "semantic"
+                else max(requests[i].top_k, settings.RETRIEVAL_HYBRID_CANDIDATES)
+                for i in members
             }
-        )
-    
+
+            vector_hits: Dict[int, Tuple[np.ndarray, np.ndarray]] = {}
+            vector_members = [i for i in members if i in query_rows]
+            if vector_members and searched:
+                # Scoring is CPU-bound (BLAS releases the GIL); keep the loop free
+                positions, scores = await asyncio.to_thread(
+                    self.index.search,
+                    queries[[query_rows[i] for i in vector_members]],
+                    max(pools[i] for i in vector_members),
+                    candidates,
+                    published
+                )
+                for i, row_positions, row_scores in zip(vector_members, positions, scores):
+                    # Approximate indexes pad with -1 when the probed lists run short
+                    found = row_positions[:pools[i]] >= 0
+                    vector_hits[i] = (row_positions[:pools[i]][found], row_scores[:pools[i]][found])
+
+            for i in members:
+                request = requests[i]
+                empty = (np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32))
+                if request.mode == "semantic":
+                    positions, scores = vector_hits.get(i, empty)
+                else:
+                    lexical = self.lexical_index.search(request.query, pools[i], candidates, published)
+                    if request.mode == "lexical":
+                        positions, scores = lexical
+                    else:
+                        positions, scores = reciprocal_rank_fusion(
+                            [vector_hits.get(i, empty)[0], lexical[0]],
+                            request.top_k,
+                            k=settings.RETRIEVAL_RRF_K
+                        )
+                responses[i] = RetrievalResponse(
+                    results=[self.document_store[position] for position in positions[:request.top_k].tolist()],
+                    scores=scores[:request.top_k].tolist(),
+                    metadata={
+                        "query": request.query,
+                        "segment_id": request.segment_id,
+                        "filters": request.filters,
+                        "retrieval_method": RETRIEVAL_METHODS[request.mode],
+                        "documents_searched": searched,
+                        "cached": False
+                    }
+                )
+        logger.info(f"Retrieved context for {len(requests)} queries over {published} documents")
+        return responses
+
     async def add_documents(self, documents: List[Dict[str, Any]]):
-        """Add documents to the retrieval store"""
-        self.document_store.extend(documents)
+        """
+        Add documents to the retrieval store and index them
+
+        Documents carrying an "embedding" are indexed as-is; the rest are
+        embedded from their "content". Embeddings live only in the index
+        matrix, not in the stored document dicts. The batch is published to
+        searches in one step once it is fully indexed; if any part of
+        indexing fails, every component is rolled back to where it was.
+        """
+        if not documents:
+            return
+        documents = [dict(document) for document in documents]
+        for i, document in enumerate(documents):
+            if not isinstance(document.get("content", ""), str):
+                raise ValueError(f"Document {i}: content must be a string")
+        self.metadata_index.validate(documents)
+        vectors = [document.pop("embedding", None) for document in documents]
+        missing = [i for i, vector in enumerate(vectors) if vector is None]
+        if missing:
+            embedded = await self._embed([documents[i].get("content", "") for i in missing])
+            for i, vector in zip(missing, embedded):
+                vectors[i] = vector
+
+        async with self.lock:
+            start = len(self.document_store)
+            for position, document in enumerate(documents, start):
+                document.setdefault("id", f"doc_{position}")
+            try:
+                self.document_store.extend(documents)
+                await asyncio.to_thread(self._index_batch, start, documents, vectors)
+            except Exception:
+                # Rows past `start` were never published, so no search has seen them
+                for component in (self.document_store, self.index, self.metadata_index, self.lexical_index):
+                    component.truncate(start)
+                raise
+            self.published = len(self.document_store)
+            self.generation = uuid.uuid4().hex
         logger.info(f"Added {len(documents)} documents to store")
 
+    def _index_batch(self, start: int, documents: List[Dict[str, Any]], vectors: List[Any]):
+        """
+        Add a stored batch to the vector, metadata and lexical indexes
+
+        Runs in a worker thread so searches keep being served meanwhile;
+        they only see the batch once `published` moves past it.
+        """
+        # May train an approximate index
+        self.index.add(np.asarray(vectors, dtype=VECTOR_DTYPE))
+        self.metadata_index.add(start, documents)
+        self.lexical_index.add(start, [document.get("content", "") for document in documents])
+
+    async def save_snapshot(self) -> Dict[str, Any]:
+        """
+        Write the published documents and indexes as a new snapshot version
+
+        Holds the writer lock while the files are written, so ingestion
+        pauses but searches keep running.
+        """
+        async with self.lock:
+            meta = await asyncio.to_thread(self._write_snapshot)
+        return describe_snapshot(meta)
+
+    def _write_snapshot(self) -> Dict[str, Any]:
+        index_params, index_arrays = self.index.export()
+        metadata_params, metadata_arrays = self.metadata_index.export()
+        lexical_params, lexical_arrays = self.lexical_index.export()
+        return self.snapshots.save(
+            {"index": index_params, "metadata": metadata_params, "lexical": lexical_params},
+            {**index_arrays, **metadata_arrays, **lexical_arrays},
+            self.document_store,
+            self.published
+        )
+
+    def load_snapshot(self, version: Optional[str] = None) -> Optional[Dict[str, Any]]:
+        """
+        Replace the retrieval state with a snapshot (default: the latest)
+
+        Only maps the files: vectors and postings are paged in on first use
+        and documents are decoded when returned. Meant for startup, before
+        requests are served. Returns the snapshot summary, or None when no
+        snapshot exists.
+        """
+        loaded = self.snapshots.load(version)
+        if loaded is None:
+            return None
+        meta, arrays, documents = loaded
+        index = restore_index(meta["index"], arrays)
+        metadata_index = MetadataIndex.restore(meta["metadata"], arrays)
+        if list(metadata_index.fields) != list(settings.RETRIEVAL_FILTER_FIELDS):
+            logger.warning(
+                f"Snapshot {meta['version']} indexes filter fields {list(metadata_index.fields)}, "
+                f"not the configured {settings.RETRIEVAL_FILTER_FIELDS}"
+            )
+        if meta["index"]["kind"] != settings.RETRIEVAL_INDEX:
+            logger.warning(f"Snapshot {meta['version']} holds a {meta['index']['kind']} index")
+        self.document_store = documents
+        self.index = index
+        self.metadata_index = metadata_index
+        self.lexical_index = LexicalIndex.restore(meta["lexical"], arrays)
+        self.published = meta["documents"]
+        self.base_snapshot = meta["version"]
+        self.generation = uuid.uuid4().hex
+        return describe_snapshot(meta)
+
+    async def ingest_stream(self, batches: AsyncIterator[List[Dict[str, Any]]]) -> Dict[str, Any]:
+        """
+        Feed an upload's document batches to a background indexing task
+
+        At most RETRIEVAL_INGEST_MAX_PENDING_BATCHES parsed batches wait for
+        indexing; beyond that reading the upload pauses, so memory stays
+        bounded whatever its size. Returns the ingestion record once the
+        upload is fully read; indexing may still be running.
+        """
+        ingestion_id = f"ingest_{uuid.uuid4().hex[:12]}"
+        ingestion = {
+            "ingestion_id": ingestion_id,
+            "status": "receiving",
+            "documents_received": 0,
+            "documents_indexed": 0,
+            "batches_published": 0,
+            "created_at": datetime.utcnow(),
+            "finished_at": None,
+            "error": None
+        }
+        self.ingestions[ingestion_id] = ingestion
+        while len(self.ingestions) > settings.RETRIEVAL_INGESTION_RETENTION:
+            self.ingestions.popitem(last=False)
+
+        queue: "asyncio.Queue[Optional[List[Dict[str, Any]]]]" = asyncio.Queue(
+            maxsize=settings.RETRIEVAL_INGEST_MAX_PENDING_BATCHES
+        )
+        task = asyncio.create_task(self._index_batches(ingestion, queue))
+        self._ingest_tasks.add(task)
+        task.add_done_callback(self._ingest_tasks.discard)
+        try:
+            async for batch in batches:
+                if ingestion["status"] == "failed":
+                    break
+                ingestion["documents_received"] += len(batch)
+                await queue.put(batch)
+        except Exception as e:
+            ingestion["status"] = "failed"
+            ingestion["error"] = str(e)
+            raise
+        finally:
+            await queue.put(None)
+        if ingestion["status"] == "receiving":
+            ingestion["status"] = "indexing"
+        return ingestion
+
+    async def _index_batches(self, ingestion: Dict[str, Any], queue: "asyncio.Queue"):
+        """Index queued batches in order until the end-of-upload marker"""
+        while (batch := await queue.get()) is not None:
+            if ingestion["status"] == "failed":
+                continue  # drain so the reader never blocks on a full queue
+            try:
+                await self.add_documents(batch)
+            except Exception as e:
+                logger.error(f"Ingestion {ingestion['ingestion_id']} failed: {e}")
+                ingestion["status"] = "failed"
+                ingestion["error"] = str(e)
+                continue
+            ingestion["documents_indexed"] += len(batch)
+            ingestion["batches_published"] += 1
+        if ingestion["status"] != "failed":
+            ingestion["status"] = "completed"
+        ingestion["finished_at"] = datetime.utcnow()
+
+    def get_ingestion(self, ingestion_id: str) -> Dict[str, Any]:
+        """Progress of a document ingestion"""
+        if ingestion_id not in self.ingestions:
+            raise LookupError(f"Ingestion {ingestion_id} not found")
+        return self.ingestions[ingestion_id]
+
 
 # Global instance
 retrieval_agent = RetrievalAgent()
@@ -2,6 +2,7 @@
 Safety Agent
 Handles content safety checks and moderation
 """
+import asyncio
 import logging
 from typing import List
 
@@ -9,8 +10,11 @@ from app.models.schemas import (
     SafetyRequest,
     SafetyResponse,
     SafetyIssue,
+    SafetySpan,
     SafetyCheckType
 )
+from app.utils.config import settings
+from app.utils.pii_scanner import PII_KINDS, POLICY_KIND, Finding, PIIScanner
 
 logger = logging.getLogger(__name__)
 
@@ -23,6 +27,7 @@ class SafetyAgent:
     
     def __init__(self):
         self.safety_models = {}
+        self.scanner = PIIScanner(settings.SAFETY_POLICY_TERMS)
         logger.info("Safety Agent initialized")
     
     async def check_safety(
@@ -31,6 +36,9 @@ class SafetyAgent:
     ) -> SafetyResponse:
         """
         Perform comprehensive safety checks on content
+
+        PII and content-policy issues carry the spans they were found at;
+        both checks share a single scan of the content.
         """
         logger.info(f"Running safety checks on content (length: {len(request.content)})")
         
@@ -68,16 +76,21 @@ class SafetyAgent:
             else:
                 passed_checks.append("bias")
         
+        findings: List[Finding] = []
+        if {SafetyCheckType.PII, SafetyCheckType.CONTENT_POLICY, SafetyCheckType.ALL} & set(request.check_types):
+            findings = await self._scan(request.content)
+        
         # Check for PII
         if SafetyCheckType.PII in request.check_types or SafetyCheckType.ALL in request.check_types:
-            pii_detected = await self._check_pii(request.content)
-            if pii_detected:
+            pii = [finding for finding in findings if finding.kind in PII_KINDS]
+            if pii:
                 issues.append(SafetyIssue(
                     issue_type="pii",
                     severity="high",
                     confidence=0.95,
-                    description="Potential PII detected in content",
-                    suggested_fix="Remove or redact personal information"
+                    description=f"Potential PII detected in content: {', '.join(dict.fromkeys(f.kind for f in pii))}",
+                    suggested_fix="Remove or redact personal information",
+                    spans=self._spans(pii)
                 ))
                 failed_checks.append("pii")
             else:
@@ -85,14 +98,15 @@ class SafetyAgent:
         
         # Check content policy
         if SafetyCheckType.CONTENT_POLICY in request.check_types or SafetyCheckType.ALL in request.check_types:
-            policy_violation = await self._check_content_policy(request.content)
-            if policy_violation:
+            terms = [finding for finding in findings if finding.kind == POLICY_KIND]
+            if terms:
                 issues.append(SafetyIssue(
                     issue_type="content_policy",
                     severity="high",
                     confidence=0.88,
-                    description="Content may violate usage policies",
-                    suggested_fix="Review content against policy guidelines"
+                    description=f"Content may violate usage policies: {', '.join(dict.fromkeys(f.text.lower() for f in terms))}",
+                    suggested_fix="Review content against policy guidelines",
+                    spans=self._spans(terms)
                 ))
                 failed_checks.append("content_policy")
             else:
@@ -121,16 +135,13 @@ class SafetyAgent:
         # Mock implementation
         return 0.2
     
-    async def _check_pii(self, content: str) -> bool:
-        """Check content for PII"""
-        # Mock implementation - use Azure Text Analytics
-        pii_patterns = ['@', 'ssn', 'credit card']
-        return any(pattern in content.lower() for pattern in pii_patterns)
+    async def _scan(self, content: str) -> List[Finding]:
+        """PII and policy-term findings, scanned off the event loop"""
+        return await asyncio.to_thread(self.scanner.scan, content)
     
-    async def _check_content_policy(self, content: str) -> bool:
-        """Check content against usage policies"""
-        # Mock implementation
-        return False
+    @staticmethod
+    def _spans(findings: List[Finding]) -> List[SafetySpan]:
+        return [SafetySpan(type=finding.kind, start=finding.start, end=finding.end) for finding in findings]
 
 
 # Global instance
@@ -2,78 +2,84 @@
 Segmentation Agent
 Handles customer segmentation using various ML algorithms
 """
+import asyncio
 import logging
-from typing import List, Dict, Any
-from datetime import datetime
+import time
+import uuid
+from functools import partial
+from typing import List, Dict, Any, Optional, Tuple, Union
 import numpy as np
-from sklearn.cluster import KMeans
-from sklearn.preprocessing import StandardScaler
+from pydantic import ValidationError
 
 from app.models.schemas import (
     CustomerFeatures,
     Segment,
+    SegmentationOptions,
     SegmentationRequest,
-    SegmentationResponse
+    ColumnarSegmentationRequest,
+    SegmentationResponse,
+    SegmentationStreamRequest,
+    SegmentationStreamStatus,
+    SegmentAssignmentRequest,
+    SegmentAssignmentResponse,
+    SegmentationJobStatus,
+    IncrementalSegmentationRequest,
+    IncrementalSegmentationResponse,
+    SegmentDrift
 )
+from app.utils.features import (
+    FEATURE_NAMES,
+    extract_from_columns,
+    extract_from_customers,
+    validate_matrix
+)
+from app.utils.assignment_store import AssignmentStore, StoredAssignments
+from app.utils.clustering import (
+    build_profiles,
+    fit_segmentation,
+    incremental_update,
+    score_candidate_k
+)
+from app.utils.config import settings
+from app.utils.jobs import JobManager, share_array
+from app.utils.model_registry import SegmentationModelRegistry
+from app.utils.segment_stream import SegmentationStream
 
 logger = logging.getLogger(__name__)
 
 
+def _validate_records(records: List[Dict[str, Any]]):
+    """Raise ValueError naming the first raw record that is not a valid CustomerFeatures"""
+    for i, record in enumerate(records):
+        try:
+            CustomerFeatures.model_validate(record)
+        except ValidationError as e:
+            error = e.errors()[0]
+            field = ".".join(map(str, error["loc"])) or "record"
+            raise ValueError(f"Invalid customer record {i}: {field}: {error['msg']}") from None
+
+
 class SegmentationAgent:
     """
     Agent responsible for customer segmentation
     Uses ML algorithms to group customers based on features
     """
     
-    def __init__(self):
-        self.scaler = StandardScaler()
-        self.model = None
-        self.feature_names = []
+    def __init__(self, model_dir: Optional[str] = None, jobs: Optional[JobManager] = None):
+        self.feature_names = list(FEATURE_NAMES)
+        self.streams: Dict[str, SegmentationStream] = {}
+        self.registry = SegmentationModelRegistry(model_dir or settings.MODEL_STORAGE_PATH)
+        self.jobs = jobs or JobManager(
+            max_workers=settings.SEGMENTATION_WORKERS,
+            max_pending=settings.SEGMENTATION_MAX_PENDING_JOBS,
+            max_finished=settings.SEGMENTATION_JOB_RETENTION
+        )
+        self.results = AssignmentStore(settings.SEGMENTATION_MAX_STORED_RESULTS)
         logger.info("Segmentation Agent initialized")
     
     def _extract_features(self, customers: List[CustomerFeatures]) -> np.ndarray:
-        """Extract and normalize features from customer data"""
-        features_list = []
-        
-        for customer in customers:
-            # Combine all feature dictionaries into a single vector
-            feature_vector = []
-            
-            # Extract demographic features
-            demo = customer.demographics
-            feature_vector.extend([
-                demo.get('age', 0),
-                demo.get('income', 0),
-                1 if demo.get('gender') == 'M' else 0
-            ])
-            
-            # Extract behavioral features
-            behavior = customer.behavior
-            feature_vector.extend([
-                behavior.get('page_views', 0),
-                behavior.get('session_duration', 0),
-                behavior.get('bounce_rate', 0)
-            ])
-            
-            # Extract purchase history
-            purchase = customer.purchase_history
-            feature_vector.extend([
-                purchase.get('total_purchases', 0),
-                purchase.get('avg_order_value', 0),
-                purchase.get('lifetime_value', 0)
-            ])
-            
-            # Extract engagement metrics
-            engagement = customer.engagement
-            feature_vector.extend([
-                engagement.get('email_open_rate', 0),
-                engagement.get('click_through_rate', 0),
-                engagement.get('last_interaction_days', 0)
-            ])
-            
-            features_list.append(feature_vector)
-        
-        return np.array(features_list)
+        """Extract features from customer data into a float32 matrix"""
+        return extract_from_customers(customers)
     
     async def segment_customers(
         self,
@@ -82,64 +88,424 @@ class SegmentationAgent:
         """
         Segment customers using specified algorithm
         """
+        async with self.jobs.slot():
+            return await self._segment_customers(request)
+    
+    async def segment_columnar(
+        self,
+        request: ColumnarSegmentationRequest
+    ) -> SegmentationResponse:
+        """
+        Segment customers supplied as parallel per-feature arrays
+        """
+        async with self.jobs.slot():
+            return await self._segment_columnar(request)
+    
+    async def segment_matrix(
+        self,
+        features: np.ndarray,
+        customer_ids: List[str],
+        options: SegmentationOptions
+    ) -> SegmentationResponse:
+        """
+        Segment a prebuilt feature matrix laid out as FEATURE_SPEC
+        """
+        features = validate_matrix(features)
+        if len(customer_ids) != features.shape[0]:
+            raise ValueError(
+                f"Got {len(customer_ids)} customer ids for {features.shape[0]} feature rows"
+            )
+        logger.info(f"Starting matrix segmentation for {len(customer_ids)} customers")
+        
+        async with self.jobs.slot():
+            return await self._segment_matrix(features, customer_ids, options)
+    
+    def submit_job(
+        self,
+        request: Union[SegmentationRequest, ColumnarSegmentationRequest]
+    ) -> SegmentationJobStatus:
+        """
+        Run a segmentation in the background and return a job id to poll
+        """
+        if isinstance(request, ColumnarSegmentationRequest):
+            job_id = self.jobs.submit(self._segment_columnar, request)
+        else:
+            job_id = self.jobs.submit(self._segment_customers, request)
+        logger.info(f"Submitted segmentation job {job_id}")
+        return self.get_job(job_id)
+    
+    def get_job(self, job_id: str) -> SegmentationJobStatus:
+        """
+        Current status of a segmentation job, with its result once completed
+        """
+        return SegmentationJobStatus(**self.jobs.get(job_id))
+    
+    async def _segment_customers(self, request: SegmentationRequest) -> SegmentationResponse:
+        """Extract features off the event loop and segment them"""
         logger.info(f"Starting segmentation for {len(request.customers)} customers")
         
-        # Extract features
-        features = self._extract_features(request.customers)
+        features = await asyncio.to_thread(self._extract_features, request.customers)
+        customer_ids = [customer.customer_id for customer in request.customers]
         
-        # Normalize features
-        features_normalized = self.scaler.fit_transform(features)
+        return await self._segment_matrix(features, customer_ids, request)
+    
+    async def _segment_columnar(self, request: ColumnarSegmentationRequest) -> SegmentationResponse:
+        """Build the feature matrix from columns off the event loop and segment it"""
+        logger.info(f"Starting columnar segmentation for {len(request.customer_ids)} customers")
         
-        # Apply clustering algorithm
-        if request.algorithm == "kmeans":
-            self.model = KMeans(n_clusters=request.num_segments, random_state=42)
-            labels = self.model.fit_predict(features_normalized)
-        else:
-            raise ValueError(f"Unsupported algorithm: {request.algorithm}")
-        
-        # Create segments
-        segments = []
-        assignments = {}
-        
-        for i in range(request.num_segments):
-            segment_customers = [
-                request.customers[j] 
-                for j in range(len(request.customers)) 
-                if labels[j] == i
-            ]
-            
-            # Calculate segment characteristics
-            segment_features = features[labels == i]
-            characteristics = {
-                "avg_age": float(np.mean(segment_features[:, 0])),
-                "avg_income": float(np.mean(segment_features[:, 1])),
-                "avg_ltv": float(np.mean(segment_features[:, 8])),
-                "size": len(segment_customers)
-            }
-            
-            segment = Segment(
-                segment_id=f"seg_{i}",
-                name=f"Segment {i}",
-                description=f"Customer segment {i} with {len(segment_customers)} members",
-                size=len(segment_customers),
-                characteristics=characteristics
-            )
-            segments.append(segment)
-            
-            # Record assignments
-            for customer in segment_customers:
-                assignments[customer.customer_id] = f"seg_{i}"
+        features = await asyncio.to_thread(
+            extract_from_columns, request.columns, len(request.customer_ids)
+        )
         
-        # Calculate quality score (silhouette score approximation)
-        quality_score = 0.75  # Placeholder
+        return await self._segment_matrix(features, request.customer_ids, request)
+    
+    async def _segment_matrix(
+        self,
+        features: np.ndarray,
+        customer_ids: List[str],
+        options: SegmentationOptions
+    ) -> SegmentationResponse:
+        """Cluster a feature matrix in the process pool and build the response"""
+        quality_sample_size = options.quality_sample_size or settings.SEGMENTATION_QUALITY_SAMPLE_SIZE
+        
+        k_selection = None
+        num_segments = options.num_segments
+        if num_segments == "auto":
+            num_segments, k_selection = await self._select_num_segments(features, options)
+        
+        fit = partial(
+            fit_segmentation,
+            quality_sample_size=quality_sample_size,
+            quality_time_budget=options.quality_time_budget or settings.SEGMENTATION_QUALITY_TIME_BUDGET
+        )
+        result = await self.jobs.run_in_pool(fit, features, num_segments, options.algorithm)
+        
+        profiles = build_profiles(self.feature_names, result.means, result.stds, result.quantiles)
+        segments = [
+            self._build_segment(i, result.counts[i], profiles[i])
+            for i in range(num_segments)
+        ]
+        
+        segmentation_id, assignments = self._record_assignments(
+            customer_ids, result.labels, num_segments, options.inline_assignments
+        )
+        
+        model_version = None
+        if options.save_model:
+            model_version = self.registry.save(
+                result.scaler_mean,
+                result.scaler_scale,
+                result.centroids,
+                result.counts,
+                metadata={"algorithm": options.algorithm, "num_customers": len(customer_ids)}
+            ).version
         
         logger.info(f"Segmentation complete: {len(segments)} segments created")
         
         return SegmentationResponse(
+            segmentation_id=segmentation_id,
+            segments=segments,
+            assignments=assignments,
+            quality_score=result.quality_score,
+            quality_details=self._quality_details(quality_sample_size, result.quality_rows),
+            k_selection=k_selection,
+            model_version=model_version
+        )
+    
+    async def _select_num_segments(
+        self,
+        features: np.ndarray,
+        options: SegmentationOptions
+    ) -> Tuple[int, Dict[str, Any]]:
+        """
+        Sweep candidate k values in parallel on a shared, scaled subsample
+        
+        The subsample is written to shared memory once; every pool worker
+        reads it in place and scores one k with the sampled silhouette.
+        """
+        # Full-matrix statistics; keep them off the event loop
+        sample = await asyncio.to_thread(
+            self._scaled_sample, features, settings.SEGMENTATION_AUTO_K_SAMPLE_SIZE
+        )
+        
+        max_k = min(options.max_segments or settings.MAX_SEGMENTS, len(sample) - 1)
+        candidates = list(range(options.min_segments, max_k + 1))
+        if not candidates:
+            raise ValueError(
+                f"No candidate segment counts between {options.min_segments} and {max_k}"
+            )
+        logger.info(f"Selecting k from {candidates} on {len(sample)} sampled customers")
+        
+        quality_sample_size = options.quality_sample_size or settings.SEGMENTATION_QUALITY_SAMPLE_SIZE
+        with share_array(sample) as sample_ref:
+            curve = await asyncio.gather(*[
+                self.jobs.run_in_pool(
+                    score_candidate_k, sample_ref, k, options.algorithm, quality_sample_size
+                )
+                for k in candidates
+            ])
+        
+        best = max(curve, key=lambda point: point["score"])
+        return best["k"], {
+            "metric": "sampled_silhouette",
+            "best_k": best["k"],
+            "sample_size": len(sample),
+            "curve": curve
+        }
+    
+    @staticmethod
+    def _scaled_sample(features: np.ndarray, sample_size: int) -> np.ndarray:
+        """Uniform subsample of up to sample_size rows, standardized with full-data statistics"""
+        rng = np.random.default_rng(42)
+        n = features.shape[0]
+        rows = np.sort(rng.choice(n, size=sample_size, replace=False)) if n > sample_size else np.arange(n)
+        mean = features.mean(axis=0, dtype=np.float64)
+        scale = features.std(axis=0, dtype=np.float64)
+        scale[scale == 0] = 1.0
+        return (features[rows] - mean) / scale
+    
+    def _record_assignments(
+        self,
+        customer_ids: List[str],
+        labels: np.ndarray,
+        num_segments: int,
+        inline: bool
+    ) -> Tuple[str, Dict[str, str]]:
+        """
+        Store a run's assignments compactly; build the inline dict only if asked
+        """
+        segmentation_id = f"segrun_{uuid.uuid4().hex[:12]}"
+        self.results.put(segmentation_id, customer_ids, labels, num_segments)
+        if not inline:
+            return segmentation_id, {}
+        segment_ids = np.array([f"seg_{i}" for i in range(num_segments)], dtype=object)
+        return segmentation_id, dict(zip(customer_ids, segment_ids[labels].tolist()))
+    
+    def get_assignments(self, segmentation_id: str) -> StoredAssignments:
+        """
+        Stored assignments of a previous segmentation run
+        """
+        return self.results.get(segmentation_id)
+    
+    def _quality_details(self, sample_size: int, rows_scored: int) -> Dict[str, Any]:
+        """Describe how quality_score was computed"""
+        return {
+            "metric": "sampled_silhouette",
+            "sample_size": sample_size,
+            "rows_scored": rows_scored
+        }
+    
+    def _build_segment(
+        self,
+        index: int,
+        size: int,
+        profile: Dict[str, Dict[str, float]]
+    ) -> Segment:
+        """Build a Segment from its size and per-feature profile"""
+        characteristics = {
+            "avg_age": profile["age"]["mean"],
+            "avg_income": profile["income"]["mean"],
+            "avg_ltv": profile["lifetime_value"]["mean"],
+            "size": int(size),
+            "features": profile
+        }
+        return Segment(
+            segment_id=f"seg_{index}",
+            name=f"Segment {index}",
+            description=f"Customer segment {index} with {size} members",
+            size=int(size),
+            characteristics=characteristics
+        )
+    
+    async def create_stream(self, request: SegmentationStreamRequest) -> SegmentationStreamStatus:
+        """
+        Open a streaming segmentation session fed by chunked uploads
+        """
+        if request.algorithm != "minibatch_kmeans":
+            raise ValueError(f"Unsupported streaming algorithm: {request.algorithm}")
+        self._expire_streams()
+        stream_id = f"stream_{uuid.uuid4().hex[:8]}"
+        self.streams[stream_id] = SegmentationStream(
+            stream_id,
+            request.num_segments,
+            chunk_size=request.chunk_size,
+            save_model=request.save_model,
+            inline_assignments=request.inline_assignments
+        )
+        logger.info(f"Created segmentation stream {stream_id}")
+        return SegmentationStreamStatus(stream_id=stream_id, status="open", rows_received=0)
+    
+    async def add_stream_records(
+        self,
+        stream_id: str,
+        records: List[Dict[str, Any]]
+    ) -> SegmentationStreamStatus:
+        """
+        Update a stream's scaler and centroids with one chunk of customers
+        """
+        stream = self._get_stream(stream_id)
+        await asyncio.to_thread(_validate_records, records)
+        async with stream.lock:
+            rows_received = await asyncio.to_thread(stream.add_records, records)
+        return SegmentationStreamStatus(stream_id=stream_id, status="open", rows_received=rows_received)
+    
+    async def finalize_stream(self, stream_id: str) -> SegmentationResponse:
+        """
+        Label every streamed customer and close the session
+        """
+        stream = self._get_stream(stream_id)
+        async with stream.lock:
+            if self.streams.pop(stream_id, None) is None:
+                raise LookupError(f"Segmentation stream {stream_id} not found")
+            try:
+                stats, customer_ids, labels, quality_score, quality_rows = await asyncio.to_thread(
+                    stream.finalize,
+                    settings.SEGMENTATION_QUALITY_SAMPLE_SIZE,
+                    settings.SEGMENTATION_QUALITY_TIME_BUDGET
+                )
+            finally:
+                stream.close()
+        
+        # Quantiles need the full data, so streamed profiles carry mean/std only
+        profiles = build_profiles(self.feature_names, stats.means, stats.stds)
+        segments = [
+            self._build_segment(i, stats.counts[i], profiles[i])
+            for i in range(stream.num_segments)
+        ]
+        segmentation_id, assignments = self._record_assignments(
+            customer_ids, labels, stream.num_segments, stream.inline_assignments
+        )
+        
+        model_version = None
+        if stream.save_model:
+            model_version = self.registry.save(
+                stream.scaler.mean_,
+                stream.scaler.scale_,
+                stream.model.cluster_centers_,
+                stats.counts,
+                metadata={"algorithm": "minibatch_kmeans", "num_customers": stream.rows_received}
+            ).version
+        
+        return SegmentationResponse(
+            segmentation_id=segmentation_id,
             segments=segments,
             assignments=assignments,
-            quality_score=quality_score
+            quality_score=quality_score,
+            quality_details=self._quality_details(
+                settings.SEGMENTATION_QUALITY_SAMPLE_SIZE, quality_rows
+            ),
+            model_version=model_version
         )
+    
+    def _get_stream(self, stream_id: str) -> SegmentationStream:
+        """Look up an open stream and mark it active"""
+        self._expire_streams()
+        if stream_id not in self.streams:
+            raise LookupError(f"Segmentation stream {stream_id} not found")
+        stream = self.streams[stream_id]
+        stream.last_active = time.monotonic()
+        return stream
+    
+    def _expire_streams(self):
+        """Close streams idle for longer than SEGMENTATION_STREAM_IDLE_SECONDS, deleting their spools"""
+        cutoff = time.monotonic() - settings.SEGMENTATION_STREAM_IDLE_SECONDS
+        for stream_id, stream in list(self.streams.items()):
+            if stream.last_active < cutoff and not stream.lock.locked():
+                del self.streams[stream_id]
+                stream.close()
+                logger.info(f"Closed idle segmentation stream {stream_id}")
+    
+    async def assign_customers(
+        self,
+        request: SegmentAssignmentRequest
+    ) -> SegmentAssignmentResponse:
+        """
+        Assign customers to the segments of a stored model without refitting
+        """
+        model = self.registry.get(request.model_version)
+        labels = model.assign(self._extract_features(request.customers))
+        assignments = {
+            customer.customer_id: f"seg_{label}"
+            for customer, label in zip(request.customers, labels.tolist())
+        }
+        return SegmentAssignmentResponse(model_version=model.version, assignments=assignments)
+    
+    async def update_incremental(
+        self,
+        request: IncrementalSegmentationRequest
+    ) -> IncrementalSegmentationResponse:
+        """
+        Warm-start from a stored model's centroids and fold in only the
+        customers whose features changed, reporting per-segment drift
+        """
+        base = self.registry.get(request.model_version)
+        logger.info(
+            f"Incremental update of {base.version} with {len(request.changed)} changed "
+            f"and {len(request.previous)} previous customers"
+        )
+        added = await asyncio.to_thread(self._extract_features, request.changed)
+        removed = await asyncio.to_thread(self._extract_features, request.previous)
+        
+        async with self.jobs.slot():
+            centroids, counts, labels = await self.jobs.run_in_pool(
+                incremental_update,
+                np.asarray(base.scaler_mean),
+                np.asarray(base.scaler_scale),
+                np.asarray(base.centroids),
+                np.asarray(base.counts),
+                added,
+                removed,
+                request.max_iter
+            )
+        
+        shifts = np.linalg.norm(centroids - base.centroids, axis=1)
+        drift = [
+            SegmentDrift(
+                segment_id=f"seg_{i}",
+                centroid_shift=float(shifts[i]),
+                size_before=int(base.counts[i]),
+                size_after=int(counts[i]),
+                drifted=bool(shifts[i] > request.drift_threshold)
+            )
+            for i in range(base.num_segments)
+        ]
+        refit_recommended = any(segment.drifted for segment in drift)
+        
+        model_version = None
+        if request.save_model:
+            model_version = self.registry.save(
+                base.scaler_mean,
+                base.scaler_scale,
+                centroids,
+                counts,
+                metadata={
+                    "algorithm": base.metadata.get("algorithm"),
+                    "base_version": base.version,
+                    "num_customers": int(counts.sum())
+                }
+            ).version
+        
+        assignments = {
+            customer.customer_id: f"seg_{label}"
+            for customer, label in zip(request.changed, labels.tolist())
+        }
+        logger.info(f"Incremental update complete, refit recommended: {refit_recommended}")
+        
+        return IncrementalSegmentationResponse(
+            base_model_version=base.version,
+            model_version=model_version,
+            assignments=assignments,
+            drift=drift,
+            refit_recommended=refit_recommended
+        )
+    
+    def list_models(self) -> List[Dict[str, Any]]:
+        """Describe every registered model version"""
+        self.registry.load_all()
+        return [
+            model.describe()
+            for model in sorted(self.registry.models.values(), key=lambda model: int(model.version[1:]))
+        ]
 
 
 # Global instance
@@ -8,6 +8,9 @@ from contextlib import asynccontextmanager
 import logging
 
 from app.routers import segmentation, retrieval, generation, safety, experiments
+from app.agents.generation import generation_agent
+from app.agents.retrieval import retrieval_agent
+from app.agents.segmentation import segmentation_agent
 from app.utils.config import settings
 
 # Configure logging
@@ -23,8 +26,20 @@ async def lifespan(app: FastAPI):
     """Manage application lifecycle"""
     logger.info("Starting Customer Personalization Orchestrator...")
     # Initialize resources (database connections, model loading, etc.)
+    segmentation_agent.registry.load_all()
+    try:
+        # Maps the files only; workers loading the same version share pages
+        retrieval_agent.load_snapshot()
+    except (OSError, ValueError) as e:
+        logger.error(f"Could not load retrieval snapshot, starting empty: {e}")
     yield
     # Cleanup resources
+    segmentation_agent.jobs.shutdown()
+    retrieval_agent.embeddings_cache.flush()
+    await retrieval_agent.embedding_client.close()
+    await retrieval_agent.result_cache.close()
+    await generation_agent.client.close()
+    await generation_agent.result_cache.close()
     logger.info("Shutting down Customer Personalization Orchestrator...")
 
 
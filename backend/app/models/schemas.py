@@ -1,6 +1,6 @@
 """Pydantic models for API requests and responses"""
-from pydantic import BaseModel, Field
-from typing import List, Dict, Optional, Any
+from pydantic import BaseModel, ConfigDict, Field
+from typing import List, Dict, Optional, Any, Union, Literal
 from datetime import datetime
 from enum import Enum
 
@@ -24,18 +24,123 @@ class Segment(BaseModel):
     created_at: datetime = Field(default_factory=datetime.utcnow)
 
 
-class SegmentationRequest(BaseModel):
+class SegmentationOptions(BaseModel):
+    """Clustering options shared by every segmentation input format"""
+    num_segments: Optional[Union[int, Literal["auto"]]] = 5
+    min_segments: int = Field(default=2, ge=2)  # auto mode sweep range
+    max_segments: Optional[int] = None  # settings.MAX_SEGMENTS when omitted
+    algorithm: Optional[str] = "kmeans"
+    save_model: bool = False
+    quality_sample_size: Optional[int] = Field(default=None, ge=2)  # settings default when omitted
+    quality_time_budget: Optional[float] = Field(default=None, gt=0)  # seconds
+    inline_assignments: bool = True  # False: fetch from /results/{segmentation_id}/assignments
+
+
+class SegmentationRequest(SegmentationOptions):
     """Request for customer segmentation"""
     customers: List[CustomerFeatures]
-    num_segments: Optional[int] = 5
-    algorithm: Optional[str] = "kmeans"
+
+
+class ColumnarSegmentationRequest(SegmentationOptions):
+    """Request for customer segmentation with parallel per-feature arrays"""
+    customer_ids: List[str]
+    columns: Dict[str, List[Any]]  # feature name -> one value per customer
 
 
 class SegmentationResponse(BaseModel):
     """Response from segmentation agent"""
+    model_config = ConfigDict(protected_namespaces=())
+
+    segmentation_id: Optional[str] = None
     segments: List[Segment]
     assignments: Dict[str, str]  # customer_id -> segment_id
     quality_score: float
+    quality_details: Optional[Dict[str, Any]] = None
+    k_selection: Optional[Dict[str, Any]] = None  # auto mode: chosen k and the score curve
+    model_version: Optional[str] = None
+
+
+class SegmentAssignmentPage(BaseModel):
+    """One page of stored segmentation assignments"""
+    segmentation_id: str
+    total: int
+    offset: int
+    limit: int
+    assignments: Dict[str, str]  # customer_id -> segment_id
+
+
+class SegmentationJobStatus(BaseModel):
+    """State of a background segmentation job"""
+    job_id: str
+    status: str  # running | completed | failed | cancelled
+    created_at: datetime
+    finished_at: Optional[datetime] = None
+    result: Optional[SegmentationResponse] = None
+    error: Optional[str] = None
+
+
+class SegmentationStreamRequest(BaseModel):
+    """Request to open a streaming segmentation session"""
+    num_segments: int = 5
+    algorithm: str = "minibatch_kmeans"
+    chunk_size: int = Field(default=10000, ge=1)
+    save_model: bool = False
+    inline_assignments: bool = True
+
+
+class SegmentationStreamStatus(BaseModel):
+    """State of a streaming segmentation session"""
+    stream_id: str
+    status: str
+    rows_received: int
+
+
+class SegmentAssignmentRequest(BaseModel):
+    """Request to assign customers to segments of a stored model"""
+    model_config = ConfigDict(protected_namespaces=())
+
+    customers: List[CustomerFeatures]
+    model_version: Optional[str] = None  # latest when omitted
+
+
+class SegmentAssignmentResponse(BaseModel):
+    """Segment assignments from a stored model"""
+    model_config = ConfigDict(protected_namespaces=())
+
+    model_version: str
+    assignments: Dict[str, str]  # customer_id -> segment_id
+
+
+class IncrementalSegmentationRequest(BaseModel):
+    """Request to update a stored model with changed customers only"""
+    model_config = ConfigDict(protected_namespaces=())
+
+    changed: List[CustomerFeatures]  # new or updated customers, current features
+    previous: List[CustomerFeatures] = Field(default_factory=list)  # prior snapshots of updated/removed customers
+    model_version: Optional[str] = None  # latest when omitted
+    drift_threshold: float = Field(default=0.1, ge=0)  # centroid shift in standardized units
+    max_iter: int = Field(default=3, ge=1)
+    save_model: bool = False
+
+
+class SegmentDrift(BaseModel):
+    """How far one segment moved in an incremental update"""
+    segment_id: str
+    centroid_shift: float
+    size_before: int
+    size_after: int
+    drifted: bool
+
+
+class IncrementalSegmentationResponse(BaseModel):
+    """Result of an incremental segmentation update"""
+    model_config = ConfigDict(protected_namespaces=())
+
+    base_model_version: str
+    model_version: Optional[str] = None
+    assignments: Dict[str, str]  # changed customers only
+    drift: List[SegmentDrift]
+    refit_recommended: bool
 
 
 class RetrievalRequest(BaseModel):
@@ -44,6 +149,7 @@ class RetrievalRequest(BaseModel):
     segment_id: Optional[str] = None
     top_k: int = 5
     filters: Optional[Dict[str, Any]] = None
+    mode: Literal["semantic", "lexical", "hybrid"] = "semantic"  # lexical skips the embedding call
 
 
 class RetrievalResponse(BaseModel):
@@ -53,6 +159,28 @@ class RetrievalResponse(BaseModel):
     metadata: Dict[str, Any]
 
 
+class RetrievalBatchRequest(BaseModel):
+    """Several retrieval queries scored in one pass over the index"""
+    requests: List[RetrievalRequest]
+
+
+class RetrievalBatchResponse(BaseModel):
+    """One response per query, in request order"""
+    responses: List[RetrievalResponse]
+
+
+class DocumentIngestionStatus(BaseModel):
+    """Progress of a streamed document upload"""
+    ingestion_id: str
+    status: str  # receiving | indexing | completed | failed
+    documents_received: int
+    documents_indexed: int
+    batches_published: int
+    created_at: datetime
+    finished_at: Optional[datetime] = None
+    error: Optional[str] = None
+
+
 class GenerationRequest(BaseModel):
     """Request for message generation"""
     segment_id: str
@@ -60,6 +188,7 @@ class GenerationRequest(BaseModel):
     template_id: Optional[str] = None
     variants: int = 3
     personalization_level: str = "high"
+    use_cache: bool = True  # False bypasses the generation cache (no lookup, no store)
 
 
 class MessageVariant(BaseModel):
@@ -78,6 +207,26 @@ class GenerationResponse(BaseModel):
     generation_metadata: Dict[str, Any]
 
 
+class GenerationBatchRequest(BaseModel):
+    """Generation requests for many segments"""
+    requests: List[GenerationRequest]
+
+
+class GenerationBatchResult(BaseModel):
+    """One finished request of a batch: its response or the error it failed with"""
+    index: int
+    segment_id: str
+    response: Optional[GenerationResponse] = None
+    error: Optional[str] = None
+
+
+class RenderRequest(BaseModel):
+    """Per-customer rendering of a variant from parallel per-field arrays"""
+    variant: MessageVariant
+    customer_ids: List[str]
+    columns: Dict[str, List[Any]]  # placeholder field -> one value per customer
+
+
 class SafetyCheckType(str, Enum):
     """Types of safety checks"""
     TOXICITY = "toxicity"
@@ -94,6 +243,13 @@ class SafetyRequest(BaseModel):
     threshold: float = 0.8
 
 
+class SafetySpan(BaseModel):
+    """Where in the content an issue was found: content[start:end]"""
+    type: str  # email | phone | card | ssn | policy_term
+    start: int
+    end: int
+
+
 class SafetyIssue(BaseModel):
     """Safety issue detected"""
     issue_type: str
@@ -101,6 +257,7 @@ class SafetyIssue(BaseModel):
     confidence: float
     description: str
     suggested_fix: Optional[str] = None
+    spans: List[SafetySpan] = Field(default_factory=list)
 
 
 class SafetyResponse(BaseModel):
@@ -1,9 +1,20 @@
 """Generation API endpoints"""
 from fastapi import APIRouter, HTTPException
+from fastapi.responses import StreamingResponse
+from typing import Any, AsyncIterator, Dict, Iterator
+import itertools
+import json
 import logging
 
-from app.models.schemas import GenerationRequest, GenerationResponse
+from app.models.schemas import (
+    GenerationRequest,
+    GenerationResponse,
+    GenerationBatchRequest,
+    GenerationBatchResult,
+    RenderRequest
+)
 from app.agents.generation import generation_agent
+from app.utils.config import settings
 
 logger = logging.getLogger(__name__)
 router = APIRouter()
@@ -19,3 +30,81 @@ async def generate_messages(request: GenerationRequest):
     except Exception as e:
         logger.error(f"Generation error: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
+
+
+@router.post("/stream")
+async def stream_messages(request: GenerationRequest):
+    """
+    Generate personalized message variants as server-sent events
+
+    Emits `token` events ({"variant_index", "text"}) while variants are
+    written, a `variant` event with each finished MessageVariant (plus its
+    `variant_index`), `error` for a variant that failed, and a final
+    `done` event with the generation metadata.
+    """
+    async def events() -> AsyncIterator[bytes]:
+        async for event, data in generation_agent.stream_messages(request):
+            yield f"event: {event}\ndata: {json.dumps(data, default=str)}\n\n".encode("utf-8")
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+
+@router.post("/batch")
+async def generate_messages_batch(request: GenerationBatchRequest):
+    """
+    Generate variants for many segments, streamed as NDJSON in completion order
+
+    Each line is a GenerationBatchResult; `index` points back into
+    `requests`. A failed segment yields a line with `error` set.
+    """
+    async def results() -> AsyncIterator[bytes]:
+        async for index, outcome in generation_agent.generate_many(request.requests):
+            result = GenerationBatchResult(index=index, segment_id=request.requests[index].segment_id)
+            if isinstance(outcome, Exception):
+                result.error = str(outcome)
+            else:
+                result.response = outcome
+            yield (result.model_dump_json() + "\n").encode("utf-8")
+
+    return StreamingResponse(results(), media_type="application/x-ndjson")
+
+
+@router.post("/render")
+def render_messages(request: RenderRequest):
+    """
+    Render a variant for every customer, streamed as NDJSON
+
+    Placeholders look like {{first_name:title|there}}: a field, an optional
+    type (str, title, upper, int, float, currency, percent, date) and an
+    optional default for missing values. Each line is
+    {"customer_id", "subject", "content"}.
+    """
+    try:
+        chunks = generation_agent.renderer(request.variant).iter_rendered(
+            request.customer_ids, request.columns, chunk_size=settings.GENERATION_RENDER_CHUNK_SIZE
+        )
+        # Render the first chunk now so bad templates and values fail with 422
+        first = list(itertools.islice(chunks, 1))
+    except ValueError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+
+    def lines() -> Iterator[bytes]:
+        for rows in itertools.chain(first, chunks):
+            yield "".join(
+                json.dumps({"customer_id": customer_id, "subject": subject, "content": content}) + "\n"
+                for customer_id, subject, content in rows
+            ).encode("utf-8")
+
+    return StreamingResponse(lines(), media_type="application/x-ndjson")
+
+
+@router.get("/cache/stats")
+async def cache_stats() -> Dict[str, Any]:
+    """
+    Generation cache occupancy and hit rate
+    """
+    return generation_agent.result_cache.stats()
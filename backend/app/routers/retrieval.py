@@ -1,9 +1,18 @@
 """Retrieval API endpoints"""
-from fastapi import APIRouter, HTTPException
+from fastapi import APIRouter, HTTPException, Request
+from typing import Any, Dict, List
 import logging
 
-from app.models.schemas import RetrievalRequest, RetrievalResponse
+from app.models.schemas import (
+    RetrievalRequest,
+    RetrievalResponse,
+    RetrievalBatchRequest,
+    RetrievalBatchResponse,
+    DocumentIngestionStatus
+)
 from app.agents.retrieval import retrieval_agent
+from app.utils.config import settings
+from app.utils.ndjson import iter_ndjson_batches
 
 logger = logging.getLogger(__name__)
 router = APIRouter()
@@ -16,6 +25,85 @@ async def retrieve_context(request: RetrievalRequest):
     """
     try:
         return await retrieval_agent.retrieve_context(request)
+    except ValueError as e:
+        raise HTTPException(status_code=422, detail=str(e))
     except Exception as e:
         logger.error(f"Retrieval error: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
+
+
+@router.post("/batch", response_model=RetrievalBatchResponse)
+async def retrieve_context_batch(request: RetrievalBatchRequest):
+    """
+    Retrieve context for several queries in one scoring pass
+    """
+    try:
+        return RetrievalBatchResponse(
+            responses=await retrieval_agent.retrieve_many(request.requests)
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+    except Exception as e:
+        logger.error(f"Retrieval error: {str(e)}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@router.post("/documents", response_model=DocumentIngestionStatus, status_code=202)
+async def ingest_documents(request: Request):
+    """
+    Stream documents as NDJSON (one {"content": ..., ...} object per line)
+
+    The upload is indexed in background batches; each batch becomes
+    searchable atomically. Poll /documents/ingestions/{ingestion_id}
+    for progress.
+    """
+    batches = iter_ndjson_batches(request.stream(), batch_size=settings.RETRIEVAL_INGEST_BATCH_SIZE)
+    try:
+        return await retrieval_agent.ingest_stream(batches)
+    except ValueError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+
+
+@router.get("/documents/ingestions/{ingestion_id}", response_model=DocumentIngestionStatus)
+async def get_ingestion(ingestion_id: str):
+    """
+    Get the progress of a document ingestion
+    """
+    try:
+        return retrieval_agent.get_ingestion(ingestion_id)
+    except LookupError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+
+
+@router.get("/cache/stats")
+async def cache_stats() -> Dict[str, Any]:
+    """
+    Embedding and query result cache occupancy and hit rates
+    """
+    return {
+        "embeddings": retrieval_agent.embeddings_cache.stats(),
+        "results": retrieval_agent.result_cache.stats()
+    }
+
+
+@router.post("/snapshots", status_code=201)
+async def save_snapshot() -> Dict[str, Any]:
+    """
+    Persist the published documents and indexes as a new snapshot version
+
+    Workers started afterwards memory-map the latest version instead of
+    re-ingesting.
+    """
+    try:
+        return await retrieval_agent.save_snapshot()
+    except OSError as e:
+        logger.error(f"Snapshot error: {str(e)}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@router.get("/snapshots")
+async def list_snapshots() -> List[str]:
+    """
+    List stored snapshot versions, oldest first
+    """
+    return retrieval_agent.snapshots.versions()
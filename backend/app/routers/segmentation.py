@@ -1,9 +1,27 @@
 """Segmentation API endpoints"""
-from fastapi import APIRouter, HTTPException
+from fastapi import APIRouter, HTTPException, UploadFile, File, Form, Request, Query
+from fastapi.responses import Response, StreamingResponse
+from typing import Optional
 import logging
+import numpy as np
 
-from app.models.schemas import SegmentationRequest, SegmentationResponse
+from app.models.schemas import (
+    SegmentationOptions,
+    SegmentationRequest,
+    ColumnarSegmentationRequest,
+    SegmentationResponse,
+    SegmentationStreamRequest,
+    SegmentationStreamStatus,
+    SegmentAssignmentRequest,
+    SegmentAssignmentResponse,
+    SegmentationJobStatus,
+    IncrementalSegmentationRequest,
+    IncrementalSegmentationResponse,
+    SegmentAssignmentPage
+)
 from app.agents.segmentation import segmentation_agent
+from app.utils.jobs import JobQueueFullError
+from app.utils.ndjson import iter_ndjson_batches
 
 logger = logging.getLogger(__name__)
 router = APIRouter()
@@ -16,11 +34,223 @@ async def segment_customers(request: SegmentationRequest):
     """
     try:
         return await segmentation_agent.segment_customers(request)
+    except JobQueueFullError as e:
+        raise HTTPException(status_code=429, detail=str(e), headers={"Retry-After": "5"})
     except Exception as e:
         logger.error(f"Segmentation error: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
 
 
+@router.post("/columnar", response_model=SegmentationResponse)
+async def segment_customers_columnar(request: ColumnarSegmentationRequest):
+    """
+    Segment customers supplied as parallel per-feature arrays
+    """
+    try:
+        return await segmentation_agent.segment_columnar(request)
+    except JobQueueFullError as e:
+        raise HTTPException(status_code=429, detail=str(e), headers={"Retry-After": "5"})
+    except ValueError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+    except Exception as e:
+        logger.error(f"Segmentation error: {str(e)}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@router.post("/upload", response_model=SegmentationResponse)
+async def segment_customers_upload(
+    features: UploadFile = File(..., description="NPY matrix of shape (n, 12) in feature spec order"),
+    customer_ids: Optional[UploadFile] = File(None, description="Newline-delimited customer ids"),
+    num_segments: str = Form("5", description="Segment count or 'auto'"),
+    algorithm: str = Form("kmeans"),
+    save_model: bool = Form(False),
+    inline_assignments: bool = Form(True)
+):
+    """
+    Segment customers from an uploaded NPY feature matrix
+    """
+    try:
+        matrix = np.load(features.file, allow_pickle=False)
+        if customer_ids is not None:
+            ids = (await customer_ids.read()).decode("utf-8").split()
+        else:
+            ids = [str(i) for i in range(len(matrix))]
+        options = SegmentationOptions(
+            num_segments=num_segments if num_segments == "auto" else int(num_segments),
+            algorithm=algorithm,
+            save_model=save_model,
+            inline_assignments=inline_assignments
+        )
+        return await segmentation_agent.segment_matrix(matrix, ids, options)
+    except JobQueueFullError as e:
+        raise HTTPException(status_code=429, detail=str(e), headers={"Retry-After": "5"})
+    except ValueError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+    except Exception as e:
+        logger.error(f"Segmentation error: {str(e)}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@router.get("/results/{segmentation_id}/assignments", response_model=SegmentAssignmentPage)
+async def get_assignments(
+    segmentation_id: str,
+    offset: int = Query(0, ge=0),
+    limit: int = Query(1000, ge=1, le=100000)
+):
+    """
+    Page through the assignments of a segmentation run
+    """
+    try:
+        stored = segmentation_agent.get_assignments(segmentation_id)
+    except LookupError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    return SegmentAssignmentPage(
+        segmentation_id=segmentation_id,
+        total=len(stored),
+        offset=offset,
+        limit=limit,
+        assignments=stored.page(offset, limit)
+    )
+
+
+@router.get("/results/{segmentation_id}/assignments.ndjson")
+async def stream_assignments(segmentation_id: str):
+    """
+    Stream all assignments of a segmentation run as NDJSON
+    """
+    try:
+        stored = segmentation_agent.get_assignments(segmentation_id)
+    except LookupError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    return StreamingResponse(stored.iter_ndjson(), media_type="application/x-ndjson")
+
+
+@router.get("/results/{segmentation_id}/assignments.npz")
+async def download_assignments(segmentation_id: str):
+    """
+    Download assignments as an NPZ archive with `labels` and `customer_ids` arrays
+    """
+    try:
+        stored = segmentation_agent.get_assignments(segmentation_id)
+    except LookupError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    return Response(
+        content=stored.to_npz(),
+        media_type="application/octet-stream",
+        headers={"Content-Disposition": f'attachment; filename="{segmentation_id}.npz"'}
+    )
+
+
+@router.post("/jobs", response_model=SegmentationJobStatus, status_code=202)
+async def submit_segmentation_job(request: SegmentationRequest):
+    """
+    Submit a segmentation to run in the background; poll it by job id
+    """
+    try:
+        return segmentation_agent.submit_job(request)
+    except JobQueueFullError as e:
+        raise HTTPException(status_code=429, detail=str(e), headers={"Retry-After": "5"})
+
+
+@router.post("/jobs/columnar", response_model=SegmentationJobStatus, status_code=202)
+async def submit_columnar_segmentation_job(request: ColumnarSegmentationRequest):
+    """
+    Submit a columnar segmentation to run in the background
+    """
+    try:
+        return segmentation_agent.submit_job(request)
+    except JobQueueFullError as e:
+        raise HTTPException(status_code=429, detail=str(e), headers={"Retry-After": "5"})
+
+
+@router.get("/jobs/{job_id}", response_model=SegmentationJobStatus)
+async def get_segmentation_job(job_id: str):
+    """
+    Poll a background segmentation job
+    """
+    try:
+        return segmentation_agent.get_job(job_id)
+    except LookupError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+
+
+@router.post("/streams", response_model=SegmentationStreamStatus)
+async def create_stream(request: SegmentationStreamRequest):
+    """
+    Open a streaming segmentation session
+    """
+    try:
+        return await segmentation_agent.create_stream(request)
+    except ValueError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+
+
+@router.post("/streams/{stream_id}/chunks", response_model=SegmentationStreamStatus)
+async def upload_stream_chunk(stream_id: str, request: Request):
+    """
+    Feed an NDJSON body of customers (one CustomerFeatures object per line)
+    into a streaming segmentation session
+    """
+    try:
+        status = None
+        async for records in iter_ndjson_batches(request.stream()):
+            status = await segmentation_agent.add_stream_records(stream_id, records)
+        return status or await segmentation_agent.add_stream_records(stream_id, [])
+    except LookupError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    except ValueError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+
+
+@router.post("/streams/{stream_id}/finalize", response_model=SegmentationResponse)
+async def finalize_stream(stream_id: str):
+    """
+    Label all streamed customers and return segments and assignments
+    """
+    try:
+        return await segmentation_agent.finalize_stream(stream_id)
+    except LookupError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    except ValueError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+
+
+@router.post("/assign", response_model=SegmentAssignmentResponse)
+async def assign_customers(request: SegmentAssignmentRequest):
+    """
+    Assign customers to segments of a stored model without refitting
+    """
+    try:
+        return await segmentation_agent.assign_customers(request)
+    except LookupError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+
+
+@router.post("/incremental", response_model=IncrementalSegmentationResponse)
+async def update_incremental(request: IncrementalSegmentationRequest):
+    """
+    Update a stored model with changed customers and report per-segment drift
+    """
+    try:
+        return await segmentation_agent.update_incremental(request)
+    except LookupError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    except JobQueueFullError as e:
+        raise HTTPException(status_code=429, detail=str(e), headers={"Retry-After": "5"})
+
+
+@router.get("/models")
+async def list_models():
+    """
+    List stored segmentation model versions
+    """
+    models = segmentation_agent.list_models()
+    return {
+        "models": models,
+        "total": len(models)
+    }
+
+
 @router.get("/segments")
 async def list_segments():
     """
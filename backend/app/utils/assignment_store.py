@@ -0,0 +1,75 @@
+"""Compact storage and paged/streamed export of segmentation assignments"""
+import io
+import json
+import logging
+from collections import OrderedDict
+from typing import Dict, Iterator, Sequence
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+class StoredAssignments:
+    """Assignments of one segmentation run as a label array plus an ID index"""
+
+    def __init__(self, customer_ids: np.ndarray, labels: np.ndarray):
+        self.customer_ids = customer_ids
+        self.labels = labels
+
+    def __len__(self) -> int:
+        return len(self.labels)
+
+    def page(self, offset: int, limit: int) -> Dict[str, str]:
+        """customer_id -> segment_id for one page of rows"""
+        ids = self.customer_ids[offset:offset + limit].tolist()
+        labels = self.labels[offset:offset + limit].tolist()
+        return {customer_id: f"seg_{label}" for customer_id, label in zip(ids, labels)}
+
+    def iter_ndjson(self, chunk_rows: int = 10000) -> Iterator[bytes]:
+        """Yield NDJSON lines ({"customer_id": ..., "segment_id": ...}) in chunks"""
+        for start in range(0, len(self), chunk_rows):
+            ids = self.customer_ids[start:start + chunk_rows].tolist()
+            labels = self.labels[start:start + chunk_rows].tolist()
+            yield "".join(
+                f'{{"customer_id": {json.dumps(customer_id)}, "segment_id": "seg_{label}"}}\n'
+                for customer_id, label in zip(ids, labels)
+            ).encode("utf-8")
+
+    def to_npz(self) -> bytes:
+        """Binary export: `labels` (int) and `customer_ids` (unicode) arrays"""
+        buffer = io.BytesIO()
+        np.savez(buffer, labels=self.labels, customer_ids=self.customer_ids)
+        return buffer.getvalue()
+
+
+class AssignmentStore:
+    """
+    Keeps the assignments of recent segmentation runs, bounded LRU
+
+    Labels are stored in the smallest integer dtype that fits and IDs as one
+    numpy string array, a fraction of the size of a dict of Python strings.
+    """
+
+    def __init__(self, max_results: int = 20):
+        self.max_results = max_results
+        self._results: "OrderedDict[str, StoredAssignments]" = OrderedDict()
+
+    def put(self, segmentation_id: str, customer_ids: Sequence[str], labels: np.ndarray, num_segments: int):
+        """Store one run's assignments, evicting the least recently used runs"""
+        dtype = np.int16 if num_segments <= np.iinfo(np.int16).max else np.int32
+        self._results[segmentation_id] = StoredAssignments(
+            np.asarray(customer_ids, dtype=str),
+            np.asarray(labels, dtype=dtype)
+        )
+        self._results.move_to_end(segmentation_id)
+        while len(self._results) > self.max_results:
+            evicted, _ = self._results.popitem(last=False)
+            logger.info(f"Evicted stored assignments for {evicted}")
+
+    def get(self, segmentation_id: str) -> StoredAssignments:
+        """Look up a run's assignments"""
+        if segmentation_id not in self._results:
+            raise LookupError(f"Segmentation result {segmentation_id} not found")
+        self._results.move_to_end(segmentation_id)
+        return self._results[segmentation_id]
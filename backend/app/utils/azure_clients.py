@@ -1,30 +1,208 @@
 """Azure integration utilities"""
+import asyncio
+import hashlib
 import logging
-from typing import Optional
+import re
+from dataclasses import dataclass
+from typing import AsyncIterator, List, Optional
+
+import httpx
+import numpy as np
+from openai import AsyncAzureOpenAI
+
+from app.utils.batching import MicroBatcher
+from app.utils.rate_limit import TokenBucket, estimate_tokens
 
 logger = logging.getLogger(__name__)
 
+EMBEDDING_DIM = 1536
+
+
+def mock_embedding(text: str, dim: int = EMBEDDING_DIM) -> np.ndarray:
+    """
+    Deterministic stand-in embedding: hashed bag of words, unit length
+
+    Texts sharing words get similar vectors, so retrieval behaves sensibly
+    without an Azure OpenAI deployment.
+    """
+    vector = np.zeros(dim, dtype=np.float32)
+    for token in re.findall(r"\w+", text.lower()):
+        digest = int.from_bytes(hashlib.blake2b(token.encode("utf-8"), digest_size=8).digest(), "little")
+        vector[digest % dim] += 1.0 if digest >> 63 else -1.0
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
+
+
+@dataclass
+class Completion:
+    """Generated text and the tokens it was billed for"""
+    text: str
+    prompt_tokens: int
+    completion_tokens: int
+
+    @property
+    def total_tokens(self) -> int:
+        return self.prompt_tokens + self.completion_tokens
+
 
 class AzureOpenAIClient:
-    """Client for Azure OpenAI Service"""
+    """
+    Client for Azure OpenAI Service
+
+    Without an endpoint every call returns local mock output. Single-text
+    `generate_embedding` calls are coalesced by a MicroBatcher into
+    `generate_embeddings` requests of up to `embedding_batch_size` inputs.
+    At most `completion_concurrency` completions are in flight, and with
+    `completion_tokens_per_minute` set they also share a token-rate budget.
+    """
     
-    def __init__(self, endpoint: str, api_key: str, deployment: str):
+    def __init__(
+        self,
+        endpoint: str,
+        api_key: str,
+        deployment: str,
+        embedding_deployment: str = "",
+        api_version: str = "2023-12-01-preview",
+        embedding_batch_size: int = 64,
+        embedding_batch_max_wait: float = 0.005,
+        http_client: Optional[httpx.AsyncClient] = None,
+        completion_concurrency: int = 8,
+        completion_tokens_per_minute: int = 0
+    ):
         self.endpoint = endpoint
         self.api_key = api_key
         self.deployment = deployment
+        self.embedding_deployment = embedding_deployment or deployment
+        self.api_version = api_version
+        self.embedding_batch_size = embedding_batch_size
+        self._http_client = http_client
+        self._client: Optional[AsyncAzureOpenAI] = None
+        self.embedding_batcher = MicroBatcher(
+            self.generate_embeddings,
+            max_batch_size=embedding_batch_size,
+            max_wait=embedding_batch_max_wait
+        )
+        self.completion_concurrency = completion_concurrency
+        self.completion_slots = asyncio.Semaphore(completion_concurrency)
+        self.token_budget = TokenBucket(completion_tokens_per_minute) if completion_tokens_per_minute else None
         logger.info("Azure OpenAI client initialized")
+
+    @property
+    def client(self) -> AsyncAzureOpenAI:
+        if self._client is None:
+            self._client = AsyncAzureOpenAI(
+                azure_endpoint=self.endpoint,
+                api_key=self.api_key,
+                api_version=self.api_version,
+                http_client=self._http_client
+            )
+        return self._client
+
+    async def close(self):
+        """Release pooled HTTP connections"""
+        if self._client is not None:
+            await self._client.close()
+            self._client = None
     
-    async def generate_completion(self, prompt: str, max_tokens: int = 500) -> str:
-        """Generate text completion using Azure OpenAI"""
-        # Stub implementation - integrate with Azure OpenAI SDK
+    async def generate_completion(self, prompt: str, max_tokens: int = 500) -> Completion:
+        """
+        Generate text completion using Azure OpenAI
+
+        Reserves the prompt estimate plus `max_tokens` from the token budget
+        before the call and settles the reservation with the reported usage.
+        """
         logger.info(f"Generating completion for prompt (length: {len(prompt)})")
-        return "This is a mock completion from Azure OpenAI"
+        reserved = 0.0
+        if self.token_budget is not None:
+            reserved = await self.token_budget.acquire(estimate_tokens(prompt) + max_tokens)
+        try:
+            async with self.completion_slots:
+                if not self.endpoint:
+                    # Stub implementation, throttled like real calls
+                    text = "This is a mock completion from Azure OpenAI"
+                    completion = Completion(text, estimate_tokens(prompt), estimate_tokens(text))
+                else:
+                    response = await self.client.chat.completions.create(
+                        model=self.deployment,
+                        messages=[{"role": "user", "content": prompt}],
+                        max_tokens=max_tokens
+                    )
+                    completion = Completion(
+                        response.choices[0].message.content or "",
+                        response.usage.prompt_tokens,
+                        response.usage.completion_tokens
+                    )
+        except Exception:
+            if self.token_budget is not None:
+                self.token_budget.settle(reserved, 0)
+            raise
+        if self.token_budget is not None:
+            self.token_budget.settle(reserved, completion.total_tokens)
+        return completion
+
+    async def stream_completion(self, prompt: str, max_tokens: int = 500) -> AsyncIterator[str]:
+        """
+        Generate a completion as a stream of text deltas
+
+        Throttled like `generate_completion`; the concurrency slot is held
+        until the stream ends. Streamed responses carry no usage, so the
+        reservation is settled with the prompt estimate plus one token per
+        delta.
+        """
+        logger.info(f"Streaming completion for prompt (length: {len(prompt)})")
+        reserved = 0.0
+        if self.token_budget is not None:
+            reserved = await self.token_budget.acquire(estimate_tokens(prompt) + max_tokens)
+        used = estimate_tokens(prompt)
+        try:
+            async with self.completion_slots:
+                if not self.endpoint:
+                    # Stub implementation, throttled like real calls
+                    for word in re.findall(r"\S+\s*", "This is a mock completion from Azure OpenAI"):
+                        used += 1
+                        yield word
+                    return
+                stream = await self.client.chat.completions.create(
+                    model=self.deployment,
+                    messages=[{"role": "user", "content": prompt}],
+                    max_tokens=max_tokens,
+                    stream=True
+                )
+                async for chunk in stream:
+                    if chunk.choices and chunk.choices[0].delta.content:
+                        used += 1
+                        yield chunk.choices[0].delta.content
+        finally:
+            if self.token_budget is not None:
+                self.token_budget.settle(reserved, used)
     
     async def generate_embedding(self, text: str) -> list:
-        """Generate text embedding"""
-        # Stub implementation
-        logger.info(f"Generating embedding for text (length: {len(text)})")
-        return [0.1] * 1536  # Mock embedding vector
+        """Generate text embedding, batched with concurrent callers"""
+        return await self.embedding_batcher.submit(text)
+
+    async def generate_embeddings(self, texts: List[str]) -> List[list]:
+        """Generate embeddings for many texts, `embedding_batch_size` per request"""
+        if not texts:
+            return []
+        if not self.endpoint:
+            # Stub implementation
+            logger.info(f"Generating {len(texts)} mock embeddings")
+            return [mock_embedding(text).tolist() for text in texts]
+
+        chunks = [
+            texts[start:start + self.embedding_batch_size]
+            for start in range(0, len(texts), self.embedding_batch_size)
+        ]
+        responses = await asyncio.gather(*(
+            self.client.embeddings.create(model=self.embedding_deployment, input=chunk)
+            for chunk in chunks
+        ))
+        logger.info(f"Generated {len(texts)} embeddings in {len(chunks)} requests")
+        return [
+            item.embedding
+            for response in responses
+            for item in sorted(response.data, key=lambda item: item.index)
+        ]
 
 
 class AzureStorageClient:
@@ -0,0 +1,450 @@
+"""Clustering fit functions and vectorized per-segment statistics"""
+import logging
+import time
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+from sklearn.cluster import Birch, KMeans, MiniBatchKMeans
+from sklearn.mixture import GaussianMixture
+from sklearn.preprocessing import StandardScaler
+
+from app.utils.jobs import SharedArrayRef, attach_shared_array
+
+logger = logging.getLogger(__name__)
+
+PROFILE_QUANTILES = (0.25, 0.5, 0.75)
+
+# Rows per predict/partial_fit call for the chunked algorithms
+CHUNK_ROWS = 100000
+# Rows the Gaussian mixture is fitted on before vectorized assignment
+GMM_FIT_SAMPLE_SIZE = 50000
+# BIRCH subcluster radius in standardized units; sklearn's 0.5 default turns
+# most rows into their own subcluster once there are more than a few features
+BIRCH_THRESHOLD = 1.0
+
+
+def _label_dtype(num_segments: int) -> np.dtype:
+    """Smallest integer dtype for labels; int16 lets argsort use radix sort"""
+    return np.dtype(np.int16) if num_segments <= np.iinfo(np.int16).max else np.dtype(np.int32)
+
+
+class SegmentStatsAccumulator:
+    """
+    Per-segment count, mean and variance over one or more chunks
+
+    Each update computes chunk statistics with bincount (two passes over the
+    chunk, O(n) per feature and independent of k) and merges them into the
+    running totals with Chan's parallel variance formula, so streamed and
+    in-memory datasets share the same numerically stable path.
+    """
+
+    def __init__(self, num_segments: int, num_features: int):
+        self.num_segments = num_segments
+        self.counts = np.zeros(num_segments, dtype=np.int64)
+        self.means = np.zeros((num_segments, num_features), dtype=np.float64)
+        self._m2 = np.zeros((num_segments, num_features), dtype=np.float64)
+
+    def update(self, features: np.ndarray, labels: np.ndarray):
+        """Fold one chunk of rows and their segment labels into the totals"""
+        k = self.num_segments
+        chunk_counts = np.bincount(labels, minlength=k)
+        safe_counts = np.maximum(chunk_counts, 1)[:, None]
+
+        chunk_means = np.empty_like(self.means)
+        chunk_m2 = np.empty_like(self._m2)
+        for j in range(features.shape[1]):
+            column = features[:, j]
+            chunk_means[:, j] = np.bincount(labels, weights=column, minlength=k)
+            chunk_means[:, j] /= safe_counts[:, 0]
+            deviations = column - chunk_means[labels, j]
+            chunk_m2[:, j] = np.bincount(labels, weights=deviations * deviations, minlength=k)
+
+        total = self.counts + chunk_counts
+        safe_total = np.maximum(total, 1)[:, None]
+        delta = chunk_means - self.means
+        self._m2 += chunk_m2 + delta * delta * (self.counts * chunk_counts)[:, None] / safe_total
+        self.means += delta * chunk_counts[:, None] / safe_total
+        self.counts = total
+
+    @property
+    def stds(self) -> np.ndarray:
+        """Population standard deviation per segment and feature"""
+        return np.sqrt(self._m2 / np.maximum(self.counts, 1)[:, None])
+
+
+def segment_quantiles(
+    features: np.ndarray,
+    labels: np.ndarray,
+    num_segments: int,
+    quantiles: Sequence[float] = PROFILE_QUANTILES
+) -> np.ndarray:
+    """
+    Per-segment feature quantiles, shape (num_segments, len(quantiles), d)
+
+    Rows are grouped with one stable argsort of the labels; each segment is
+    then a contiguous run of the permutation, so only one segment's rows are
+    gathered at a time. Empty segments get zeros.
+    """
+    labels = labels.astype(_label_dtype(num_segments), copy=False)
+    order = np.argsort(labels, kind="stable")
+    bounds = np.zeros(num_segments + 1, dtype=np.int64)
+    np.cumsum(np.bincount(labels, minlength=num_segments), out=bounds[1:])
+
+    result = np.zeros((num_segments, len(quantiles), features.shape[1]), dtype=np.float64)
+    for i in range(num_segments):
+        start, end = bounds[i], bounds[i + 1]
+        if end > start:
+            result[i] = np.quantile(features[order[start:end]], quantiles, axis=0)
+    return result
+
+
+def build_profiles(
+    feature_names: Sequence[str],
+    means: np.ndarray,
+    stds: np.ndarray,
+    quantile_values: Optional[np.ndarray] = None,
+    quantiles: Sequence[float] = PROFILE_QUANTILES
+) -> List[Dict[str, Dict[str, float]]]:
+    """Convert per-segment statistic arrays into {feature: {stat: value}} dicts"""
+    quantile_keys = [f"p{round(q * 100)}" for q in quantiles]
+    profiles = []
+    for i in range(means.shape[0]):
+        profile: Dict[str, Dict[str, Any]] = {}
+        for j, name in enumerate(feature_names):
+            stats = {"mean": float(means[i, j]), "std": float(stds[i, j])}
+            if quantile_values is not None:
+                stats.update(zip(quantile_keys, quantile_values[i, :, j].tolist()))
+            profile[name] = stats
+        profiles.append(profile)
+    return profiles
+
+
+def sampled_silhouette(
+    features: np.ndarray,
+    labels: np.ndarray,
+    num_segments: int,
+    sample_size: int = 5000,
+    time_budget: Optional[float] = None,
+    block_bytes: int = 64 * 1024 * 1024,
+    random_state: int = 42
+) -> Tuple[float, int]:
+    """
+    Mean silhouette coefficient over a uniform sample of rows
+
+    Distances are computed block by block as ||a||^2 + ||b||^2 - 2ab, each
+    block holding at most `block_bytes` of float64 distances, and reduced to
+    per-cluster sums with one matmul against the sample's one-hot labels.
+    Scoring stops early once `time_budget` seconds have elapsed (at least
+    one block is always scored). Returns (score, rows_scored).
+    """
+    n = features.shape[0]
+    if n == 0:
+        return 0.0, 0
+    rng = np.random.default_rng(random_state)
+    sample = np.sort(rng.choice(n, size=sample_size, replace=False)) if n > sample_size else np.arange(n)
+    points = np.asarray(features[sample], dtype=np.float64)
+    sample_labels = np.asarray(labels[sample])
+    s = len(sample)
+
+    counts = np.bincount(sample_labels, minlength=num_segments).astype(np.float64)
+    if np.count_nonzero(counts) < 2:
+        return 0.0, 0
+    one_hot = np.zeros((s, num_segments), dtype=np.float64)
+    one_hot[np.arange(s), sample_labels] = 1.0
+    squared_norms = np.einsum("ij,ij->i", points, points)
+
+    block_rows = max(1, block_bytes // (8 * s))
+    started = time.perf_counter()
+    scores = []
+    for start in range(0, s, block_rows):
+        block = slice(start, start + block_rows)
+        distances = squared_norms[block, None] + squared_norms[None, :] - 2.0 * points[block] @ points.T
+        np.maximum(distances, 0.0, out=distances)
+        np.sqrt(distances, out=distances)
+        cluster_sums = distances @ one_hot
+
+        own = sample_labels[block]
+        rows = np.arange(len(own))
+        own_counts = counts[own]
+        # Self-distance is zero, so the own-cluster sum only needs n_own - 1
+        intra = cluster_sums[rows, own] / np.maximum(own_counts - 1, 1)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            mean_other = cluster_sums / counts
+        mean_other[rows, own] = np.inf
+        mean_other[:, counts == 0] = np.inf
+        nearest = mean_other.min(axis=1)
+
+        denominator = np.maximum(intra, nearest)
+        block_scores = np.where(
+            (own_counts > 1) & (denominator > 0),
+            (nearest - intra) / np.where(denominator > 0, denominator, 1.0),
+            0.0
+        )
+        scores.append(block_scores)
+        if time_budget is not None and time.perf_counter() - started > time_budget:
+            break
+
+    scored = np.concatenate(scores)
+    return float(scored.mean()), len(scored)
+
+
+def _fit_kmeans(features: np.ndarray, num_segments: int, random_state: int) -> Tuple[np.ndarray, np.ndarray]:
+    """Full-batch Lloyd k-means; exact but O(n * k * iterations) per init"""
+    model = KMeans(n_clusters=num_segments, random_state=random_state, n_init=10)
+    labels = model.fit_predict(features)
+    return labels, model.cluster_centers_
+
+
+def _fit_minibatch_kmeans(features: np.ndarray, num_segments: int, random_state: int) -> Tuple[np.ndarray, np.ndarray]:
+    """Mini-batch k-means; each step touches one batch, not the full dataset"""
+    model = MiniBatchKMeans(
+        n_clusters=num_segments,
+        random_state=random_state,
+        n_init=3,
+        batch_size=4096
+    )
+    labels = model.fit_predict(features)
+    return labels, model.cluster_centers_
+
+
+def _nearest_centroid(features: np.ndarray, centroids: np.ndarray) -> np.ndarray:
+    """Label each row with its closest centroid, CHUNK_ROWS rows at a time"""
+    centroid_norms = np.einsum("kd,kd->k", centroids, centroids)
+    labels = np.empty(len(features), dtype=np.int64)
+    for start in range(0, len(features), CHUNK_ROWS):
+        chunk = features[start:start + CHUNK_ROWS]
+        labels[start:start + CHUNK_ROWS] = np.argmin(centroid_norms - 2.0 * chunk @ centroids.T, axis=1)
+    return labels
+
+
+def _fit_birch(features: np.ndarray, num_segments: int, random_state: int) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    BIRCH: one streaming pass builds a CF-tree of subclusters, which are then
+    merged into `num_segments` groups. Centroids are the mean of each group's
+    subcluster centers and rows are labelled by nearest centroid, so the cost
+    of assignment does not grow with the number of subclusters.
+    """
+    model = Birch(n_clusters=num_segments, threshold=BIRCH_THRESHOLD)
+    for start in range(0, len(features), CHUNK_ROWS):
+        model.partial_fit(features[start:start + CHUNK_ROWS])
+    model.partial_fit()  # global clustering of the subclusters
+    centroids = np.zeros((num_segments, features.shape[1]))
+    subcluster_counts = np.bincount(model.subcluster_labels_, minlength=num_segments)
+    for j in range(features.shape[1]):
+        centroids[:, j] = np.bincount(
+            model.subcluster_labels_, weights=model.subcluster_centers_[:, j], minlength=num_segments
+        )
+    centroids /= np.maximum(subcluster_counts, 1)[:, None]
+    return _nearest_centroid(features, centroids), centroids
+
+
+def _fit_gmm(features: np.ndarray, num_segments: int, random_state: int) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Diagonal Gaussian mixture fitted on a uniform sample, then every row is
+    assigned in chunks with the vectorized predict. Centroids are the
+    component means (used for nearest-centroid assignment of stored models).
+    """
+    rng = np.random.default_rng(random_state)
+    if len(features) > GMM_FIT_SAMPLE_SIZE:
+        sample = features[np.sort(rng.choice(len(features), size=GMM_FIT_SAMPLE_SIZE, replace=False))]
+    else:
+        sample = features
+    model = GaussianMixture(
+        n_components=num_segments,
+        covariance_type="diag",
+        random_state=random_state
+    )
+    model.fit(sample)
+    labels = np.concatenate([
+        model.predict(features[start:start + CHUNK_ROWS])
+        for start in range(0, len(features), CHUNK_ROWS)
+    ])
+    return labels, model.means_
+
+
+# Algorithm name -> fit(scaled_features, num_segments, random_state) -> (labels, centroids)
+CLUSTERING_ALGORITHMS: Dict[str, Callable[[np.ndarray, int, int], Tuple[np.ndarray, np.ndarray]]] = {
+    "kmeans": _fit_kmeans,
+    "minibatch_kmeans": _fit_minibatch_kmeans,
+    "birch": _fit_birch,
+    "gmm": _fit_gmm,
+}
+
+
+def run_algorithm(
+    algorithm: str,
+    features: np.ndarray,
+    num_segments: int,
+    random_state: int = 42
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Cluster scaled features with a registered algorithm"""
+    if algorithm not in CLUSTERING_ALGORITHMS:
+        raise ValueError(
+            f"Unsupported algorithm: {algorithm} (available: {', '.join(CLUSTERING_ALGORITHMS)})"
+        )
+    return CLUSTERING_ALGORITHMS[algorithm](features, num_segments, random_state)
+
+
+def inertia(features: np.ndarray, labels: np.ndarray, centroids: np.ndarray) -> float:
+    """Sum of squared distances from each row to its assigned centroid"""
+    total = 0.0
+    for start in range(0, len(features), CHUNK_ROWS):
+        residual = features[start:start + CHUNK_ROWS] - centroids[labels[start:start + CHUNK_ROWS]]
+        total += float(np.einsum("ij,ij->", residual, residual))
+    return total
+
+
+def score_candidate_k(
+    sample_ref: SharedArrayRef,
+    num_segments: int,
+    algorithm: str = "kmeans",
+    quality_sample_size: int = 5000,
+    random_state: int = 42
+) -> Dict[str, float]:
+    """
+    Fit one candidate k on a shared, already scaled sample
+
+    Runs in a pool worker; the sample is read in place from shared memory.
+    Returns the candidate's silhouette and inertia.
+    """
+    shm, sample = attach_shared_array(sample_ref)
+    try:
+        labels, centroids = run_algorithm(algorithm, sample, num_segments, random_state)
+        score, _ = sampled_silhouette(
+            sample, labels, num_segments,
+            sample_size=quality_sample_size,
+            random_state=random_state
+        )
+        return {
+            "k": num_segments,
+            "score": score,
+            "inertia": inertia(sample, labels, centroids)
+        }
+    finally:
+        del sample
+        shm.close()
+
+
+@dataclass
+class ClusteringResult:
+    """Everything a fit produces; plain arrays so it pickles cheaply across processes"""
+    labels: np.ndarray
+    counts: np.ndarray
+    means: np.ndarray
+    stds: np.ndarray
+    quantiles: np.ndarray
+    scaler_mean: np.ndarray
+    scaler_scale: np.ndarray
+    centroids: np.ndarray
+    quality_score: float = 0.0
+    quality_rows: int = 0
+
+
+def fit_segmentation(
+    features: np.ndarray,
+    num_segments: int,
+    algorithm: str = "kmeans",
+    random_state: int = 42,
+    quality_sample_size: int = 5000,
+    quality_time_budget: Optional[float] = None
+) -> ClusteringResult:
+    """
+    Scale, cluster and profile a feature matrix
+
+    Pure function with its own scaler and model, so it is safe to run for
+    several requests at once in worker processes.
+    """
+    scaler = StandardScaler()
+    features_normalized = scaler.fit_transform(features)
+
+    labels, centroids = run_algorithm(algorithm, features_normalized, num_segments, random_state)
+
+    stats = SegmentStatsAccumulator(num_segments, features.shape[1])
+    stats.update(features, labels)
+    quality_score, quality_rows = sampled_silhouette(
+        features_normalized,
+        labels,
+        num_segments,
+        sample_size=quality_sample_size,
+        time_budget=quality_time_budget,
+        random_state=random_state
+    )
+    return ClusteringResult(
+        labels=labels,
+        counts=stats.counts,
+        means=stats.means,
+        stds=stats.stds,
+        quantiles=segment_quantiles(features, labels, num_segments),
+        scaler_mean=scaler.mean_,
+        scaler_scale=scaler.scale_,
+        centroids=centroids,
+        quality_score=quality_score,
+        quality_rows=quality_rows
+    )
+
+
+def incremental_update(
+    scaler_mean: np.ndarray,
+    scaler_scale: np.ndarray,
+    centroids: np.ndarray,
+    counts: np.ndarray,
+    added: np.ndarray,
+    removed: np.ndarray,
+    max_iter: int = 3
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Warm-started update of a fitted model with a delta of customers
+
+    Centroids are treated as running means over `counts` members in the
+    model's (fixed) scaled space. `removed` rows (prior snapshots of changed
+    or deleted customers) are subtracted from the segment they were closest
+    to, then `added` rows are assigned and folded in. Assignment of the added
+    rows and the centroid update alternate for up to `max_iter` rounds, a
+    Lloyd iteration restricted to the delta. Only the delta is ever scored.
+
+    Returns updated centroids, updated counts and labels for `added`.
+    """
+    k = centroids.shape[0]
+    centroids = np.asarray(centroids, dtype=np.float64)
+    base_counts = np.asarray(counts, dtype=np.float64)
+    base_sums = centroids * base_counts[:, None]
+
+    def nearest(scaled: np.ndarray, current: np.ndarray) -> np.ndarray:
+        distances = (
+            np.einsum("kd,kd->k", current, current)[None, :]
+            - 2.0 * scaled @ current.T
+        )
+        return np.argmin(distances, axis=1)
+
+    def label_sums(scaled: np.ndarray, labels: np.ndarray) -> np.ndarray:
+        sums = np.zeros_like(centroids)
+        for j in range(scaled.shape[1]):
+            sums[:, j] = np.bincount(labels, weights=scaled[:, j], minlength=k)
+        return sums
+
+    if len(removed):
+        removed_scaled = (removed - scaler_mean) / scaler_scale
+        removed_labels = nearest(removed_scaled, centroids)
+        base_sums -= label_sums(removed_scaled, removed_labels)
+        base_counts = np.maximum(base_counts - np.bincount(removed_labels, minlength=k), 0)
+
+    added_scaled = (added - scaler_mean) / scaler_scale
+    current = centroids
+    labels = np.zeros(len(added), dtype=np.int64)
+    total_counts = base_counts
+    for _ in range(max(1, max_iter)):
+        new_labels = nearest(added_scaled, current)
+        total_counts = base_counts + np.bincount(new_labels, minlength=k)
+        sums = base_sums + label_sums(added_scaled, new_labels)
+        updated = np.where(
+            total_counts[:, None] > 0,
+            sums / np.maximum(total_counts, 1)[:, None],
+            centroids
+        )
+        converged = np.array_equal(new_labels, labels) and np.allclose(updated, current)
+        labels, current = new_labels, updated
+        if converged:
+            break
+
+    return current, total_counts.astype(np.int64), labels
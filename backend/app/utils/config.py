@@ -22,6 +22,7 @@ class Settings(BaseSettings):
     AZURE_OPENAI_ENDPOINT: str = ""
     AZURE_OPENAI_API_KEY: str = ""
     AZURE_OPENAI_DEPLOYMENT: str = ""
+    AZURE_OPENAI_EMBEDDING_DEPLOYMENT: str = ""  # AZURE_OPENAI_DEPLOYMENT when empty
     AZURE_OPENAI_API_VERSION: str = "2023-12-01-preview"
     
     # Azure Storage
@@ -41,12 +42,52 @@ class Settings(BaseSettings):
     # Database
     DATABASE_URL: str = "sqlite:///./cpo.db"
     
+    # Artifact storage
+    MODEL_STORAGE_PATH: str = "../data/models"
+    EMBEDDING_CACHE_PATH: str = "../data/processed/embedding_cache"
+    RETRIEVAL_SNAPSHOT_PATH: str = "../data/processed/retrieval_index"
+    
     # Agent Configuration
     SEGMENTATION_MODEL: str = "kmeans"
     MAX_SEGMENTS: int = 10
+    SEGMENTATION_WORKERS: int = 2
+    SEGMENTATION_MAX_PENDING_JOBS: int = 4
+    SEGMENTATION_JOB_RETENTION: int = 100
+    SEGMENTATION_MAX_STORED_RESULTS: int = 20
+    SEGMENTATION_AUTO_K_SAMPLE_SIZE: int = 20000
+    SEGMENTATION_QUALITY_SAMPLE_SIZE: int = 5000
+    SEGMENTATION_QUALITY_TIME_BUDGET: float = 2.0
+    SEGMENTATION_STREAM_IDLE_SECONDS: float = 3600.0  # unfinalized streams are closed after this long
     RETRIEVAL_TOP_K: int = 5
+    RETRIEVAL_FILTER_FIELDS: List[str] = ["segment", "source", "category"]
+    RETRIEVAL_INDEX: str = "exact"  # exact | ivf
+    RETRIEVAL_IVF_NLIST: int = 1024
+    RETRIEVAL_IVF_NPROBE: int = 16
+    RETRIEVAL_VECTOR_STORAGE: str = "float32"  # float32 | float16 | int8 (exact index only)
+    RETRIEVAL_RERANK_FACTOR: int = 4  # quantized storage: float32 re-rank of top_k * factor
+    RETRIEVAL_HYBRID_CANDIDATES: int = 50  # per ranking, before fusion
+    RETRIEVAL_RRF_K: int = 60
+    RETRIEVAL_CACHE_BACKEND: str = "memory"  # memory | redis | none
+    RETRIEVAL_CACHE_TTL_SECONDS: float = 300.0
+    RETRIEVAL_CACHE_MAX_ENTRIES: int = 10000
+    RETRIEVAL_INGEST_BATCH_SIZE: int = 1000
+    RETRIEVAL_INGEST_MAX_PENDING_BATCHES: int = 4
+    RETRIEVAL_INGESTION_RETENTION: int = 100
+    RETRIEVAL_SNAPSHOT_RETENTION: int = 3  # snapshot versions kept on disk
+    EMBEDDING_CACHE_MEMORY_ENTRIES: int = 10000
+    EMBEDDING_BATCH_SIZE: int = 64
+    EMBEDDING_BATCH_MAX_WAIT_MS: float = 5.0
     GENERATION_MAX_TOKENS: int = 500
+    GENERATION_MAX_CONCURRENCY: int = 8  # LLM completions in flight
+    GENERATION_TOKENS_PER_MINUTE: int = 40000  # 0 disables the token-rate budget
+    GENERATION_CACHE_BACKEND: str = "memory"  # memory | redis | none
+    GENERATION_CACHE_TTL_SECONDS: float = 3600.0
+    GENERATION_CACHE_MAX_ENTRIES: int = 10000
+    GENERATION_RENDER_CHUNK_SIZE: int = 10000  # customers rendered per streamed chunk
     SAFETY_THRESHOLD: float = 0.8
+    SAFETY_POLICY_TERMS: List[str] = [  # matched case-insensitively as whole words
+        "guaranteed income", "risk-free", "get rich quick", "miracle cure", "no credit check"
+    ]
     
     class Config:
         env_file = ".env"
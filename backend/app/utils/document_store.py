@@ -0,0 +1,68 @@
+"""Retrieval document storage: a memory-mapped snapshot base plus live appends"""
+import json
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional
+
+import numpy as np
+
+
+class DocumentStore:
+    """
+    Sequence of document dicts, position i <-> index row i
+
+    Documents loaded from a snapshot stay as JSON lines in a memory-mapped
+    file and are decoded only when a result returns them; documents added
+    since are kept in a plain list. Only those can be removed again.
+    """
+
+    def __init__(self, data: Optional[np.ndarray] = None, offsets: Optional[np.ndarray] = None):
+        self._data = data  # JSON lines bytes
+        self._offsets = offsets  # byte offset of each line, plus the end
+        self._base_size = 0 if offsets is None else len(offsets) - 1
+        self._live: List[Dict[str, Any]] = []
+
+    @classmethod
+    def load(cls, directory: Path) -> "DocumentStore":
+        path = directory / "documents.jsonl"
+        if path.stat().st_size:
+            data = np.memmap(path, dtype=np.uint8, mode="r")
+        else:
+            data = np.empty(0, dtype=np.uint8)  # empty files cannot be mapped
+        return cls(data, np.load(directory / "document_offsets.npy", mmap_mode="r"))
+
+    def save(self, directory: Path, size: int):
+        """Write the first `size` documents as JSON lines plus their offsets"""
+        offsets = np.zeros(size + 1, dtype=np.int64)
+        with open(directory / "documents.jsonl", "wb") as f:
+            for position in range(size):
+                if position < self._base_size:
+                    line = bytes(self._data[self._offsets[position]:self._offsets[position + 1]])
+                else:
+                    document = self._live[position - self._base_size]
+                    line = (json.dumps(document, default=str) + "\n").encode("utf-8")
+                f.write(line)
+                offsets[position + 1] = offsets[position] + len(line)
+        np.save(directory / "document_offsets.npy", offsets)
+
+    def __len__(self) -> int:
+        return self._base_size + len(self._live)
+
+    def __getitem__(self, position: int) -> Dict[str, Any]:
+        if position < 0:
+            position += len(self)
+        if position < self._base_size:
+            return json.loads(bytes(self._data[self._offsets[position]:self._offsets[position + 1]]))
+        return self._live[position - self._base_size]
+
+    def __iter__(self) -> Iterator[Dict[str, Any]]:
+        for position in range(len(self)):
+            yield self[position]
+
+    def extend(self, documents: List[Dict[str, Any]]):
+        self._live.extend(documents)
+
+    def truncate(self, size: int):
+        """Drop the documents at positions >= size"""
+        if size < self._base_size:
+            raise ValueError("Cannot remove documents loaded from a snapshot")
+        del self._live[size - self._base_size:]
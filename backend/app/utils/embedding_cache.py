@@ -0,0 +1,210 @@
+"""Content-addressed embedding cache: in-memory LRU over a memory-mapped disk tier"""
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import re
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+DIGEST_SIZE = 32  # sha256
+CACHE_DTYPE = np.float32
+
+
+def content_digest(text: str) -> bytes:
+    """sha256 of the UTF-8 text; the cache key within one model"""
+    return hashlib.sha256(text.encode("utf-8")).digest()
+
+
+class DiskEmbeddingTier:
+    """
+    Append-only on-disk store of one model's embeddings
+
+    `vectors.f32` holds fixed-width float32 rows and `keys.bin` the matching
+    32-byte digests, both appended in the same order. Reads go through a
+    read-only memmap, so cached vectors cost page cache, not heap.
+
+    Several processes may share a directory: appends are serialized with
+    an exclusive flock and take their row numbers from the files, and a
+    lookup that misses re-reads the key log for rows other processes added.
+    """
+
+    def __init__(self, directory: Path):
+        self.directory = directory
+        self.rows: Dict[bytes, int] = {}
+        self.num_rows = 0  # rows read from the files so far
+        self.dim: Optional[int] = None
+        self._mapped: Optional[np.memmap] = None
+        self._sync()
+        if self.num_rows:
+            logger.info(f"Loaded {self.num_rows} cached embeddings from {self.directory}")
+
+    @property
+    def _vectors_path(self) -> Path:
+        return self.directory / "vectors.f32"
+
+    @property
+    def _keys_path(self) -> Path:
+        return self.directory / "keys.bin"
+
+    def __len__(self) -> int:
+        return len(self.rows)
+
+    def _sync(self):
+        """Read rows appended to the files since the last sync, by any process"""
+        if self.dim is None:
+            meta_path = self.directory / "meta.json"
+            if not meta_path.is_file():
+                return
+            self.dim = json.loads(meta_path.read_text())["dim"]
+        if not self._keys_path.is_file() or not self._vectors_path.is_file():
+            return
+        with open(self._keys_path, "rb") as f:
+            f.seek(self.num_rows * DIGEST_SIZE)
+            keys = f.read()
+        vector_rows = self._vectors_path.stat().st_size // (4 * self.dim)
+        # Vectors are written before keys, and a crash or a concurrent append
+        # can leave the files different lengths; only rows present in both count.
+        num_rows = min(self.num_rows + len(keys) // DIGEST_SIZE, vector_rows)
+        for i in range(num_rows - self.num_rows):
+            self.rows.setdefault(keys[i * DIGEST_SIZE:(i + 1) * DIGEST_SIZE], self.num_rows + i)
+        self.num_rows = max(self.num_rows, num_rows)
+
+    def _remap(self):
+        self._mapped = np.memmap(self._vectors_path, dtype=CACHE_DTYPE, mode="r", shape=(self.num_rows, self.dim))
+
+    def get(self, digest: bytes) -> Optional[np.ndarray]:
+        row = self.rows.get(digest)
+        if row is None:
+            self._sync()  # another process may have added it
+            row = self.rows.get(digest)
+            if row is None:
+                return None
+        if self._mapped is None or row >= len(self._mapped):
+            self._remap()
+        return np.array(self._mapped[row])
+
+    def append(self, digests: Sequence[bytes], vectors: np.ndarray):
+        """Persist new rows; digests another process already wrote are skipped"""
+        if not digests:
+            return
+        vectors = np.asarray(vectors, dtype=CACHE_DTYPE)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        with open(self.directory / "append.lock", "wb") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)  # released when the lock file closes
+            self._sync()
+            if self.dim is None:
+                self.dim = vectors.shape[1]
+                staging = self.directory / f".meta.{os.getpid()}.tmp"
+                staging.write_text(json.dumps({"dim": self.dim}))
+                os.replace(staging, self.directory / "meta.json")
+            if vectors.shape[1] != self.dim:
+                raise ValueError(f"Expected {self.dim}-dim embeddings, got {vectors.shape[1]}")
+            fresh = [i for i, digest in enumerate(digests) if digest not in self.rows]
+            if not fresh:
+                return
+            # Row numbers come from the files: drop any partial row a crashed
+            # writer left behind so both files end at the same row
+            for path, row_bytes in ((self._vectors_path, 4 * self.dim), (self._keys_path, DIGEST_SIZE)):
+                with open(path, "ab") as f:
+                    f.truncate(self.num_rows * row_bytes)
+            with open(self._vectors_path, "ab") as f:
+                f.write(vectors[fresh].tobytes())
+            with open(self._keys_path, "ab") as f:
+                f.write(b"".join(digests[i] for i in fresh))
+            for offset, i in enumerate(fresh):
+                self.rows[digests[i]] = self.num_rows + offset
+            self.num_rows += len(fresh)
+
+
+class EmbeddingCache:
+    """
+    Two-tier embedding cache keyed by (model, sha256(text))
+
+    A bounded LRU of arrays sits in front of one DiskEmbeddingTier per model
+    under `root`. Entries evicted from memory spill to disk (call `flush`
+    on shutdown to persist the rest), and disk hits are promoted back into
+    memory. Hit counters let the memory tier be sized from real traffic.
+    """
+
+    def __init__(self, root: str, max_memory_entries: int = 10000):
+        self.root = Path(root)
+        self.max_memory_entries = max_memory_entries
+        self._memory: "OrderedDict[Tuple[str, bytes], np.ndarray]" = OrderedDict()
+        self._disk: Dict[str, DiskEmbeddingTier] = {}
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    def _disk_tier(self, model: str) -> DiskEmbeddingTier:
+        if model not in self._disk:
+            self._disk[model] = DiskEmbeddingTier(self.root / re.sub(r"[^\w.-]", "_", model))
+        return self._disk[model]
+
+    def get_many(self, model: str, texts: Sequence[str]) -> List[Optional[np.ndarray]]:
+        """Cached vector per text, or None for misses"""
+        found: List[Optional[np.ndarray]] = []
+        promoted = []
+        for text in texts:
+            key = (model, content_digest(text))
+            vector = self._memory.get(key)
+            if vector is not None:
+                self._memory.move_to_end(key)
+                self.memory_hits += 1
+            else:
+                vector = self._disk_tier(model).get(key[1])
+                if vector is not None:
+                    self.disk_hits += 1
+                    promoted.append((key, vector))
+                else:
+                    self.misses += 1
+            found.append(vector)
+        self._insert(promoted)
+        return found
+
+    def put_many(self, model: str, texts: Sequence[str], vectors: Sequence[np.ndarray]):
+        """Cache freshly computed vectors in the memory tier"""
+        self._insert([
+            ((model, content_digest(text)), np.asarray(vector, dtype=CACHE_DTYPE))
+            for text, vector in zip(texts, vectors)
+        ])
+
+    def _insert(self, entries: List[Tuple[Tuple[str, bytes], np.ndarray]]):
+        for key, vector in entries:
+            self._memory[key] = vector
+            self._memory.move_to_end(key)
+        evicted = []
+        while len(self._memory) > self.max_memory_entries:
+            evicted.append(self._memory.popitem(last=False))
+        self._spill(evicted)
+
+    def _spill(self, entries: List[Tuple[Tuple[str, bytes], np.ndarray]]):
+        """Write entries not yet on disk, one append per model"""
+        by_model: Dict[str, Dict[bytes, np.ndarray]] = {}
+        for (model, digest), vector in entries:
+            if digest not in self._disk_tier(model).rows:
+                by_model.setdefault(model, {})[digest] = vector
+        for model, pending in by_model.items():
+            self._disk_tier(model).append(list(pending), np.stack(list(pending.values())))
+
+    def flush(self):
+        """Persist every memory-tier entry to disk"""
+        self._spill(list(self._memory.items()))
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.memory_hits + self.disk_hits + self.misses
+        return {
+            "memory_entries": len(self._memory),
+            "max_memory_entries": self.max_memory_entries,
+            "disk_entries": {model: len(tier) for model, tier in self._disk.items()},
+            "memory_hits": self.memory_hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_rate": (self.memory_hits + self.disk_hits) / lookups if lookups else 0.0
+        }
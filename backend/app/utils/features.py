@@ -0,0 +1,124 @@
+"""Declarative customer feature spec and vectorized feature extraction"""
+import logging
+from dataclasses import dataclass
+from typing import Any, Dict, Iterable, List, Mapping, Optional, Sequence, Tuple
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True)
+class FeatureField:
+    """
+    A single numeric column of the segmentation feature matrix
+
+    `group` names the CustomerFeatures attribute (demographics, behavior, ...)
+    and `key` the entry inside it. When `match` is set the column is a 0/1
+    indicator of `value == match` instead of the raw value.
+    """
+    name: str
+    group: str
+    key: str
+    default: float = 0.0
+    match: Optional[str] = None
+
+
+# Column order of the feature matrix. Indices are stable and relied on by
+# segment characteristics, so append new fields rather than reordering.
+FEATURE_SPEC: Tuple[FeatureField, ...] = (
+    # Demographic features
+    FeatureField("age", "demographics", "age"),
+    FeatureField("income", "demographics", "income"),
+    FeatureField("gender_male", "demographics", "gender", match="M"),
+    # Behavioral features
+    FeatureField("page_views", "behavior", "page_views"),
+    FeatureField("session_duration", "behavior", "session_duration"),
+    FeatureField("bounce_rate", "behavior", "bounce_rate"),
+    # Purchase history
+    FeatureField("total_purchases", "purchase_history", "total_purchases"),
+    FeatureField("avg_order_value", "purchase_history", "avg_order_value"),
+    FeatureField("lifetime_value", "purchase_history", "lifetime_value"),
+    # Engagement metrics
+    FeatureField("email_open_rate", "engagement", "email_open_rate"),
+    FeatureField("click_through_rate", "engagement", "click_through_rate"),
+    FeatureField("last_interaction_days", "engagement", "last_interaction_days"),
+)
+
+FEATURE_NAMES: List[str] = [field.name for field in FEATURE_SPEC]
+FEATURE_INDEX: Dict[str, int] = {name: i for i, name in enumerate(FEATURE_NAMES)}
+FEATURE_DTYPE = np.float32
+
+
+def _field_values(groups: Iterable[Mapping[str, Any]], field: FeatureField) -> Iterable[float]:
+    """Yield one encoded value per customer for a single field"""
+    if field.match is not None:
+        return (1.0 if group.get(field.key) == field.match else 0.0 for group in groups)
+    return (group.get(field.key, field.default) for group in groups)
+
+
+def extract_from_customers(customers: Sequence[Any], spec: Sequence[FeatureField] = FEATURE_SPEC) -> np.ndarray:
+    """
+    Fill a preallocated float32 matrix from CustomerFeatures objects
+
+    Each column is filled with a single np.fromiter pass, so the per-customer
+    work is one attribute lookup and one dict.get per field.
+    """
+    n = len(customers)
+    matrix = np.empty((n, len(spec)), dtype=FEATURE_DTYPE)
+    for j, field in enumerate(spec):
+        groups = (getattr(customer, field.group) for customer in customers)
+        matrix[:, j] = np.fromiter(_field_values(groups, field), dtype=FEATURE_DTYPE, count=n)
+    return matrix
+
+
+def extract_from_records(records: Sequence[Mapping[str, Any]], spec: Sequence[FeatureField] = FEATURE_SPEC) -> np.ndarray:
+    """Same as extract_from_customers, for raw customer dicts (e.g. parsed NDJSON)"""
+    n = len(records)
+    matrix = np.empty((n, len(spec)), dtype=FEATURE_DTYPE)
+    for j, field in enumerate(spec):
+        groups = (record.get(field.group) or {} for record in records)
+        matrix[:, j] = np.fromiter(_field_values(groups, field), dtype=FEATURE_DTYPE, count=n)
+    return matrix
+
+
+def extract_from_columns(
+    columns: Mapping[str, Sequence[Any]],
+    num_rows: int,
+    spec: Sequence[FeatureField] = FEATURE_SPEC
+) -> np.ndarray:
+    """
+    Fill a preallocated float32 matrix from parallel per-feature arrays
+
+    `columns` is keyed by feature name. Missing columns take the field default;
+    indicator fields accept either raw values (e.g. "M"/"F") or 0/1 numbers.
+    """
+    unknown = set(columns) - {field.name for field in spec}
+    if unknown:
+        raise ValueError(f"Unknown feature columns: {sorted(unknown)}")
+
+    matrix = np.empty((num_rows, len(spec)), dtype=FEATURE_DTYPE)
+    for j, field in enumerate(spec):
+        values = columns.get(field.name)
+        if values is None:
+            matrix[:, j] = field.default
+            continue
+        if len(values) != num_rows:
+            raise ValueError(
+                f"Column '{field.name}' has {len(values)} values, expected {num_rows}"
+            )
+        column = np.asarray(values)
+        if field.match is not None and column.dtype.kind in "UOS":
+            matrix[:, j] = column == field.match
+        else:
+            matrix[:, j] = column
+    return matrix
+
+
+def validate_matrix(matrix: np.ndarray, spec: Sequence[FeatureField] = FEATURE_SPEC) -> np.ndarray:
+    """Check an uploaded feature matrix against the spec and cast it to float32"""
+    if matrix.ndim != 2 or matrix.shape[1] != len(spec):
+        raise ValueError(
+            f"Feature matrix must have shape (n, {len(spec)}), got {matrix.shape}"
+        )
+    return np.ascontiguousarray(matrix, dtype=FEATURE_DTYPE)
@@ -0,0 +1,150 @@
+"""Process-pool execution and polled background jobs for CPU-bound agent work"""
+import asyncio
+import logging
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import asynccontextmanager, contextmanager
+from datetime import datetime
+from multiprocessing import resource_tracker, shared_memory
+from typing import Any, Awaitable, Callable, Dict, Iterator, Optional, Tuple
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+SharedArrayRef = Tuple[str, Tuple[int, ...], str]
+
+
+@contextmanager
+def share_array(array: np.ndarray) -> Iterator[SharedArrayRef]:
+    """
+    Copy an array into shared memory once for the duration of the block
+
+    Yields a small picklable (name, shape, dtype) reference that pool
+    workers pass to `attach_shared_array` instead of pickling the data.
+    """
+    shm = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+    try:
+        np.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf)[...] = array
+        yield shm.name, array.shape, array.dtype.str
+    finally:
+        shm.close()
+        shm.unlink()
+
+
+def attach_shared_array(ref: SharedArrayRef) -> Tuple[shared_memory.SharedMemory, np.ndarray]:
+    """
+    Zero-copy view of an array published with `share_array`
+
+    The caller must drop every reference to the view before calling
+    `close()` on the returned SharedMemory handle.
+    """
+    name, shape, dtype = ref
+    shm = shared_memory.SharedMemory(name=name)
+    return shm, np.ndarray(shape, dtype=np.dtype(dtype), buffer=shm.buf)
+
+
+class JobQueueFullError(RuntimeError):
+    """Raised when admitting more work would exceed the configured queue depth"""
+
+
+class JobManager:
+    """
+    Runs CPU-bound functions in a process pool with bounded admission
+
+    Work is admitted either synchronously (`slot`) or as a background job
+    (`submit`); both count against `max_pending`, and anything beyond it is
+    rejected with JobQueueFullError instead of piling up behind the pool.
+    Finished jobs are kept for polling, oldest evicted past `max_finished`.
+    """
+
+    def __init__(self, max_workers: int, max_pending: int, max_finished: int = 100):
+        self.max_workers = max_workers
+        self.max_pending = max_pending
+        self.max_finished = max_finished
+        self.active = 0
+        self.jobs: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self._executor: Optional[ProcessPoolExecutor] = None
+
+    @property
+    def executor(self) -> ProcessPoolExecutor:
+        if self._executor is None:
+            # Start the resource tracker before forking so workers share it;
+            # otherwise each worker would track (and unlink on exit) shared
+            # memory segments owned by this process.
+            resource_tracker.ensure_running()
+            self._executor = ProcessPoolExecutor(max_workers=self.max_workers)
+        return self._executor
+
+    def _acquire(self):
+        if self.active >= self.max_pending:
+            raise JobQueueFullError(
+                f"Too many pending jobs ({self.active}/{self.max_pending}), retry later"
+            )
+        self.active += 1
+
+    def _release(self):
+        self.active -= 1
+
+    @asynccontextmanager
+    async def slot(self):
+        """Admit one unit of synchronous work or raise JobQueueFullError"""
+        self._acquire()
+        try:
+            yield
+        finally:
+            self._release()
+
+    async def run_in_pool(self, fn: Callable[..., Any], *args: Any) -> Any:
+        """Run a picklable function in the process pool without blocking the loop"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, fn, *args)
+
+    def submit(self, coro_fn: Callable[..., Awaitable[Any]], *args: Any) -> str:
+        """Start a coroutine as a background job and return its id"""
+        self._acquire()
+        job_id = f"job_{uuid.uuid4().hex[:12]}"
+        self.jobs[job_id] = {
+            "job_id": job_id,
+            "status": "running",
+            "created_at": datetime.utcnow(),
+            "result": None,
+            "error": None
+        }
+        task = asyncio.create_task(coro_fn(*args))
+        task.add_done_callback(lambda t: self._finish(job_id, t))
+        return job_id
+
+    def _finish(self, job_id: str, task: "asyncio.Task"):
+        self._release()
+        job = self.jobs[job_id]
+        if task.cancelled():
+            job["status"] = "cancelled"
+        elif task.exception() is not None:
+            job["status"] = "failed"
+            job["error"] = str(task.exception())
+            logger.error(f"Job {job_id} failed: {job['error']}")
+        else:
+            job["status"] = "completed"
+            job["result"] = task.result()
+        job["finished_at"] = datetime.utcnow()
+        self._evict()
+
+    def _evict(self):
+        finished = [job_id for job_id, job in self.jobs.items() if "finished_at" in job]
+        for job_id in finished[:max(0, len(finished) - self.max_finished)]:
+            del self.jobs[job_id]
+
+    def get(self, job_id: str) -> Dict[str, Any]:
+        """Return a job's current record"""
+        if job_id not in self.jobs:
+            raise LookupError(f"Job {job_id} not found")
+        return self.jobs[job_id]
+
+    def shutdown(self):
+        """Stop the process pool"""
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
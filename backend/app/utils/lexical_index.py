@@ -0,0 +1,166 @@
+"""BM25 inverted index over document content, and rank fusion with vector results"""
+import logging
+import math
+import re
+from collections import Counter
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from app.utils.metadata_index import PostingList, export_postings, restore_postings
+from app.utils.vector_index import is_member, top_k_rows
+
+logger = logging.getLogger(__name__)
+
+# Keeps SKU- and campaign-style tokens ("sku-1042", "bf.2024") in one piece
+TOKEN_PATTERN = re.compile(r"\w+(?:[-.]\w+)*")
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+
+def tokenize(text: str) -> List[str]:
+    return TOKEN_PATTERN.findall(text.lower())
+
+
+class LexicalIndex:
+    """
+    Okapi BM25 over an append-only document set
+
+    Each term keeps two parallel posting lists, document positions and term
+    frequencies. A query only touches the postings of its own terms, so
+    exact-term lookups cost nothing proportional to the corpus size.
+    """
+
+    def __init__(self):
+        self._positions: Dict[str, PostingList] = {}
+        self._frequencies: Dict[str, PostingList] = {}
+        self._lengths = PostingList()  # tokens per document, by position
+        self.total_length = 0
+
+    def __len__(self) -> int:
+        return len(self._lengths)
+
+    def add(self, start: int, texts: Sequence[str]):
+        """Index texts stored at positions start, start + 1, ..."""
+        if start != len(self):
+            raise ValueError(f"Expected documents from position {len(self)}, got {start}")
+        lengths = []
+        # Gather the batch's postings per term, then extend each list once
+        batch: Dict[str, Tuple[List[int], List[int]]] = {}
+        for position, text in enumerate(texts, start):
+            tokens = tokenize(text)
+            lengths.append(len(tokens))
+            for term, count in Counter(tokens).items():
+                postings = batch.get(term)
+                if postings is None:
+                    batch[term] = postings = ([], [])
+                postings[0].append(position)
+                postings[1].append(count)
+        for term, (positions, counts) in batch.items():
+            if term not in self._positions:
+                # Searches may run meanwhile and look terms up in _positions first
+                self._frequencies[term] = PostingList()
+                self._positions[term] = PostingList()
+            self._positions[term].extend(positions)
+            self._frequencies[term].extend(counts)
+        self._lengths.extend(lengths)
+        self.total_length += sum(lengths)
+
+    def truncate(self, size: int):
+        """Forget every document at position `size` or later"""
+        if size >= len(self):
+            return
+        self.total_length -= int(self._lengths.positions[size:].sum())
+        self._lengths.truncate(size)
+        for term in list(self._positions):
+            keep = int(np.searchsorted(self._positions[term].positions, size))
+            if keep:
+                self._positions[term].truncate(keep)
+                self._frequencies[term].truncate(keep)
+            else:
+                del self._positions[term], self._frequencies[term]
+
+    def export(self) -> Tuple[Dict[str, Any], Dict[str, Any]]:
+        """Vocabulary and posting arrays, for snapshots (see VectorIndex.export)"""
+        terms = list(self._positions)
+        arrays: Dict[str, Any] = {"lexical_lengths": self._lengths.positions}
+        arrays["lexical_positions"], arrays["lexical_offsets"] = export_postings(
+            [self._positions[term] for term in terms]
+        )
+        arrays["lexical_frequencies"], _ = export_postings([self._frequencies[term] for term in terms])
+        return {"terms": terms, "total_length": self.total_length}, arrays
+
+    @classmethod
+    def restore(cls, params: Dict[str, Any], arrays: Dict[str, np.ndarray]) -> "LexicalIndex":
+        index = cls()
+        terms, offsets = params["terms"], arrays["lexical_offsets"]
+        index._positions = dict(zip(terms, restore_postings(arrays["lexical_positions"], offsets)))
+        index._frequencies = dict(zip(terms, restore_postings(arrays["lexical_frequencies"], offsets)))
+        index._lengths = PostingList.wrap(arrays["lexical_lengths"])
+        index.total_length = params["total_length"]
+        return index
+
+    def search(
+        self,
+        query: str,
+        top_k: int,
+        candidates: Optional[np.ndarray] = None,
+        limit: Optional[int] = None
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Top-k positions and BM25 scores for one query, best first
+
+        Only documents containing at least one query term are returned;
+        `candidates` and `limit` restrict them like VectorIndex.search.
+        Safe to call while `add` runs on another thread: unpublished
+        documents are below `limit` only once fully indexed.
+        """
+        num_docs = len(self) if limit is None else min(limit, len(self))
+        terms = [term for term in dict.fromkeys(tokenize(query)) if term in self._positions]
+        if not num_docs or not terms:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+
+        lengths = self._lengths.positions
+        avg_length = self.total_length / len(self)
+        matched, weights = [], []
+        for term in terms:
+            positions = self._positions[term].positions
+            frequencies = self._frequencies[term].positions
+            # An add may have extended positions but not yet frequencies
+            count = min(len(positions), len(frequencies))
+            positions, frequencies = positions[:count], frequencies[:count]
+            visible = positions < num_docs
+            if candidates is not None:
+                visible &= is_member(candidates, positions)
+            positions, frequencies = positions[visible], frequencies[visible].astype(np.float32)
+            idf = math.log(1.0 + (num_docs - len(positions) + 0.5) / (len(positions) + 0.5))
+            norm = BM25_K1 * (1.0 - BM25_B + BM25_B * lengths[positions] / avg_length)
+            matched.append(positions)
+            weights.append(idf * frequencies * (BM25_K1 + 1.0) / (frequencies + norm))
+
+        positions, inverse = np.unique(np.concatenate(matched), return_inverse=True)
+        scores = np.bincount(inverse, weights=np.concatenate(weights)).astype(np.float32)
+        best, best_scores = top_k_rows(scores[None, :], top_k)
+        return positions[best[0]], best_scores[0]
+
+
+def reciprocal_rank_fusion(
+    rankings: Sequence[np.ndarray],
+    top_k: int,
+    k: int = 60
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Fuse ranked position lists: score(d) = sum over lists of 1 / (k + rank)
+
+    Rank-based, so cosine similarities and BM25 scores need no calibration
+    against each other.
+    """
+    fused: Dict[int, float] = {}
+    for ranking in rankings:
+        for rank, position in enumerate(ranking.tolist(), 1):
+            fused[position] = fused.get(position, 0.0) + 1.0 / (k + rank)
+    best = sorted(fused.items(), key=lambda item: -item[1])[:top_k]
+    return (
+        np.array([position for position, _ in best], dtype=np.int64),
+        np.array([score for _, score in best], dtype=np.float32)
+    )
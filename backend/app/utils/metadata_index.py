@@ -0,0 +1,180 @@
+"""Inverted index from document metadata values to sorted row positions"""
+import logging
+from collections import defaultdict
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Filterable values must be hashable and survive a JSON round trip in snapshots
+FILTER_VALUE_TYPES = (str, int, float, bool)
+
+
+def _key(value: Any) -> Any:
+    """Posting key of a filter value; booleans are kept apart from the equal ints 1 and 0"""
+    return ("bool", value) if isinstance(value, bool) else value
+
+
+def _value(key: Any) -> Any:
+    return key[1] if isinstance(key, tuple) else key
+
+
+class PostingList:
+    """Growable, append-only int64 array of row positions (sorted by construction)"""
+
+    def __init__(self):
+        self._positions = np.empty(16, dtype=np.int64)
+        self.size = 0
+
+    @classmethod
+    def wrap(cls, positions: np.ndarray) -> "PostingList":
+        """Posting list over an existing (e.g. memory-mapped) array; copied on first extend"""
+        postings = cls()
+        postings._positions = positions
+        postings.size = len(positions)
+        return postings
+
+    def __len__(self) -> int:
+        return self.size
+
+    @property
+    def positions(self) -> np.ndarray:
+        return self._positions[:self.size]
+
+    def extend(self, positions: Sequence[int]):
+        if not len(positions):
+            return
+        if self.size + len(positions) > len(self._positions):
+            grown = np.empty(max(2 * len(self._positions), self.size + len(positions)), dtype=np.int64)
+            grown[:self.size] = self._positions[:self.size]
+            self._positions = grown
+        self._positions[self.size:self.size + len(positions)] = positions
+        self.size += len(positions)
+
+    def truncate(self, size: int):
+        """Drop everything past the first `size` entries"""
+        self.size = min(self.size, size)
+
+
+class MetadataIndex:
+    """
+    Maps (field, value) to the sorted positions of the documents carrying it
+
+    Only the configured `fields` are indexed. A list-valued field files the
+    document under each element. Documents are appended in position order,
+    so every posting list stays sorted without re-sorting.
+    """
+
+    def __init__(self, fields: Iterable[str]):
+        self.fields = tuple(fields)
+        self._postings: Dict[str, Dict[Any, PostingList]] = {field: {} for field in self.fields}
+
+    def validate(self, documents: Sequence[Dict[str, Any]]):
+        """Raise ValueError for an indexed field value that cannot be filtered on"""
+        for i, document in enumerate(documents):
+            for field in self.fields:
+                value = document.get(field)
+                for item in value if isinstance(value, (list, tuple)) else [value]:
+                    if item is not None and not isinstance(item, FILTER_VALUE_TYPES):
+                        raise ValueError(
+                            f"Document {i}: filter field '{field}' must be a string, number or boolean "
+                            f"(or a list of them), got {type(item).__name__}"
+                        )
+
+    def add(self, start: int, documents: Sequence[Dict[str, Any]]):
+        """Index documents stored at positions start, start + 1, ... (see `validate`)"""
+        for field in self.fields:
+            grouped: Dict[Any, List[int]] = defaultdict(list)
+            for position, document in enumerate(documents, start):
+                value = document.get(field)
+                for item in value if isinstance(value, (list, tuple)) else [value]:
+                    if item is not None:
+                        grouped[_key(item)].append(position)
+            postings = self._postings[field]
+            for value, positions in grouped.items():
+                postings.setdefault(value, PostingList()).extend(positions)
+
+    def truncate(self, size: int):
+        """Forget every document at position `size` or later"""
+        for postings in self._postings.values():
+            for value in list(postings):
+                posting_list = postings[value]
+                posting_list.truncate(int(np.searchsorted(posting_list.positions, size)))
+                if not len(posting_list):
+                    del postings[value]
+
+    def export(self) -> Tuple[Dict[str, Any], Dict[str, Any]]:
+        """Field values and posting arrays, for snapshots (see VectorIndex.export)"""
+        params: Dict[str, Any] = {"fields": []}
+        arrays: Dict[str, Any] = {}
+        for i, field in enumerate(self.fields):
+            postings = self._postings[field]
+            params["fields"].append({"name": field, "values": [_value(key) for key in postings]})
+            arrays[f"metadata_{i}_positions"], arrays[f"metadata_{i}_offsets"] = export_postings(
+                list(postings.values())
+            )
+        return params, arrays
+
+    @classmethod
+    def restore(cls, params: Dict[str, Any], arrays: Dict[str, np.ndarray]) -> "MetadataIndex":
+        index = cls(field["name"] for field in params["fields"])
+        for i, field in enumerate(params["fields"]):
+            postings = restore_postings(arrays[f"metadata_{i}_positions"], arrays[f"metadata_{i}_offsets"])
+            index._postings[field["name"]] = dict(zip(map(_key, field["values"]), postings))
+        return index
+
+    def values(self, field: str) -> List[Tuple[Any, int]]:
+        """Distinct values of a field and their document counts"""
+        # Copy first: an add on another thread may be inserting values
+        return [(_value(key), len(postings)) for key, postings in list(self._postings[field].items())]
+
+    def lookup(self, filters: Dict[str, Any]) -> Optional[np.ndarray]:
+        """
+        Sorted positions matching every filter, or None when there is no filter
+
+        Each filter value may be a scalar or a list (match any of them);
+        different fields are intersected, smallest set first. Values that
+        could never be indexed (dicts, nested lists) raise ValueError.
+        """
+        if not filters:
+            return None
+        unknown = [field for field in filters if field not in self._postings]
+        if unknown:
+            raise ValueError(
+                f"Cannot filter on {', '.join(unknown)}; filterable fields: {', '.join(self.fields)}"
+            )
+        matches = []
+        for field, wanted in filters.items():
+            postings = self._postings[field]
+            values = wanted if isinstance(wanted, (list, tuple)) else [wanted]
+            invalid = [value for value in values if not isinstance(value, FILTER_VALUE_TYPES)]
+            if invalid:
+                raise ValueError(
+                    f"Filter on '{field}' must be a string, number or boolean (or a list of them), "
+                    f"got {type(invalid[0]).__name__}"
+                )
+            keys = [_key(value) for value in values]
+            lists = [postings[key].positions for key in keys if key in postings]
+            if len(lists) == 1:
+                matches.append(lists[0])
+            else:
+                matches.append(np.unique(np.concatenate(lists)) if lists else np.empty(0, dtype=np.int64))
+        matches.sort(key=len)
+        result = matches[0]
+        for positions in matches[1:]:
+            if not len(result):
+                break
+            result = np.intersect1d(result, positions, assume_unique=True)
+        return result
+
+
+def export_postings(postings: Sequence[PostingList]) -> Tuple[List[np.ndarray], np.ndarray]:
+    """Posting lists as concatenation parts plus (len + 1) offsets, for snapshots"""
+    sizes = np.array([len(posting_list) for posting_list in postings], dtype=np.int64)
+    return [posting_list.positions for posting_list in postings], np.concatenate([[0], np.cumsum(sizes)])
+
+
+def restore_postings(positions: np.ndarray, offsets: np.ndarray) -> List[PostingList]:
+    """Inverse of export_postings, as views into `positions`"""
+    return [PostingList.wrap(positions[start:end]) for start, end in zip(offsets[:-1].tolist(), offsets[1:].tolist())]
@@ -0,0 +1,171 @@
+"""Versioned on-disk registry of fitted segmentation models"""
+import json
+import logging
+import os
+import shutil
+import uuid
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+ARRAY_NAMES = ("scaler_mean", "scaler_scale", "centroids", "counts")
+
+
+class SegmentationModel:
+    """
+    A fitted scaler + centroid set used for predict-only assignment
+
+    The scaler is folded into the centroid scores at construction, so
+    labelling a batch is a single (n, d) x (d, k) matmul plus argmin.
+    """
+
+    def __init__(
+        self,
+        version: str,
+        scaler_mean: np.ndarray,
+        scaler_scale: np.ndarray,
+        centroids: np.ndarray,
+        counts: np.ndarray,
+        metadata: Dict[str, Any]
+    ):
+        self.version = version
+        self.scaler_mean = scaler_mean
+        self.scaler_scale = scaler_scale
+        self.centroids = centroids
+        self.counts = counts
+        self.metadata = metadata
+
+        # ||z - c||^2 = ||z||^2 - 2 z.c + ||c||^2 with z = (x - mean) / scale;
+        # ||z||^2 is constant per row so argmin only needs x.W + b.
+        scaled_centroids = (centroids / scaler_scale).astype(np.float64)
+        self._weights = -2.0 * scaled_centroids.T
+        self._bias = (
+            np.einsum("kd,kd->k", centroids, centroids)
+            + 2.0 * scaled_centroids @ scaler_mean
+        )
+
+    @property
+    def num_segments(self) -> int:
+        return self.centroids.shape[0]
+
+    def assign(self, features: np.ndarray) -> np.ndarray:
+        """Return the nearest segment index for each row of raw features"""
+        scores = features @ self._weights
+        scores += self._bias
+        return np.argmin(scores, axis=1)
+
+    def describe(self) -> Dict[str, Any]:
+        """Summary for listing endpoints"""
+        return {
+            "version": self.version,
+            "num_segments": self.num_segments,
+            "sizes": self.counts.tolist(),
+            **self.metadata
+        }
+
+
+class SegmentationModelRegistry:
+    """
+    Stores fitted models as versioned artifact directories under `root`
+
+    Each version is a directory of .npy arrays plus meta.json. Versions are
+    written to a temporary directory and renamed into place, and loaded with
+    memory mapping so several worker processes share the same pages. Worker
+    processes saving concurrently each get their own version; versions saved
+    by another process are picked up on lookup.
+    """
+
+    def __init__(self, root: str):
+        self.root = Path(root) / "segmentation"
+        self.models: Dict[str, SegmentationModel] = {}
+
+    def _next_version(self) -> str:
+        existing = [
+            int(path.name[1:]) for path in self.root.glob("v*")
+            if path.is_dir() and path.name[1:].isdigit()
+        ]
+        return f"v{max(existing, default=0) + 1}"
+
+    def save(
+        self,
+        scaler_mean: np.ndarray,
+        scaler_scale: np.ndarray,
+        centroids: np.ndarray,
+        counts: np.ndarray,
+        metadata: Optional[Dict[str, Any]] = None
+    ) -> SegmentationModel:
+        """Persist a fitted model as a new version and register it"""
+        self.root.mkdir(parents=True, exist_ok=True)
+        staging = self.root / f".{os.getpid()}-{uuid.uuid4().hex}.tmp"
+        staging.mkdir()
+
+        arrays = {
+            "scaler_mean": np.asarray(scaler_mean, dtype=np.float64),
+            "scaler_scale": np.asarray(scaler_scale, dtype=np.float64),
+            "centroids": np.asarray(centroids, dtype=np.float64),
+            "counts": np.asarray(counts, dtype=np.int64),
+        }
+        for name, array in arrays.items():
+            np.save(staging / f"{name}.npy", array)
+        meta = {"created_at": datetime.utcnow().isoformat(), **(metadata or {})}
+        (staging / "meta.json").write_text(json.dumps(meta))
+        while True:
+            version = self._next_version()
+            try:
+                os.rename(staging, self.root / version)
+                break
+            except OSError:
+                # Another process took this version first
+                if not (self.root / version).exists():
+                    shutil.rmtree(staging, ignore_errors=True)
+                    raise
+
+        model = SegmentationModel(version, metadata=meta, **arrays)
+        self.models[version] = model
+        logger.info(f"Saved segmentation model {version}")
+        return model
+
+    def load_all(self) -> List[str]:
+        """Memory-map every stored version; returns the loaded version names"""
+        if not self.root.is_dir():
+            return []
+        paths = [path for path in self.root.glob("v*") if path.name[1:].isdigit()]
+        loaded = 0
+        for path in sorted(paths, key=lambda p: int(p.name[1:])):
+            if path.name in self.models:
+                continue
+            try:
+                arrays = {
+                    name: np.load(path / f"{name}.npy", mmap_mode="r")
+                    for name in ARRAY_NAMES
+                }
+                meta = json.loads((path / "meta.json").read_text())
+            except (OSError, ValueError) as e:
+                logger.warning(f"Skipping unreadable segmentation model {path.name}: {e}")
+                continue
+            self.models[path.name] = SegmentationModel(path.name, metadata=meta, **arrays)
+            loaded += 1
+        if loaded:
+            logger.info(f"Loaded {loaded} segmentation models")
+        return list(self.models)
+
+    def get(self, version: Optional[str] = None) -> SegmentationModel:
+        """
+        Return a model by version, or the latest one
+
+        The latest version, and any version not yet known here, is looked
+        up on disk first, so models saved by other worker processes are found.
+        """
+        if version is None or version not in self.models:
+            self.load_all()
+        if version is None:
+            if not self.models:
+                raise LookupError("No segmentation models available")
+            version = max(self.models, key=lambda v: int(v[1:]))
+        if version not in self.models:
+            raise LookupError(f"Segmentation model {version} not found")
+        return self.models[version]
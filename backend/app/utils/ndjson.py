@@ -0,0 +1,30 @@
+"""Incremental NDJSON parsing for streamed request bodies"""
+import json
+from typing import Any, AsyncIterator, Dict, List
+
+
+async def iter_ndjson_batches(
+    chunks: AsyncIterator[bytes],
+    batch_size: int = 10000
+) -> AsyncIterator[List[Dict[str, Any]]]:
+    """
+    Parse an async stream of raw body chunks into batches of JSON objects
+
+    Only the current partial line and one batch are held in memory, so the
+    upload can be arbitrarily large. Blank lines are skipped.
+    """
+    batch: List[Dict[str, Any]] = []
+    remainder = b""
+    async for chunk in chunks:
+        lines = (remainder + chunk).split(b"\n")
+        remainder = lines.pop()
+        for line in lines:
+            if line.strip():
+                batch.append(json.loads(line))
+                if len(batch) >= batch_size:
+                    yield batch
+                    batch = []
+    if remainder.strip():
+        batch.append(json.loads(remainder))
+    if batch:
+        yield batch
@@ -0,0 +1,80 @@
+"""Single-pass scanner for PII and content-policy terms"""
+import logging
+import re
+from typing import Iterable, List, NamedTuple
+
+logger = logging.getLogger(__name__)
+
+PII_KINDS = ("email", "phone", "card", "ssn")
+POLICY_KIND = "policy_term"
+
+# Every finding starts at a token boundary; checking that once, outside the
+# alternation, lets the engine reject positions inside words with a single
+# lookbehind instead of trying each branch
+_BOUNDARY = r"(?<![\w.%+-])"
+_EMAIL = r"(?P<email>[\w.%+-]++@[A-Za-z0-9-]+(?:\.[A-Za-z0-9-]+)*\.[A-Za-z]{2,})"
+_NUMBERS = (
+    r"(?=[\d(+])(?:"
+    r"(?P<ssn>(?!000|666|9\d\d)\d{3}-(?!00)\d{2}-(?!0000)\d{4})"
+    r"|(?P<card>\d(?:[ -]?\d){12,18})"  # 13-19 digits, Luhn-checked after matching
+    r"|(?P<phone>\+\d{1,3}(?:[ .-]?\d{2,4}){2,4}|(?:\(\d{3}\) ?|\d{3}[ .-]?)\d{3}[ .-]?\d{4})"
+    r")(?![\w-])"
+)
+
+
+class Finding(NamedTuple):
+    """One match: its kind (email, phone, card, ssn or policy_term) and text[start:end]"""
+    kind: str
+    start: int
+    end: int
+    text: str
+
+
+def luhn_valid(number: str) -> bool:
+    """Luhn checksum over the digits of `number`, ignoring separators"""
+    digits = [int(c) for c in number if c.isdigit()]
+    total = sum(digits[-1::-2])
+    for digit in digits[-2::-2]:
+        total += digit * 2 - 9 if digit > 4 else digit * 2
+    return total % 10 == 0
+
+
+def _policy_branch(terms: Iterable[str]) -> str:
+    # Longest first so a term is not cut short by one of its prefixes;
+    # any run of whitespace in the text matches a space in a term
+    terms = sorted({term.strip().lower() for term in terms if term.strip()}, key=len, reverse=True)
+    if not terms:
+        return ""
+    alternatives = "|".join(r"\s+".join(map(re.escape, term.split())) for term in terms)
+    return rf"|(?P<{POLICY_KIND}>(?i:{alternatives})(?!\w))"
+
+
+class PIIScanner:
+    """
+    Emails, phone numbers, card numbers, SSNs and policy terms found in one pass
+
+    All patterns are compiled into a single alternation, so a text of any
+    size is scanned once regardless of how many kinds or terms are checked.
+    Card-shaped digit runs that fail the Luhn check are dropped. Policy
+    terms match case-insensitively as whole words.
+    """
+
+    def __init__(self, policy_terms: Iterable[str] = ()):
+        self.pattern = re.compile(f"{_BOUNDARY}(?:{_NUMBERS}{_policy_branch(policy_terms)}|{_EMAIL})")
+
+    def scan(self, text: str) -> List[Finding]:
+        """Findings in order of position"""
+        findings = []
+        search, position = self.pattern.search, 0
+        while True:
+            match = search(text, position)
+            if match is None:
+                return findings
+            kind, value = match.lastgroup, match.group()
+            if kind == "card" and not luhn_valid(value):
+                # Not a card, but its digit groups may still hold a phone
+                # number or SSN ("order 12345 123-45-6789"): resume at the next token
+                position = match.start() + 1
+                continue
+            findings.append(Finding(kind, match.start(), match.end(), value))
+            position = match.end()
@@ -0,0 +1,53 @@
+"""Token-rate budgeting for LLM calls"""
+import asyncio
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+# Rough size of a token in characters for English text; only used to
+# reserve budget before a call, the reservation is settled with real usage
+CHARS_PER_TOKEN = 4
+
+
+def estimate_tokens(text: str) -> int:
+    return len(text) // CHARS_PER_TOKEN + 1
+
+
+class TokenBucket:
+    """
+    Async token bucket refilled at `tokens_per_minute`, holding at most one minute's worth
+
+    `acquire` waits until the requested tokens are available; waiters are
+    served in arrival order. Callers reserve an estimate up front and
+    `settle` it against the real usage afterwards, so the level may go
+    negative and delay later calls when an estimate was too low.
+    """
+
+    def __init__(self, tokens_per_minute: int):
+        self.capacity = float(tokens_per_minute)
+        self.rate = tokens_per_minute / 60.0
+        self.tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    async def acquire(self, tokens: int) -> float:
+        """Wait for and take `tokens`; returns the amount taken, for `settle`"""
+        tokens = min(tokens, self.capacity)  # a huge request must not wait forever
+        async with self._lock:
+            self._refill()
+            while self.tokens < tokens:
+                await asyncio.sleep((tokens - self.tokens) / self.rate)
+                self._refill()
+            self.tokens -= tokens
+        return tokens
+
+    def settle(self, reserved: float, used: int):
+        """Return over-reserved tokens, or charge the shortfall"""
+        self._refill()
+        self.tokens = min(self.capacity, self.tokens + reserved - used)
@@ -0,0 +1,143 @@
+"""Pluggable TTL caches for serialized responses: in-process LRU or Redis"""
+import logging
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import redis.asyncio as redis
+
+from app.utils.config import settings
+
+logger = logging.getLogger(__name__)
+
+
+class ResultCache(ABC):
+    """Interface: batched get/set of string values with a time-to-live"""
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+
+    @abstractmethod
+    async def get_many(self, keys: Sequence[str]) -> List[Optional[str]]:
+        """Cached values in key order, None for a miss; implementations pass them through `_count`"""
+
+    @abstractmethod
+    async def set_many(self, items: Sequence[Tuple[str, str]], ttl: float):
+        """Store (key, value) pairs expiring after `ttl` seconds"""
+
+    async def close(self):
+        """Release backend connections"""
+        return None
+
+    def _count(self, values: List[Optional[str]]) -> List[Optional[str]]:
+        found = sum(value is not None for value in values)
+        self.hits += found
+        self.misses += len(values) - found
+        return values
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "backend": type(self).__name__,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0
+        }
+
+
+class NullCache(ResultCache):
+    """Caching disabled: every lookup misses"""
+
+    async def get_many(self, keys: Sequence[str]) -> List[Optional[str]]:
+        return self._count([None] * len(keys))
+
+    async def set_many(self, items: Sequence[Tuple[str, str]], ttl: float):
+        return None
+
+
+class MemoryCache(ResultCache):
+    """In-process LRU with per-entry expiry, bounded by entry count"""
+
+    def __init__(self, max_entries: int = 10000):
+        super().__init__()
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[str, Tuple[float, str]]" = OrderedDict()
+
+    async def get_many(self, keys: Sequence[str]) -> List[Optional[str]]:
+        now = time.monotonic()
+        values: List[Optional[str]] = []
+        for key in keys:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] <= now:
+                del self._entries[key]
+                entry = None
+            if entry is not None:
+                self._entries.move_to_end(key)
+            values.append(entry[1] if entry is not None else None)
+        return self._count(values)
+
+    async def set_many(self, items: Sequence[Tuple[str, str]], ttl: float):
+        expires_at = time.monotonic() + ttl
+        for key, value in items:
+            self._entries[key] = (expires_at, value)
+            self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def stats(self) -> Dict[str, Any]:
+        return {**super().stats(), "entries": len(self._entries), "max_entries": self.max_entries}
+
+
+class RedisCache(ResultCache):
+    """
+    Redis-backed cache shared by every worker process
+
+    Uses one MGET per lookup batch and one pipelined SET ... EX per store.
+    Redis errors are logged and treated as misses, so an unavailable cache
+    slows requests down instead of failing them.
+    """
+
+    def __init__(self, client: Any, prefix: str = ""):
+        super().__init__()
+        self.client = client
+        self.prefix = prefix
+
+    async def get_many(self, keys: Sequence[str]) -> List[Optional[str]]:
+        if not keys:
+            return []
+        try:
+            values = await self.client.mget([self.prefix + key for key in keys])
+        except Exception as e:
+            logger.warning(f"Redis cache lookup failed: {e}")
+            values = [None] * len(keys)
+        return self._count([
+            value.decode("utf-8") if isinstance(value, bytes) else value for value in values
+        ])
+
+    async def set_many(self, items: Sequence[Tuple[str, str]], ttl: float):
+        if not items:
+            return
+        try:
+            async with self.client.pipeline(transaction=False) as pipe:
+                for key, value in items:
+                    pipe.set(self.prefix + key, value, ex=max(1, int(ttl)))
+                await pipe.execute()
+        except Exception as e:
+            logger.warning(f"Redis cache store failed: {e}")
+
+    async def close(self):
+        await self.client.aclose()
+
+
+def build_cache(backend: str, prefix: str, max_entries: int) -> ResultCache:
+    """Create the configured cache backend: memory | redis | none"""
+    if backend == "memory":
+        return MemoryCache(max_entries)
+    if backend == "redis":
+        client = redis.Redis(host=settings.REDIS_HOST, port=settings.REDIS_PORT, db=settings.REDIS_DB)
+        return RedisCache(client, prefix=prefix)
+    if backend == "none":
+        return NullCache()
+    raise ValueError(f"Unsupported cache backend: {backend}")
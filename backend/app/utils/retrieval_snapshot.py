@@ -0,0 +1,140 @@
+"""Versioned on-disk snapshots of the retrieval indexes, opened with memory mapping"""
+import json
+import logging
+import os
+import shutil
+import uuid
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+
+from app.utils.document_store import DocumentStore
+
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_FORMAT = 1
+# Rows copied per step when concatenating array parts into a snapshot file
+WRITE_BLOCK_ROWS = 65536
+
+
+def write_array(path: Path, parts: Any):
+    """
+    Save an ndarray, or the concatenation of a list of ndarrays, as .npy
+
+    Parts are streamed into a memory-mapped output file block by block, so
+    a large index is never duplicated in memory while it is written.
+    """
+    if isinstance(parts, np.ndarray):
+        parts = [parts]
+    rows = sum(len(part) for part in parts)
+    # Empty parts may lack the trailing dimensions (e.g. an index with no rows yet)
+    first = next((part for part in parts if len(part)), parts[0] if parts else np.empty(0, dtype=np.int64))
+    out = np.lib.format.open_memmap(path, mode="w+", dtype=first.dtype, shape=(rows, *first.shape[1:]))
+    offset = 0
+    for part in parts:
+        for start in range(0, len(part), WRITE_BLOCK_ROWS):
+            block = part[start:start + WRITE_BLOCK_ROWS]
+            out[offset:offset + len(block)] = block
+            offset += len(block)
+    out.flush()
+    del out
+
+
+class RetrievalSnapshotStore:
+    """
+    Stores the retrieval state as versioned directories under `root`
+
+    A version holds meta.json (format, sizes and component parameters),
+    one .npy file per array and the documents as JSON lines. Versions are
+    written to a temporary directory and renamed into place, and loaded
+    with memory mapping, so a restart only maps files instead of
+    re-embedding, and worker processes opening the same version share the
+    same physical pages through the page cache.
+    """
+
+    def __init__(self, root: str, retention: int = 3):
+        if retention < 1:
+            raise ValueError(f"Snapshot retention must keep at least 1 version, got {retention}")
+        self.root = Path(root)
+        self.retention = retention
+
+    def versions(self) -> List[str]:
+        """Stored version names, oldest first"""
+        if not self.root.is_dir():
+            return []
+        paths = [path for path in self.root.glob("v*") if path.is_dir() and path.name[1:].isdigit()]
+        return [path.name for path in sorted(paths, key=lambda p: int(p.name[1:]))]
+
+    def save(
+        self,
+        params: Dict[str, Any],
+        arrays: Dict[str, Any],
+        documents: DocumentStore,
+        size: int
+    ) -> Dict[str, Any]:
+        """Persist the first `size` documents and the given component state as a new version"""
+        self.root.mkdir(parents=True, exist_ok=True)
+        staging = self.root / f".{os.getpid()}-{uuid.uuid4().hex}.tmp"
+        staging.mkdir()
+
+        for name, parts in arrays.items():
+            write_array(staging / f"{name}.npy", parts)
+        documents.save(staging, size)
+        # The version is the directory name, only known once the rename succeeds
+        meta = {
+            "format": SNAPSHOT_FORMAT,
+            "created_at": datetime.utcnow().isoformat(),
+            "documents": size,
+            "arrays": sorted(arrays),
+            **params
+        }
+        (staging / "meta.json").write_text(json.dumps(meta, default=str))
+        while True:
+            versions = self.versions()
+            version = f"v{int(versions[-1][1:]) + 1 if versions else 1}"
+            try:
+                os.rename(staging, self.root / version)
+                break
+            except OSError:
+                # Another process took this version first
+                if not (self.root / version).exists():
+                    shutil.rmtree(staging, ignore_errors=True)
+                    raise
+        meta["version"] = version
+        logger.info(f"Saved retrieval snapshot {version} with {size} documents")
+        self._prune()
+        return meta
+
+    def _prune(self):
+        # Running workers keep their mapped files readable after unlinking
+        for version in self.versions()[:-self.retention]:
+            shutil.rmtree(self.root / version, ignore_errors=True)
+
+    def load(
+        self,
+        version: Optional[str] = None
+    ) -> Optional[Tuple[Dict[str, Any], Dict[str, np.ndarray], DocumentStore]]:
+        """
+        Memory-map a version (default: the latest); None when none is stored
+
+        Returns (meta, arrays, documents); the arrays are read-only memmaps.
+        """
+        versions = self.versions()
+        if version is None:
+            if not versions:
+                return None
+            version = versions[-1]
+        if version not in versions:
+            raise LookupError(f"Retrieval snapshot {version} not found")
+        path = self.root / version
+        meta = {**json.loads((path / "meta.json").read_text()), "version": version}
+        if meta.get("format") != SNAPSHOT_FORMAT:
+            raise ValueError(
+                f"Retrieval snapshot {version} has format {meta.get('format')}, expected {SNAPSHOT_FORMAT}"
+            )
+        arrays = {name: np.load(path / f"{name}.npy", mmap_mode="r") for name in meta["arrays"]}
+        documents = DocumentStore.load(path)
+        logger.info(f"Loaded retrieval snapshot {version} with {meta['documents']} documents")
+        return meta, arrays, documents
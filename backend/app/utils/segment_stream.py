@@ -0,0 +1,161 @@
+"""Chunk-at-a-time segmentation state for datasets too large for one request"""
+import asyncio
+import logging
+import tempfile
+import time
+from typing import Any, Iterator, List, Mapping, Optional, Sequence, Tuple
+
+import numpy as np
+from sklearn.cluster import MiniBatchKMeans
+from sklearn.preprocessing import StandardScaler
+
+from app.utils.clustering import SegmentStatsAccumulator, sampled_silhouette
+from app.utils.features import FEATURE_DTYPE, FEATURE_NAMES, extract_from_records
+
+logger = logging.getLogger(__name__)
+
+
+class SegmentationStream:
+    """
+    Incrementally fitted scaler + MiniBatchKMeans for one streamed dataset
+
+    Each chunk updates the scaler statistics and the centroids, then is
+    spooled to a temporary file. `finalize` re-reads the spool chunk by chunk
+    to label every customer with the final scaler and centroids, so resident
+    memory is bounded by the chunk size rather than the dataset size.
+    """
+
+    def __init__(
+        self,
+        stream_id: str,
+        num_segments: int,
+        chunk_size: int = 10000,
+        save_model: bool = False,
+        inline_assignments: bool = True
+    ):
+        self.stream_id = stream_id
+        self.num_segments = num_segments
+        self.chunk_size = chunk_size
+        self.save_model = save_model
+        self.inline_assignments = inline_assignments
+        # Serializes chunk updates and finalize for this stream
+        self.lock = asyncio.Lock()
+        self.rows_received = 0
+        self.scaler = StandardScaler()
+        self.model = MiniBatchKMeans(
+            n_clusters=num_segments,
+            random_state=42,
+            n_init=3,
+            batch_size=chunk_size
+        )
+        self._fitted = False
+        # Rows not yet seen by the model (MiniBatchKMeans needs >= k rows to start)
+        self._pending: List[np.ndarray] = []
+        self._pending_rows = 0
+        self._features_spool = tempfile.TemporaryFile()
+        self._ids_spool = tempfile.TemporaryFile()
+        self.last_active = time.monotonic()
+
+    def add_records(self, records: Sequence[Mapping[str, Any]]) -> int:
+        """Add a chunk of raw customer dicts; returns total rows received"""
+        if not records:
+            return self.rows_received
+        features = extract_from_records(records)
+        ids = "\n".join(str(record["customer_id"]) for record in records) + "\n"
+
+        self._features_spool.write(features.tobytes())
+        self._ids_spool.write(ids.encode("utf-8"))
+        self.rows_received += len(records)
+
+        self.scaler.partial_fit(features)
+        self._pending.append(features)
+        self._pending_rows += len(features)
+        if self._pending_rows >= max(self.num_segments, self.chunk_size) or self._fitted:
+            self._flush_pending()
+        return self.rows_received
+
+    def _flush_pending(self):
+        """Feed buffered rows to the model as one mini-batch"""
+        if not self._pending:
+            return
+        batch = np.concatenate(self._pending)
+        self._pending = []
+        self._pending_rows = 0
+        self.model.partial_fit(self.scaler.transform(batch))
+        self._fitted = True
+
+    def iter_chunks(self) -> Iterator[Tuple[np.ndarray, List[str]]]:
+        """Yield (features, customer_ids) chunks back from the spool"""
+        row_bytes = len(FEATURE_NAMES) * np.dtype(FEATURE_DTYPE).itemsize
+        self._features_spool.seek(0)
+        self._ids_spool.seek(0)
+        while True:
+            raw = self._features_spool.read(self.chunk_size * row_bytes)
+            if not raw:
+                break
+            features = np.frombuffer(raw, dtype=FEATURE_DTYPE).reshape(-1, len(FEATURE_NAMES))
+            ids = [self._ids_spool.readline().decode("utf-8").rstrip("\n") for _ in range(len(features))]
+            yield features, ids
+
+    def finalize(
+        self,
+        quality_sample_size: int = 5000,
+        quality_time_budget: Optional[float] = None
+    ) -> Tuple[SegmentStatsAccumulator, List[str], np.ndarray, float, int]:
+        """
+        Finish fitting and label every spooled customer
+
+        Returns per-segment statistics, customer ids with their segment
+        labels in upload order, and the sampled silhouette score with the
+        number of rows it scored.
+        """
+        if self.rows_received < self.num_segments:
+            raise ValueError(
+                f"Stream {self.stream_id} has {self.rows_received} customers, "
+                f"need at least {self.num_segments}"
+            )
+        self._flush_pending()
+
+        stats = SegmentStatsAccumulator(self.num_segments, len(FEATURE_NAMES))
+        customer_ids: List[str] = []
+        labels = np.empty(self.rows_received, dtype=np.int32)
+        offset = 0
+        for features, ids in self.iter_chunks():
+            chunk_labels = self.model.predict(self.scaler.transform(features))
+            stats.update(features, chunk_labels)
+            labels[offset:offset + len(chunk_labels)] = chunk_labels
+            offset += len(chunk_labels)
+            customer_ids.extend(ids)
+
+        quality_score, quality_rows = self._sampled_quality(quality_sample_size, quality_time_budget)
+        logger.info(f"Stream {self.stream_id} finalized with {self.rows_received} customers")
+        return stats, customer_ids, labels, quality_score, quality_rows
+
+    def _sampled_quality(self, sample_size: int, time_budget: Optional[float]) -> Tuple[float, int]:
+        """Silhouette on a uniform sample of spooled rows, read through a memmap"""
+        self._features_spool.flush()
+        spooled = np.memmap(
+            self._features_spool,
+            dtype=FEATURE_DTYPE,
+            mode="r",
+            shape=(self.rows_received, len(FEATURE_NAMES))
+        )
+        rng = np.random.default_rng(42)
+        if self.rows_received > sample_size:
+            rows = np.sort(rng.choice(self.rows_received, size=sample_size, replace=False))
+        else:
+            rows = np.arange(self.rows_received)
+        sample = self.scaler.transform(np.asarray(spooled[rows]))
+        del spooled
+        return sampled_silhouette(
+            sample,
+            self.model.predict(sample),
+            self.num_segments,
+            sample_size=sample_size,
+            time_budget=time_budget
+        )
+
+    def close(self):
+        """Release spool files"""
+        self._features_spool.close()
+        self._ids_spool.close()
@@ -0,0 +1,174 @@
+"""Compiled message templates rendered per customer from columnar data"""
+import functools
+import logging
+import re
+from datetime import date, datetime
+from typing import Any, Callable, Dict, Iterator, List, Mapping, Optional, Sequence, Tuple
+
+logger = logging.getLogger(__name__)
+
+# {{field}}, {{field:type}}, {{field|default}} or {{field:type|default}}
+PLACEHOLDER_PATTERN = re.compile(r"\{\{\s*(\w+)\s*(?::\s*(\w+)\s*)?(?:\|([^}]*))?\}\}")
+
+
+def _format_date(value: Any) -> str:
+    if isinstance(value, str):
+        value = date.fromisoformat(value[:10])
+    if isinstance(value, datetime):
+        value = value.date()
+    return f"{value:%B} {value.day}, {value.year}"
+
+
+FORMATTERS: Dict[str, Callable[[Any], str]] = {
+    "str": str,
+    "title": lambda value: str(value).title(),
+    "upper": lambda value: str(value).upper(),
+    "int": lambda value: f"{int(value):d}",
+    "float": lambda value: f"{float(value):.2f}",
+    "currency": lambda value: f"${float(value):,.2f}",
+    "percent": lambda value: f"{float(value):.0%}",
+    "date": _format_date,
+}
+# Types whose output depends only on the value, not on its Python type
+# (1, 1.0 and True format alike), so a chunk formats each distinct value once
+MEMOIZED_TYPES = {"int", "float", "currency", "percent", "date"}
+
+
+def _is_missing(value: Any) -> bool:
+    return value is None or value == "" or value != value  # NaN != NaN
+
+
+class Placeholder:
+    """A typed field reference; a missing value renders as `default`"""
+
+    def __init__(self, field: str, kind: str = "str", default: str = ""):
+        if kind not in FORMATTERS:
+            raise ValueError(f"Unknown placeholder type '{kind}' for {field}; available: {', '.join(FORMATTERS)}")
+        self.field = field
+        self.kind = kind
+        self.default = default
+        self._format = FORMATTERS[kind]
+
+    def format_column(self, values: Sequence[Any]) -> List[str]:
+        """Format a slice of the field's column"""
+        format_value, default = self._format, self.default
+        try:
+            if self.kind in MEMOIZED_TYPES:
+                distinct = dict.fromkeys(values)
+                for value in distinct:
+                    distinct[value] = default if _is_missing(value) else format_value(value)
+                return [distinct[value] for value in values]
+            return [
+                default if value is None or value == "" or value != value else format_value(value)
+                for value in values
+            ]
+        except (TypeError, ValueError):
+            # Slow path, only to name the offending value
+            for value in values:
+                try:
+                    _is_missing(value) or format_value(value)
+                except (TypeError, ValueError) as e:
+                    raise ValueError(f"Cannot render {value!r} as {self.kind} for field '{self.field}': {e}")
+            raise
+
+
+class CompiledTemplate:
+    """
+    A template parsed once into a str.format pattern plus its placeholders
+
+    Rendering a batch formats each distinct placeholder over its column
+    slice, then fills the pattern row by row with `map(str.format, ...)`;
+    the template text is never re-scanned per customer.
+    """
+
+    def __init__(self, source: str):
+        self.source = source
+        self.placeholders: List[Placeholder] = []
+        slots: Dict[Tuple[str, str, str], int] = {}
+        pattern, end = [], 0
+        for match in PLACEHOLDER_PATTERN.finditer(source):
+            field, kind, default = match.group(1), match.group(2) or "str", (match.group(3) or "").strip()
+            key = (field, kind, default)
+            if key not in slots:
+                slots[key] = len(self.placeholders)
+                self.placeholders.append(Placeholder(field, kind, default))
+            pattern.append(self._escape(source[end:match.start()]))
+            pattern.append(f"{{{slots[key]}}}")
+            end = match.end()
+        pattern.append(self._escape(source[end:]))
+        self._fill = "".join(pattern).format
+
+    @staticmethod
+    def _escape(literal: str) -> str:
+        return literal.replace("{", "{{").replace("}", "}}")
+
+    @property
+    def fields(self) -> List[str]:
+        return list(dict.fromkeys(placeholder.field for placeholder in self.placeholders))
+
+    def render(self, values: Mapping[str, Any]) -> str:
+        """Render one customer"""
+        return self.render_columns({field: [values.get(field)] for field in self.fields}, 0, 1)[0]
+
+    def render_columns(self, columns: Mapping[str, Sequence[Any]], start: int, end: int) -> List[str]:
+        """Render rows start..end of parallel per-field columns"""
+        if not self.placeholders:
+            return [self.source] * (end - start)
+        formatted = [placeholder.format_column(columns[placeholder.field][start:end]) for placeholder in self.placeholders]
+        return list(map(self._fill, *formatted))
+
+
+@functools.lru_cache(maxsize=1024)
+def compile_template(source: str) -> CompiledTemplate:
+    """Compile a template, reusing the compiled form of any text seen before"""
+    return CompiledTemplate(source)
+
+
+class VariantRenderer:
+    """A MessageVariant's subject and content compiled for per-customer rendering"""
+
+    def __init__(self, subject: Optional[str], content: str):
+        self.subject = compile_template(subject or "")
+        self.content = compile_template(content)
+
+    @property
+    def fields(self) -> List[str]:
+        return list(dict.fromkeys(self.subject.fields + self.content.fields))
+
+    def iter_rendered(
+        self,
+        customer_ids: Sequence[str],
+        columns: Mapping[str, Sequence[Any]],
+        chunk_size: int = 10000
+    ) -> Iterator[List[Tuple[str, str, str]]]:
+        """
+        Generator of (customer_id, subject, content) rows, one list per chunk of customers
+
+        `columns` maps each placeholder field to one value per customer;
+        unused columns are ignored. Missing or mis-sized columns raise
+        ValueError here, before anything is rendered; a value that does not
+        fit its placeholder type raises when its chunk is rendered. Only one
+        chunk of messages is held at a time, so the output can be written
+        out as it is produced.
+        """
+        missing = [field for field in self.fields if field not in columns]
+        if missing:
+            raise ValueError(f"Missing columns for placeholders: {missing}")
+        for field in self.fields:
+            if len(columns[field]) != len(customer_ids):
+                raise ValueError(
+                    f"Column '{field}' has {len(columns[field])} values, expected {len(customer_ids)}"
+                )
+        return self._chunks(customer_ids, columns, chunk_size)
+
+    def _chunks(
+        self,
+        customer_ids: Sequence[str],
+        columns: Mapping[str, Sequence[Any]],
+        chunk_size: int
+    ) -> Iterator[List[Tuple[str, str, str]]]:
+        for start in range(0, len(customer_ids), chunk_size):
+            end = min(start + chunk_size, len(customer_ids))
+            subjects = self.subject.render_columns(columns, start, end)
+            contents = self.content.render_columns(columns, start, end)
+            yield list(zip(customer_ids[start:end], subjects, contents))
@@ -0,0 +1,499 @@
+"""Exact in-memory vector index over normalized float32 embeddings"""
+import logging
+import mmap
+import os
+import tempfile
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+from sklearn.cluster import MiniBatchKMeans
+
+logger = logging.getLogger(__name__)
+
+VECTOR_DTYPE = np.float32
+# Documents scored per matmul block; bounds the (queries x block) score buffer
+SEARCH_BLOCK_ROWS = 262144
+QUANTIZED_DTYPES = {"float16": np.float16, "int8": np.int8}
+# Quantized codes are widened to float32 per block; keeps that copy small
+QUANTIZED_BLOCK_ROWS = 16384
+# IVF: rows needed before the quantizer is trained / sampled for training
+IVF_TRAIN_ROWS_PER_LIST = 39
+IVF_TRAIN_SAMPLE_ROWS_PER_LIST = 256
+
+
+def normalize_rows(vectors: np.ndarray) -> np.ndarray:
+    """Return float32 rows scaled to unit L2 norm (zero rows stay zero)"""
+    vectors = np.asarray(vectors, dtype=VECTOR_DTYPE)
+    if vectors.ndim == 1:
+        vectors = vectors[None, :]
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.maximum(norms, np.finfo(VECTOR_DTYPE).tiny)
+
+
+def top_k_rows(scores: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Column indices and values of the k largest entries of each row, best first
+
+    Uses argpartition so only the k winners are sorted, not the whole row.
+    """
+    k = min(k, scores.shape[1])
+    if k == 0:
+        empty = np.empty((scores.shape[0], 0))
+        return empty.astype(np.int64), empty.astype(scores.dtype)
+    if k < scores.shape[1]:
+        part = np.argpartition(scores, -k, axis=1)[:, -k:]
+    else:
+        part = np.broadcast_to(np.arange(scores.shape[1]), scores.shape)
+    part_scores = np.take_along_axis(scores, part, axis=1)
+    order = np.argsort(-part_scores, axis=1, kind="stable")
+    return np.take_along_axis(part, order, axis=1), np.take_along_axis(part_scores, order, axis=1)
+
+
+def is_member(sorted_set: np.ndarray, values: np.ndarray) -> np.ndarray:
+    """Boolean mask of `values` present in the sorted array `sorted_set`"""
+    if not len(sorted_set):
+        return np.zeros(len(values), dtype=bool)
+    found = np.searchsorted(sorted_set, values)
+    return sorted_set[np.minimum(found, len(sorted_set) - 1)] == values
+
+
+class VectorIndex:
+    """
+    Brute-force cosine index backed by one contiguous float32 matrix
+
+    Rows are normalized on insert so scoring is a plain inner product. The
+    matrix grows by doubling, so appends are amortized O(1) copies, and a
+    batch of queries is scored with one matmul per block of documents.
+    """
+
+    storage_dtype = VECTOR_DTYPE
+    block_rows: Optional[int] = None  # SEARCH_BLOCK_ROWS when unset
+
+    def __init__(self, dim: Optional[int] = None, capacity: int = 1024):
+        self.dim = dim
+        self.size = 0
+        self._matrix = np.empty((capacity, dim or 0), dtype=self.storage_dtype)
+
+    def __len__(self) -> int:
+        return self.size
+
+    @property
+    def vectors(self) -> np.ndarray:
+        """View of the stored (normalized) rows"""
+        return self._matrix[:self.size]
+
+    def _reserve(self, rows: int):
+        if self.size + rows <= len(self._matrix):
+            return
+        capacity = max(len(self._matrix) * 2, self.size + rows)
+        grown = np.empty((capacity, self.dim), dtype=self.storage_dtype)
+        grown[:self.size] = self._matrix[:self.size]
+        self._matrix = grown
+
+    def _write(self, start: int, vectors: np.ndarray):
+        """Store normalized rows at positions start, start + 1, ..."""
+        self._matrix[start:start + len(vectors)] = vectors
+
+    def _block_scores(self, queries: np.ndarray, matrix: np.ndarray, rows) -> np.ndarray:
+        """(num_queries, rows) similarities for a slice or index array of rows"""
+        return queries @ matrix[rows].T
+
+    def export(self) -> Tuple[Dict[str, Any], Dict[str, Any]]:
+        """
+        Parameters and arrays describing the stored rows, for snapshots
+
+        Array values are an ndarray or a list of ndarrays to concatenate
+        along the first axis.
+        """
+        return {"kind": "exact", "storage": "float32", "dim": self.dim}, {"vectors": self.vectors}
+
+    @classmethod
+    def restore(cls, params: Dict[str, Any], arrays: Dict[str, np.ndarray]) -> "VectorIndex":
+        """
+        Rebuild an index from `export` output, typically read-only memmaps
+
+        The restored matrix has no spare capacity, so the first append copies
+        it into private memory and the mapped pages are never written.
+        """
+        index = cls(dim=params["dim"], capacity=0)
+        index._adopt(arrays)
+        return index
+
+    def _adopt(self, arrays: Dict[str, np.ndarray]):
+        self._matrix = arrays["vectors"]
+        self.size = len(self._matrix)
+
+    def add(self, vectors: np.ndarray) -> np.ndarray:
+        """Append embeddings; returns their row positions"""
+        vectors = normalize_rows(vectors)
+        if self.dim is None:
+            self.dim = vectors.shape[1]
+            self._matrix = np.empty((len(self._matrix), self.dim), dtype=self.storage_dtype)
+        if vectors.shape[1] != self.dim:
+            raise ValueError(f"Expected {self.dim}-dim embeddings, got {vectors.shape[1]}")
+        self._reserve(len(vectors))
+        start = self.size
+        self._write(start, vectors)
+        self.size += len(vectors)
+        return np.arange(start, self.size)
+
+    def truncate(self, size: int):
+        """Forget rows at position `size` or later; their storage is reused by later appends"""
+        self.size = min(self.size, size)
+
+    def search(
+        self,
+        queries: np.ndarray,
+        top_k: int,
+        candidates: Optional[np.ndarray] = None,
+        limit: Optional[int] = None
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Exact top-k by cosine similarity for a batch of queries
+
+        `candidates` (sorted positions, e.g. from a metadata pre-filter)
+        restricts scoring to those rows, and `limit` to rows below that
+        position (rows appended but not yet published). Returns (positions,
+        scores), each (num_queries, min(top_k, rows scored)), best first.
+        """
+        queries = normalize_rows(queries)
+        # Snapshot so concurrent appends (which only write past `size` or
+        # into a new matrix) cannot change what this search sees
+        matrix, size = self._matrix, self.size
+        if limit is not None:
+            size = min(size, limit)
+        if candidates is not None:
+            candidates = candidates[:np.searchsorted(candidates, size)]
+        total = size if candidates is None else len(candidates)
+        k = min(top_k, total)
+        best_positions = np.empty((len(queries), 0), dtype=np.int64)
+        best_scores = np.empty((len(queries), 0), dtype=VECTOR_DTYPE)
+        block_rows = self.block_rows or SEARCH_BLOCK_ROWS
+        for start in range(0, total, block_rows):
+            end = min(start + block_rows, total)
+            if candidates is None:
+                positions, scores = top_k_rows(self._block_scores(queries, matrix, slice(start, end)), k)
+                positions += start
+            else:
+                block_positions = candidates[start:end]
+                positions, scores = top_k_rows(self._block_scores(queries, matrix, block_positions), k)
+                positions = block_positions[positions]
+            # Merge this block's winners with the running top-k
+            merged_positions = np.concatenate([best_positions, positions], axis=1)
+            merged_scores = np.concatenate([best_scores, scores], axis=1)
+            keep, best_scores = top_k_rows(merged_scores, k)
+            best_positions = np.take_along_axis(merged_positions, keep, axis=1)
+        return best_positions, best_scores
+
+
+class QuantizedVectorIndex(VectorIndex):
+    """
+    Exact-scan index over float16 or int8 codes, re-ranked in float32
+
+    The scan runs over the compact codes (2 or 1 bytes per dimension instead
+    of 4). Each query's `rerank_factor * top_k` best candidates are then
+    re-scored exactly against the float32 rows, which are spooled to disk
+    and read back through a memmap, so they cost page cache only for the
+    shortlisted rows. int8 codes use a per-row symmetric scale.
+    """
+
+    block_rows = QUANTIZED_BLOCK_ROWS
+
+    def __init__(
+        self,
+        storage: str = "int8",
+        rerank_factor: int = 4,
+        dim: Optional[int] = None,
+        capacity: int = 1024
+    ):
+        if storage not in QUANTIZED_DTYPES:
+            raise ValueError(f"Unsupported vector storage: {storage}")
+        self.storage = storage
+        self.storage_dtype = QUANTIZED_DTYPES[storage]
+        self.rerank_factor = rerank_factor
+        super().__init__(dim=dim, capacity=capacity)
+        self._scales = np.empty(capacity, dtype=VECTOR_DTYPE)
+        # Rows below _base_size come from a snapshot; later ones are spooled
+        self._base_originals = np.empty((0, dim or 0), dtype=VECTOR_DTYPE)
+        self._base_size = 0
+        self._originals_file = tempfile.TemporaryFile()
+        self._originals: Optional[np.ndarray] = None
+
+    def _reserve(self, rows: int):
+        super()._reserve(rows)
+        if len(self._scales) < len(self._matrix):
+            grown = np.empty(len(self._matrix), dtype=VECTOR_DTYPE)
+            grown[:self.size] = self._scales[:self.size]
+            self._scales = grown
+
+    def _write(self, start: int, vectors: np.ndarray):
+        if self.storage == "int8":
+            scales = np.maximum(np.abs(vectors).max(axis=1), np.finfo(VECTOR_DTYPE).tiny) / 127.0
+            self._scales[start:start + len(vectors)] = scales
+            self._matrix[start:start + len(vectors)] = np.rint(vectors / scales[:, None])
+        else:
+            self._matrix[start:start + len(vectors)] = vectors
+        # Positional writes and fd-based maps never move the shared file offset,
+        # so a search remapping on another thread cannot misplace a batch
+        data = memoryview(np.ascontiguousarray(vectors, dtype=VECTOR_DTYPE)).cast("B")
+        offset = (start - self._base_size) * self.dim * VECTOR_DTYPE().itemsize
+        while data:
+            written = os.pwrite(self._originals_file.fileno(), data, offset)
+            data, offset = data[written:], offset + written
+        self._originals = None  # remap on next read
+
+    def _block_scores(self, queries: np.ndarray, matrix: np.ndarray, rows) -> np.ndarray:
+        scores = queries @ matrix[rows].astype(VECTOR_DTYPE).T
+        if self.storage == "int8":
+            scores *= self._scales[rows]
+        return scores
+
+    @property
+    def originals(self) -> np.ndarray:
+        """Full-precision rows spooled since construction (or restore), memory-mapped"""
+        spooled = self.size - self._base_size
+        if self._originals is None or len(self._originals) < spooled:
+            if not spooled:
+                return np.empty((0, self.dim or 0), dtype=VECTOR_DTYPE)
+            mapped = mmap.mmap(
+                self._originals_file.fileno(), spooled * self.dim * VECTOR_DTYPE().itemsize, access=mmap.ACCESS_READ
+            )
+            self._originals = np.frombuffer(mapped, dtype=VECTOR_DTYPE).reshape(spooled, self.dim)
+        return self._originals
+
+    def original_rows(self, positions: np.ndarray) -> np.ndarray:
+        """Full-precision normalized rows at the given positions"""
+        if not self._base_size:
+            return self.originals[positions]
+        rows = np.empty((len(positions), self.dim), dtype=VECTOR_DTYPE)
+        base = positions < self._base_size
+        rows[base] = self._base_originals[positions[base]]
+        if not base.all():
+            rows[~base] = self.originals[positions[~base] - self._base_size]
+        return rows
+
+    def export(self) -> Tuple[Dict[str, Any], Dict[str, Any]]:
+        params = {
+            "kind": "exact",
+            "storage": self.storage,
+            "dim": self.dim,
+            "rerank_factor": self.rerank_factor
+        }
+        arrays = {
+            "vectors": self.vectors,
+            "scales": self._scales[:self.size],
+            "originals": [self._base_originals, self.originals[:self.size - self._base_size]]
+        }
+        return params, arrays
+
+    @classmethod
+    def restore(cls, params: Dict[str, Any], arrays: Dict[str, np.ndarray]) -> "QuantizedVectorIndex":
+        index = cls(storage=params["storage"], rerank_factor=params["rerank_factor"], dim=params["dim"], capacity=0)
+        index._adopt(arrays)
+        index._scales = arrays["scales"]
+        index._base_originals = arrays["originals"]
+        index._base_size = index.size
+        return index
+
+    @property
+    def nbytes(self) -> int:
+        """Resident bytes of the scanned codes (and int8 scales)"""
+        codes = self.size * self.dim * self._matrix.itemsize
+        return codes + (self.size * self._scales.itemsize if self.storage == "int8" else 0)
+
+    def search(
+        self,
+        queries: np.ndarray,
+        top_k: int,
+        candidates: Optional[np.ndarray] = None,
+        limit: Optional[int] = None
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """Approximate scan over the codes, then exact re-rank of the shortlist"""
+        shortlist, _ = super().search(queries, top_k * self.rerank_factor, candidates, limit)
+        if not shortlist.shape[1]:
+            return shortlist, np.empty(shortlist.shape, dtype=VECTOR_DTYPE)
+        queries = normalize_rows(queries)
+        exact = np.einsum("qkd,qd->qk", self.original_rows(shortlist.ravel()).reshape(*shortlist.shape, -1), queries)
+        best, scores = top_k_rows(exact, top_k)
+        return np.take_along_axis(shortlist, best, axis=1), scores
+
+
+class IVFIndex(VectorIndex):
+    """
+    Inverted-file approximate index: a coarse k-means quantizer over the rows
+
+    Every row is filed under its nearest of `nlist` centroids; a query only
+    scores the rows in its `nprobe` closest lists, trading recall for
+    latency. Until `train_size` rows exist (enough for k-means to place
+    `nlist` centroids) searches fall back to the exact scan. Rows added after
+    training are filed incrementally, the centroids are not refitted.
+    """
+
+    def __init__(
+        self,
+        nlist: int = 1024,
+        nprobe: int = 16,
+        dim: Optional[int] = None,
+        capacity: int = 1024,
+        train_size: Optional[int] = None,
+        random_state: int = 42
+    ):
+        super().__init__(dim=dim, capacity=capacity)
+        self.nlist = nlist
+        self.nprobe = nprobe
+        self.train_size = train_size or nlist * IVF_TRAIN_ROWS_PER_LIST
+        self.random_state = random_state
+        self.centroids: Optional[np.ndarray] = None
+        self._lists: List[np.ndarray] = []
+        self._list_sizes = np.zeros(nlist, dtype=np.int64)
+
+    @property
+    def is_trained(self) -> bool:
+        return self.centroids is not None
+
+    def add(self, vectors: np.ndarray) -> np.ndarray:
+        """Append embeddings, training the quantizer once enough rows exist"""
+        positions = super().add(vectors)
+        if self.is_trained:
+            self._file(positions)
+        elif self.size >= self.train_size:
+            self.train()
+        return positions
+
+    def train(self):
+        """Fit the coarse centroids on (a sample of) the stored rows and file every row"""
+        rng = np.random.default_rng(self.random_state)
+        sample_size = min(self.size, self.nlist * IVF_TRAIN_SAMPLE_ROWS_PER_LIST)
+        sample = self.vectors[np.sort(rng.choice(self.size, size=sample_size, replace=False))]
+        kmeans = MiniBatchKMeans(
+            n_clusters=self.nlist,
+            random_state=self.random_state,
+            n_init=1,
+            batch_size=4096
+        )
+        kmeans.fit(sample)
+        centroids = normalize_rows(kmeans.cluster_centers_)
+        lists = [np.empty(0, dtype=np.int64) for _ in range(self.nlist)]
+        sizes = np.zeros(self.nlist, dtype=np.int64)
+        self._file_into(np.arange(self.size), centroids, lists, sizes)
+        # Searches on other threads go by `is_trained`, so the centroids are
+        # published last, once every row is filed
+        self._lists, self._list_sizes = lists, sizes
+        self.centroids = centroids
+        logger.info(f"Trained IVF quantizer with {self.nlist} lists on {sample_size} rows")
+
+    def _file(self, positions: np.ndarray):
+        """Append row positions to the inverted list of their nearest centroid"""
+        self._file_into(positions, self.centroids, self._lists, self._list_sizes)
+
+    def _file_into(
+        self,
+        positions: np.ndarray,
+        centroids: np.ndarray,
+        lists: List[np.ndarray],
+        sizes: np.ndarray
+    ):
+        matrix = self._matrix
+        assigned = np.concatenate([
+            np.argmax(matrix[positions[start:start + SEARCH_BLOCK_ROWS]] @ centroids.T, axis=1)
+            for start in range(0, len(positions), SEARCH_BLOCK_ROWS)
+        ])
+        order = np.argsort(assigned, kind="stable")
+        list_ids, starts = np.unique(assigned[order], return_index=True)
+        for list_id, chunk in zip(list_ids.tolist(), np.split(positions[order], starts[1:])):
+            size = sizes[list_id]
+            inverted = lists[list_id]
+            if size + len(chunk) > len(inverted):
+                grown = np.empty(max(2 * len(inverted), size + len(chunk)), dtype=np.int64)
+                grown[:size] = inverted[:size]
+                lists[list_id] = inverted = grown
+            inverted[size:size + len(chunk)] = chunk
+            # Publish the new size only once its positions are written
+            sizes[list_id] = size + len(chunk)
+
+    def truncate(self, size: int):
+        super().truncate(size)
+        if self.is_trained:
+            for list_id, inverted in enumerate(self._lists):
+                # Lists are filed in position order, so they are sorted
+                self._list_sizes[list_id] = np.searchsorted(inverted[:self._list_sizes[list_id]], size)
+
+    def export(self) -> Tuple[Dict[str, Any], Dict[str, Any]]:
+        params = {
+            "kind": "ivf",
+            "storage": "float32",
+            "dim": self.dim,
+            "nlist": self.nlist,
+            "nprobe": self.nprobe,
+            "train_size": self.train_size,
+            "random_state": self.random_state
+        }
+        arrays: Dict[str, Any] = {"vectors": self.vectors}
+        if self.is_trained:
+            arrays["centroids"] = self.centroids
+            arrays["list_positions"] = [
+                inverted[:size] for inverted, size in zip(self._lists, self._list_sizes.tolist())
+            ]
+            arrays["list_offsets"] = np.concatenate([[0], np.cumsum(self._list_sizes)])
+        return params, arrays
+
+    @classmethod
+    def restore(cls, params: Dict[str, Any], arrays: Dict[str, np.ndarray]) -> "IVFIndex":
+        index = cls(
+            nlist=params["nlist"],
+            nprobe=params["nprobe"],
+            dim=params["dim"],
+            capacity=0,
+            train_size=params["train_size"],
+            random_state=params["random_state"]
+        )
+        index._adopt(arrays)
+        if "centroids" in arrays:
+            index.centroids = arrays["centroids"]
+            offsets = arrays["list_offsets"]
+            # Views into the mapped file; appending to a list copies it first
+            index._lists = [arrays["list_positions"][offsets[i]:offsets[i + 1]] for i in range(index.nlist)]
+            index._list_sizes = np.diff(offsets).astype(np.int64)
+        return index
+
+    def search(
+        self,
+        queries: np.ndarray,
+        top_k: int,
+        candidates: Optional[np.ndarray] = None,
+        limit: Optional[int] = None,
+        nprobe: Optional[int] = None
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Approximate top-k: score only the rows in each query's nprobe closest lists
+
+        With `candidates`, a filter that leaves fewer rows than the probed
+        lists would hold is answered exactly over the candidates; otherwise
+        the probed lists are masked down to the candidates. Returns
+        (positions, scores) padded with -1 / -inf when fewer than top_k
+        rows qualify.
+        """
+        nprobe = min(nprobe or self.nprobe, self.nlist)
+        if not self.is_trained or (
+            candidates is not None and len(candidates) * self.nlist <= self.size * nprobe
+        ):
+            return super().search(queries, top_k, candidates, limit)
+        queries = normalize_rows(queries)
+        limit = self.size if limit is None else min(limit, self.size)
+        k = min(top_k, limit)
+        probes, _ = top_k_rows(queries @ self.centroids.T, nprobe)
+
+        positions = np.full((len(queries), k), -1, dtype=np.int64)
+        scores = np.full((len(queries), k), -np.inf, dtype=VECTOR_DTYPE)
+        for row, (query, probe) in enumerate(zip(queries, probes)):
+            probed = np.concatenate([
+                self._lists[list_id][:self._list_sizes[list_id]] for list_id in probe.tolist()
+            ])
+            probed = probed[probed < limit]
+            if candidates is not None:
+                probed = probed[is_member(candidates, probed)]
+            # Read the current matrix: every filed position is already in it
+            best, best_scores = top_k_rows((self._matrix[probed] @ query)[None, :], k)
+            positions[row, :best.shape[1]] = probed[best[0]]
+            scores[row, :best.shape[1]] = best_scores[0]
+        return positions, scores
@@ -0,0 +1,71 @@
+"""
+Recall@k and QPS of the IVF approximate index against exact search
+
+Usage (from backend/):
+    python -m benchmarks.bench_ann --documents 200000 --dim 384 --nlist 1024
+"""
+import argparse
+import time
+
+import numpy as np
+
+from app.utils.vector_index import IVFIndex, VECTOR_DTYPE, VectorIndex, normalize_rows
+
+
+def make_corpus(documents: int, dim: int, topics: int, seed: int = 0) -> np.ndarray:
+    """Embeddings scattered around `topics` directions, like a real corpus"""
+    rng = np.random.default_rng(seed)
+    centers = normalize_rows(rng.standard_normal((topics, dim), dtype=VECTOR_DTYPE))
+    labels = rng.integers(0, topics, size=documents)
+    noise = rng.standard_normal((documents, dim), dtype=VECTOR_DTYPE) * (0.6 / np.sqrt(dim))
+    return centers[labels] + noise
+
+
+def timed_search(index, queries, top_k, batch_size, **kwargs):
+    """Run all queries in batches; returns (positions, queries per second)"""
+    started = time.perf_counter()
+    positions = np.concatenate([
+        index.search(queries[start:start + batch_size], top_k, **kwargs)[0]
+        for start in range(0, len(queries), batch_size)
+    ])
+    return positions, len(queries) / (time.perf_counter() - started)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--documents", type=int, default=200000)
+    parser.add_argument("--dim", type=int, default=384)
+    parser.add_argument("--topics", type=int, default=2000)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--top-k", type=int, default=10)
+    parser.add_argument("--batch-size", type=int, default=16)
+    parser.add_argument("--nlist", type=int, default=1024)
+    parser.add_argument("--nprobe", type=int, nargs="*", default=[1, 4, 16, 64])
+    args = parser.parse_args()
+
+    corpus = make_corpus(args.documents, args.dim, args.topics)
+    rng = np.random.default_rng(1)
+    queries = corpus[rng.choice(args.documents, size=args.queries, replace=False)]
+    queries = queries + rng.standard_normal(queries.shape, dtype=VECTOR_DTYPE) * (0.3 / np.sqrt(args.dim))
+
+    exact = VectorIndex(dim=args.dim, capacity=args.documents)
+    exact.add(corpus)
+    started = time.perf_counter()
+    ivf = IVFIndex(nlist=args.nlist, dim=args.dim, capacity=args.documents)
+    ivf.add(corpus)
+    print(f"documents={args.documents} dim={args.dim} nlist={args.nlist} "
+          f"train_s={time.perf_counter() - started:.1f}")
+
+    truth, exact_qps = timed_search(exact, queries, args.top_k, args.batch_size)
+    print(f"{'index':<14}{'recall@' + str(args.top_k):>10}{'qps':>10}")
+    print(f"{'exact':<14}{1.0:>10.3f}{exact_qps:>10.0f}")
+    for nprobe in args.nprobe:
+        found, qps = timed_search(ivf, queries, args.top_k, args.batch_size, nprobe=nprobe)
+        recall = np.mean([
+            len(set(f.tolist()) & set(t.tolist())) / args.top_k for f, t in zip(found, truth)
+        ])
+        print(f"{'ivf/' + str(nprobe):<14}{recall:>10.3f}{qps:>10.0f}")
+
+
+if __name__ == "__main__":
+    main()
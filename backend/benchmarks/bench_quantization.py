@@ -0,0 +1,61 @@
+"""
+Memory, latency and recall of float32 vs float16 / int8 quantized vector storage
+
+Usage (from backend/):
+    python -m benchmarks.bench_quantization --documents 200000 --dim 768
+"""
+import argparse
+import time
+
+import numpy as np
+
+from app.utils.vector_index import QuantizedVectorIndex, VECTOR_DTYPE, VectorIndex
+from benchmarks.bench_ann import make_corpus
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--documents", type=int, default=200000)
+    parser.add_argument("--dim", type=int, default=768)
+    parser.add_argument("--topics", type=int, default=2000)
+    parser.add_argument("--queries", type=int, default=128)
+    parser.add_argument("--top-k", type=int, default=10)
+    parser.add_argument("--batch-size", type=int, default=16)
+    parser.add_argument("--rerank-factor", type=int, nargs="*", default=[1, 4])
+    args = parser.parse_args()
+
+    corpus = make_corpus(args.documents, args.dim, args.topics)
+    rng = np.random.default_rng(1)
+    queries = corpus[rng.choice(args.documents, size=args.queries, replace=False)]
+    queries = queries + rng.standard_normal(queries.shape, dtype=VECTOR_DTYPE) * (0.3 / np.sqrt(args.dim))
+
+    indexes = [("float32", VectorIndex(dim=args.dim, capacity=args.documents))]
+    for storage in ("float16", "int8"):
+        for factor in args.rerank_factor:
+            indexes.append((
+                f"{storage}/rerank{factor}",
+                QuantizedVectorIndex(storage, rerank_factor=factor, dim=args.dim, capacity=args.documents)
+            ))
+
+    print(f"documents={args.documents} dim={args.dim} top_k={args.top_k} batch={args.batch_size}")
+    print(f"{'storage':<18}{'resident_mb':>12}{'p50_ms':>10}{'recall@' + str(args.top_k):>12}")
+    truth = None
+    for name, index in indexes:
+        for start in range(0, args.documents, 50000):
+            index.add(corpus[start:start + 50000])
+        latencies, found = [], []
+        for start in range(0, args.queries, args.batch_size):
+            started = time.perf_counter()
+            positions, _ = index.search(queries[start:start + args.batch_size], args.top_k)
+            latencies.append(time.perf_counter() - started)
+            found.append(positions)
+        found = np.concatenate(found)
+        truth = found if truth is None else truth
+        recall = np.mean([len(set(f.tolist()) & set(t.tolist())) / args.top_k for f, t in zip(found, truth)])
+        resident = index.nbytes if isinstance(index, QuantizedVectorIndex) else index.vectors.nbytes
+        print(f"{name:<18}{resident / 2**20:>12.1f}{np.median(latencies) * 1000:>10.1f}{recall:>12.3f}")
+        del index
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,51 @@
+"""
+Latency of exact vector search, one query per call vs batched queries
+
+Usage (from backend/):
+    python -m benchmarks.bench_retrieval --documents 200000 --dim 1536
+"""
+import argparse
+import time
+
+import numpy as np
+
+from app.utils.vector_index import VECTOR_DTYPE, VectorIndex
+
+
+def build_index(documents: int, dim: int, seed: int = 0) -> VectorIndex:
+    """Index random unit vectors, added in ingestion-sized batches"""
+    rng = np.random.default_rng(seed)
+    index = VectorIndex(dim=dim, capacity=documents)
+    for start in range(0, documents, 50000):
+        rows = min(50000, documents - start)
+        index.add(rng.standard_normal((rows, dim), dtype=VECTOR_DTYPE))
+    return index
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--documents", type=int, default=200000)
+    parser.add_argument("--dim", type=int, default=1536)
+    parser.add_argument("--queries", type=int, default=256)
+    parser.add_argument("--top-k", type=int, default=10)
+    parser.add_argument("--batch-sizes", type=int, nargs="*", default=[1, 16, 64])
+    args = parser.parse_args()
+
+    index = build_index(args.documents, args.dim)
+    queries = np.random.default_rng(1).standard_normal((args.queries, args.dim), dtype=VECTOR_DTYPE)
+    print(f"documents={args.documents} dim={args.dim} top_k={args.top_k}")
+    print(f"{'batch':>6}{'p50_ms':>10}{'p99_ms':>10}{'qps':>10}")
+    for batch_size in args.batch_sizes:
+        latencies = []
+        started = time.perf_counter()
+        for start in range(0, args.queries, batch_size):
+            call_started = time.perf_counter()
+            index.search(queries[start:start + batch_size], args.top_k)
+            latencies.append(time.perf_counter() - call_started)
+        elapsed = time.perf_counter() - started
+        p50, p99 = np.percentile(latencies, [50, 99]) * 1000
+        print(f"{batch_size:>6}{p50:>10.1f}{p99:>10.1f}{args.queries / elapsed:>10.0f}")
+
+
+if __name__ == "__main__":
+    main()
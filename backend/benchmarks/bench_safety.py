@@ -0,0 +1,80 @@
+"""
+PII / policy scanning of large texts: single-pass compiled scanner vs. one regex pass per kind
+
+Usage (from backend/):
+    python -m benchmarks.bench_safety --megabytes 20
+"""
+import argparse
+import re
+import time
+
+import numpy as np
+
+from app.utils.config import settings
+from app.utils.pii_scanner import PIIScanner, luhn_valid
+
+WORDS = (
+    "hi there your loyalty points are waiting shop the seasonal sale with member pricing "
+    "order 12345 ships soon reply to unsubscribe at any time thanks for being a customer"
+).split()
+SAMPLES = [
+    "jane.doe@example.com", "(555) 123-4567", "+44 20 7946 0958", "4111 1111 1111 1111",
+    "4111 1111 1111 1112", "123-45-6789", "Risk-Free", "guaranteed income",
+]
+
+# The straightforward alternative: an independent pattern per kind, each run over the whole text
+PER_KIND = {
+    "email": r"(?<![\w.%+-])[\w.%+-]+@[A-Za-z0-9-]+(?:\.[A-Za-z0-9-]+)*\.[A-Za-z]{2,}",
+    "ssn": r"(?<![\w.%+-])(?!000|666|9\d\d)\d{3}-(?!00)\d{2}-(?!0000)\d{4}(?![\w-])",
+    "card": r"(?<![\w.%+-])\d(?:[ -]?\d){12,18}(?![\w-])",
+    "phone": (
+        r"(?<![\w.%+-])(?:\+\d{1,3}(?:[ .-]?\d{2,4}){2,4}|(?:\(\d{3}\) ?|\d{3}[ .-]?)\d{3}[ .-]?\d{4})(?![\w-])"
+    ),
+}
+
+
+def per_kind_scan(patterns, text):
+    findings = []
+    for kind, pattern in patterns.items():
+        for match in pattern.finditer(text):
+            if kind == "card" and not luhn_valid(match.group()):
+                continue
+            findings.append((match.start(), kind))
+    return findings
+
+
+def build_text(megabytes: float, rng) -> str:
+    """Prose with a PII or policy sample roughly every 500 words"""
+    words = np.array(WORDS + SAMPLES, dtype=object)
+    weights = np.array([1.0] * len(WORDS) + [len(WORDS) / 500 / len(SAMPLES)] * len(SAMPLES))
+    count = int(megabytes * 1e6 / 6)
+    return " ".join(rng.choice(words, size=count, p=weights / weights.sum()).tolist())
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--megabytes", type=float, default=20.0)
+    args = parser.parse_args()
+
+    text = build_text(args.megabytes, np.random.default_rng(0))
+    scanner = PIIScanner(settings.SAFETY_POLICY_TERMS)
+    policy = r"(?<![\w.%+-])(?i:" + "|".join(map(re.escape, settings.SAFETY_POLICY_TERMS)) + r")(?!\w)"
+    patterns = {kind: re.compile(pattern) for kind, pattern in {**PER_KIND, "policy_term": policy}.items()}
+
+    started = time.perf_counter()
+    findings = scanner.scan(text)
+    single = time.perf_counter() - started
+
+    started = time.perf_counter()
+    baseline = per_kind_scan(patterns, text)
+    separate = time.perf_counter() - started
+
+    megabytes = len(text) / 1e6
+    print(f"text={megabytes:.1f}MB")
+    print(f"{'scanner':<22}{'seconds':>10}{'MB/s':>10}{'findings':>10}")
+    print(f"{'single pass':<22}{single:>10.2f}{megabytes / single:>10.1f}{len(findings):>10}")
+    print(f"{'one pass per kind':<22}{separate:>10.2f}{megabytes / separate:>10.1f}{len(baseline):>10}")
+
+
+if __name__ == "__main__":
+    main()
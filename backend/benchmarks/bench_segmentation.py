@@ -0,0 +1,46 @@
+"""
+Fit time and peak memory of the registered clustering algorithms
+
+Usage (from backend/):
+    python -m benchmarks.bench_segmentation --rows 200000 --segments 8
+"""
+import argparse
+import time
+import tracemalloc
+
+import numpy as np
+
+from app.utils.clustering import CLUSTERING_ALGORITHMS, fit_segmentation
+from app.utils.features import FEATURE_DTYPE, FEATURE_NAMES
+
+
+def make_features(rows: int, segments: int, seed: int = 0) -> np.ndarray:
+    """Gaussian blobs in the segmentation feature space"""
+    rng = np.random.default_rng(seed)
+    centers = rng.normal(scale=5.0, size=(segments, len(FEATURE_NAMES)))
+    labels = rng.integers(0, segments, size=rows)
+    return (centers[labels] + rng.normal(size=(rows, len(FEATURE_NAMES)))).astype(FEATURE_DTYPE)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--rows", type=int, default=200000)
+    parser.add_argument("--segments", type=int, default=8)
+    parser.add_argument("--algorithms", nargs="*", default=list(CLUSTERING_ALGORITHMS))
+    args = parser.parse_args()
+
+    features = make_features(args.rows, args.segments)
+    print(f"rows={args.rows} segments={args.segments} features={features.shape[1]}")
+    print(f"{'algorithm':<18}{'fit_s':>10}{'peak_mb':>10}{'silhouette':>12}")
+    for algorithm in args.algorithms:
+        tracemalloc.start()
+        started = time.perf_counter()
+        result = fit_segmentation(features, args.segments, algorithm=algorithm)
+        elapsed = time.perf_counter() - started
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        print(f"{algorithm:<18}{elapsed:>10.2f}{peak / 2**20:>10.1f}{result.quality_score:>12.3f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,70 @@
+"""
+Retrieval startup cost: re-ingesting documents vs. memory-mapping a snapshot
+
+Usage (from backend/):
+    python -m benchmarks.bench_snapshot --documents 200000 --dim 768
+"""
+import argparse
+import asyncio
+import tempfile
+import time
+
+import numpy as np
+
+from app.agents.retrieval import RetrievalAgent, build_index
+from benchmarks.bench_ann import make_corpus
+
+WORDS = ["offer", "loyalty", "premium", "discount", "shipping", "bundle", "renewal", "sku-1042", "winter", "sale"]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--documents", type=int, default=200000)
+    parser.add_argument("--dim", type=int, default=768)
+    parser.add_argument("--topics", type=int, default=2000)
+    parser.add_argument("--storage", default="float32", choices=["float32", "float16", "int8"])
+    parser.add_argument("--batch-size", type=int, default=10000)
+    args = parser.parse_args()
+
+    corpus = make_corpus(args.documents, args.dim, args.topics)
+    rng = np.random.default_rng(2)
+    words = rng.integers(len(WORDS), size=(args.documents, 8))
+    with tempfile.TemporaryDirectory() as root:
+        agent = RetrievalAgent(
+            index=build_index("exact", args.storage), cache_dir=root, snapshot_dir=f"{root}/snapshots"
+        )
+        started = time.perf_counter()
+        for start in range(0, args.documents, args.batch_size):
+            asyncio.run(agent.add_documents([
+                {
+                    "content": " ".join(WORDS[w] for w in words[i]),
+                    "source": ["email", "sms", "push"][i % 3],
+                    "embedding": corpus[i]
+                }
+                for i in range(start, min(start + args.batch_size, args.documents))
+            ]))
+        ingest = time.perf_counter() - started
+
+        started = time.perf_counter()
+        summary = asyncio.run(agent.save_snapshot())
+        save = time.perf_counter() - started
+
+        restored = RetrievalAgent(cache_dir=root, snapshot_dir=f"{root}/snapshots")
+        started = time.perf_counter()
+        restored.load_snapshot()
+        load = time.perf_counter() - started
+        started = time.perf_counter()
+        restored.index.search(corpus[:1], 10)
+        restored.lexical_index.search("loyalty sku-1042", 10)
+        first_query = time.perf_counter() - started
+
+    print(f"documents={args.documents} dim={args.dim} storage={args.storage} snapshot={summary['version']}")
+    print(f"{'step':<28}{'seconds':>10}")
+    print(f"{'ingest (precomputed vectors)':<28}{ingest:>10.2f}")
+    print(f"{'save snapshot':<28}{save:>10.2f}")
+    print(f"{'load snapshot (mmap)':<28}{load:>10.2f}")
+    print(f"{'first query after load':<28}{first_query:>10.2f}")
+
+
+if __name__ == "__main__":
+    main()
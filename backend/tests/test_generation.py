@@ -0,0 +1,385 @@
+"""Tests for the generation agent and its LLM fan-out"""
+import asyncio
+import json
+import time
+from typing import Any, Dict
+
+import httpx
+import pytest
+from fastapi import FastAPI
+from fastapi.responses import StreamingResponse
+
+from app.agents.generation import GenerationAgent, TEMPLATES, parse_completion
+from app.models.schemas import GenerationRequest
+from app.routers import generation as generation_router
+from app.utils.azure_clients import AzureOpenAIClient
+from app.utils.rate_limit import TokenBucket
+from app.utils.result_cache import MemoryCache
+from app.utils.template_renderer import VariantRenderer, compile_template
+
+
+def completion_stand_in(delays: Dict[str, float] = None):
+    """
+    Local stand-in for the Azure OpenAI chat completions endpoint
+
+    Answers "Subject: <segment>" plus a body, whole or as streamed chunks,
+    after the delay of the first `delays` key found in the prompt, and
+    records the prompts and the peak number of requests in flight.
+    """
+    server = FastAPI()
+    server.state.prompts = []
+    server.state.in_flight = 0
+    server.state.peak = 0
+
+    @server.post("/openai/deployments/{deployment}/chat/completions")
+    async def chat_completions(deployment: str, body: Dict[str, Any]):
+        prompt = body["messages"][-1]["content"]
+        segment = prompt.split("customer segment ")[1].split(".")[0]
+        server.state.prompts.append(prompt)
+        server.state.in_flight += 1
+        server.state.peak = max(server.state.peak, server.state.in_flight)
+        delay = next((delay for key, delay in (delays or {}).items() if key in prompt), 0.02)
+        text = f"Subject: Hello {segment}\n\nOffer for {segment}."
+        if body.get("stream"):
+            async def chunks():
+                for word in text.split(" "):
+                    await asyncio.sleep(delay / 4)
+                    chunk = {
+                        "id": "chatcmpl-test",
+                        "object": "chat.completion.chunk",
+                        "created": 0,
+                        "model": deployment,
+                        "choices": [{"index": 0, "finish_reason": None, "delta": {"content": word + " "}}]
+                    }
+                    yield f"data: {json.dumps(chunk)}\n\n"
+                server.state.in_flight -= 1
+                yield "data: [DONE]\n\n"
+
+            return StreamingResponse(chunks(), media_type="text/event-stream")
+        await asyncio.sleep(delay)
+        server.state.in_flight -= 1
+        return {
+            "id": "chatcmpl-test",
+            "object": "chat.completion",
+            "created": 0,
+            "model": deployment,
+            "choices": [{
+                "index": 0,
+                "finish_reason": "stop",
+                "message": {"role": "assistant", "content": text}
+            }],
+            "usage": {"prompt_tokens": 40, "completion_tokens": 10, "total_tokens": 50}
+        }
+
+    return server
+
+
+def stand_in_agent(server, **kwargs) -> GenerationAgent:
+    client = AzureOpenAIClient(
+        "http://llm.test",
+        "test-key",
+        "chat",
+        http_client=httpx.AsyncClient(transport=httpx.ASGITransport(app=server)),
+        **kwargs
+    )
+    return GenerationAgent(client, result_cache=MemoryCache())
+
+
+def test_generate_messages_uses_completions():
+    """Each variant is one completion; subjects and token usage come from the LLM"""
+    server = completion_stand_in()
+    agent = stand_in_agent(server)
+    response = asyncio.run(agent.generate_messages(
+        GenerationRequest(segment_id="seg_1", context={"tier": "gold"}, variants=2)
+    ))
+    assert len(server.state.prompts) == 2
+    assert '{"tier": "gold"}' in server.state.prompts[0]
+    assert [variant.subject for variant in response.variants] == ["Hello seg_1", "Hello seg_1"]
+    assert response.variants[0].content == "Offer for seg_1."
+    assert response.generation_metadata["tokens_used"] == 100
+
+
+def test_generate_many_bounds_concurrency_and_yields_in_finish_order():
+    """Completions never exceed the concurrency limit and fast segments are yielded first"""
+    # seg_0 holds two of the three slots, so the ten fast completions
+    # queue through one; its delay must outlast them with room to spare
+    server = completion_stand_in(delays={"seg_0": 1.0})
+    agent = stand_in_agent(server, completion_concurrency=3)
+    requests = [GenerationRequest(segment_id=f"seg_{i}", context={}, variants=2) for i in range(6)]
+
+    async def collect():
+        return [(index, response) async for index, response in agent.generate_many(requests)]
+
+    results = asyncio.run(collect())
+    assert server.state.peak == 3
+    assert len(server.state.prompts) == 12
+    assert sorted(index for index, _ in results) == list(range(6))
+    assert results[-1][0] == 0  # the slow segment finishes last
+    assert all(response.segment_id == f"seg_{index}" for index, response in results)
+
+
+class CountingSlots:
+    """Completion slots that record how many are held at once"""
+
+    def __init__(self, limit: int):
+        self.semaphore = asyncio.Semaphore(limit)
+        self.held = self.peak = self.entered = 0
+
+    async def __aenter__(self):
+        await self.semaphore.acquire()
+        self.held += 1
+        self.entered += 1
+        self.peak = max(self.peak, self.held)
+        await asyncio.sleep(0)  # let other variants overlap
+
+    async def __aexit__(self, *exc_info):
+        self.held -= 1
+        self.semaphore.release()
+
+
+def test_generate_many_without_llm_is_bounded(monkeypatch):
+    """A large batch on the mock path keeps requests, tasks and completion slots within the limit"""
+    agent = GenerationAgent(AzureOpenAIClient("", "", "", completion_concurrency=4), result_cache=MemoryCache())
+    slots = CountingSlots(4)
+    agent.client.completion_slots = slots
+    requests = [GenerationRequest(segment_id=f"seg_{i}", context={}, variants=3) for i in range(50)]
+    state = {"running": 0, "peak": 0, "peak_tasks": 0}
+    generate_messages = agent.generate_messages
+
+    async def tracked(request):
+        state["running"] += 1
+        state["peak"] = max(state["peak"], state["running"])
+        try:
+            return await generate_messages(request)
+        finally:
+            state["peak_tasks"] = max(state["peak_tasks"], len(asyncio.all_tasks()))
+            state["running"] -= 1
+
+    monkeypatch.setattr(agent, "generate_messages", tracked)
+
+    async def collect():
+        return [index async for index, _ in agent.generate_many(requests)]
+
+    assert sorted(asyncio.run(collect())) == list(range(50))
+    assert slots.entered == 150 and slots.peak == 4
+    assert state["peak"] == 4
+    assert state["peak_tasks"] <= 1 + 4 * 4  # main task, workers and their variants
+
+
+def test_mock_completion_is_throttled():
+    """Without an endpoint, completions still hold a slot and settle against the token budget"""
+    client = AzureOpenAIClient("", "", "", completion_concurrency=1, completion_tokens_per_minute=6000)
+    slots = CountingSlots(1)
+    client.completion_slots = slots
+
+    async def run():
+        completion = await client.generate_completion("Hello there", max_tokens=100)
+        return completion, client.token_budget.tokens
+
+    completion, left = asyncio.run(run())
+    assert slots.entered == 1
+    assert 6000 - completion.total_tokens - 1 <= left < 6000
+
+
+def test_token_bucket_waits_for_refill():
+    """Once the minute's budget is spent, callers wait for it to refill"""
+    async def run():
+        bucket = TokenBucket(tokens_per_minute=6000)  # 100 tokens per second
+        started = time.perf_counter()
+        await bucket.acquire(6000)
+        burst = time.perf_counter() - started
+        reserved = await bucket.acquire(10)
+        bucket.settle(reserved, 4)
+        return burst, time.perf_counter() - started, bucket.tokens
+
+    burst, elapsed, left = asyncio.run(run())
+    assert burst < 0.05
+    assert elapsed >= 0.09
+    assert 5 <= left < 7  # the unused part of the reservation was returned
+
+
+def test_batch_endpoint_streams_results(client, monkeypatch):
+    """/batch streams one NDJSON result per request, failures included"""
+    server = completion_stand_in()
+    agent = stand_in_agent(server)
+    monkeypatch.setattr(generation_router, "generation_agent", agent)
+    requests = [{"segment_id": f"seg_{i}", "context": {}, "variants": 1} for i in range(3)]
+    response = client.post("/api/v1/generation/batch", json={"requests": requests})
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "application/x-ndjson"
+    lines = [json.loads(line) for line in response.text.splitlines()]
+    assert sorted(line["index"] for line in lines) == [0, 1, 2]
+    assert all(line["error"] is None for line in lines)
+    assert {line["response"]["variants"][0]["subject"] for line in lines} == {"Hello seg_0", "Hello seg_1", "Hello seg_2"}
+
+    original = agent.generate_messages
+
+    async def flaky(request):
+        if request.segment_id == "seg_1":
+            raise RuntimeError("quota exceeded")
+        return await original(request)
+
+    monkeypatch.setattr(agent, "generate_messages", flaky)
+    lines = [json.loads(line) for line in client.post(
+        "/api/v1/generation/batch", json={"requests": requests}
+    ).text.splitlines()]
+    errors = {line["segment_id"]: line["error"] for line in lines}
+    assert errors == {"seg_0": None, "seg_1": "quota exceeded", "seg_2": None}
+
+
+def test_parse_completion_falls_back_to_template_subject():
+    assert parse_completion("Subject: Hi\n\nBody text", TEMPLATES[0]) == ("Hi", "Body text")
+    assert parse_completion("  Just a body ", TEMPLATES[0]) == (TEMPLATES[0]["subject"], "Just a body")
+
+
+def parse_sse(text):
+    events = []
+    for block in text.strip().split("\n\n"):
+        fields = dict(line.split(": ", 1) for line in block.splitlines())
+        events.append((fields["event"], json.loads(fields["data"])))
+    return events
+
+
+def test_stream_endpoint_emits_tokens_then_variants(client, monkeypatch):
+    """Tokens and finished variants stream as SSE; the fast variant finishes first"""
+    server = completion_stand_in(delays={TEMPLATES[0]["subject"]: 0.4})
+    agent = stand_in_agent(server)
+    monkeypatch.setattr(generation_router, "generation_agent", agent)
+
+    response = client.post("/api/v1/generation/stream", json={"segment_id": "seg_7", "context": {}, "variants": 2})
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/event-stream")
+    events = parse_sse(response.text)
+
+    variants = [data for event, data in events if event == "variant"]
+    assert [variant["variant_index"] for variant in variants] == [1, 0]
+    assert all(variant["subject"] == "Hello seg_7" and variant["content"] == "Offer for seg_7." for variant in variants)
+    for variant in variants:
+        tokens = [data["text"] for event, data in events if event == "token" and data["variant_index"] == variant["variant_index"]]
+        assert "".join(tokens).strip() == "Subject: Hello seg_7\n\nOffer for seg_7."
+        finished_at = events.index(("variant", variant))
+        assert all(
+            position < finished_at for position, (event, data) in enumerate(events)
+            if event == "token" and data["variant_index"] == variant["variant_index"]
+        )
+    event, done = events[-1]
+    assert event == "done"
+    assert done["segment_id"] == "seg_7" and done["tokens_used"] > 0
+
+
+def test_stream_without_llm_streams_templates(client):
+    """With no endpoint configured the templates are streamed word by word"""
+    events = parse_sse(client.post(
+        "/api/v1/generation/stream", json={"segment_id": "seg_1", "context": {}, "variants": 3, "use_cache": False}
+    ).text)
+    variants = {data["variant_index"]: data for event, data in events if event == "variant"}
+    assert [variants[i]["subject"] for i in range(3)] == [template["subject"] for template in TEMPLATES]
+    assert sum(event == "token" for event, _ in events) > 3
+    assert events[-1][1]["tokens_used"] == 0  # templates cost no LLM tokens
+
+
+def test_generation_cache_saves_repeated_prompts():
+    """Identical requests are served from the cache; other contexts, models or opting out miss"""
+    server = completion_stand_in()
+    agent = stand_in_agent(server)
+    request = GenerationRequest(segment_id="seg_1", context={"tier": "gold", "region": "eu"}, variants=2)
+
+    async def run():
+        first = await agent.generate_messages(request)
+        # Same context in another key order renders the same prompt
+        second = await agent.generate_messages(request.model_copy(update={"context": {"region": "eu", "tier": "gold"}}))
+        calls = len(server.state.prompts)
+        await agent.generate_messages(request.model_copy(update={"context": {"tier": "silver"}}))
+        await agent.generate_messages(request.model_copy(update={"use_cache": False}))
+        agent.model = "gpt-4o"
+        await agent.generate_messages(request)
+        return first, second, calls
+
+    first, second, calls = asyncio.run(run())
+    assert calls == 2
+    assert second.generation_metadata["tokens_used"] == 0
+    assert second.generation_metadata["tokens_saved"] == first.generation_metadata["tokens_used"] == 100
+    assert second.generation_metadata["cached_variants"] == 2
+    assert [v.content for v in second.variants] == [v.content for v in first.variants]
+    assert len(server.state.prompts) == 8
+
+
+def test_stream_serves_cached_variants(client, monkeypatch):
+    """A repeated streaming request gets its variants from the cache, without token events"""
+    server = completion_stand_in()
+    agent = stand_in_agent(server)
+    monkeypatch.setattr(generation_router, "generation_agent", agent)
+    body = {"segment_id": "seg_3", "context": {}, "variants": 2}
+
+    first = parse_sse(client.post("/api/v1/generation/stream", json=body).text)
+    second = parse_sse(client.post("/api/v1/generation/stream", json=body).text)
+    assert len(server.state.prompts) == 2
+    assert [event for event, _ in second] == ["variant", "variant", "done"]
+    assert second[-1][1]["tokens_saved"] == first[-1][1]["tokens_used"] > 0
+    assert client.get("/api/v1/generation/cache/stats").json()["hits"] == 2
+
+
+def test_variant_renderer_formats_typed_placeholders():
+    """Placeholders are typed, defaulted and rendered in chunks; literal braces survive"""
+    renderer = VariantRenderer(
+        "{{first_name:title|there}}, your {{tier:upper}} perks",
+        "Hi {{first_name:title|there}}! {{points:int}} points ({{value:currency}}, {{discount:percent}} off) "
+        "since {{joined:date}}. {keep these}"
+    )
+    assert renderer.fields == ["first_name", "tier", "points", "value", "discount", "joined"]
+    columns = {
+        "first_name": ["ana", None, ""],
+        "tier": ["gold", "silver", "bronze"],
+        "points": [1200, 35.0, 0],
+        "value": [1234.5, 3.5, 0],
+        "discount": [0.2, 0.15, 0.05],
+        "joined": ["2023-04-09", "2021-12-01T10:00:00", "2024-01-31"],
+        "unused": [1, 2, 3],
+    }
+    chunks = list(renderer.iter_rendered(["c1", "c2", "c3"], columns, chunk_size=2))
+    assert [len(chunk) for chunk in chunks] == [2, 1]
+    rows = [row for chunk in chunks for row in chunk]
+    assert rows[0] == (
+        "c1",
+        "Ana, your GOLD perks",
+        "Hi Ana! 1200 points ($1,234.50, 20% off) since April 9, 2023. {keep these}"
+    )
+    assert rows[1][1] == "there, your SILVER perks"
+    assert rows[2][2].startswith("Hi there! 0 points ($0.00, 5% off) since January 31, 2024")
+    assert compile_template(renderer.content.source) is renderer.content
+
+
+def test_variant_renderer_rejects_bad_input():
+    renderer = VariantRenderer(None, "{{points:int}} points")
+    with pytest.raises(ValueError, match="Missing columns"):
+        renderer.iter_rendered(["c1"], {})
+    with pytest.raises(ValueError, match="has 2 values, expected 1"):
+        renderer.iter_rendered(["c1"], {"points": [1, 2]})
+    with pytest.raises(ValueError, match="Cannot render 'lots' as int"):
+        list(renderer.iter_rendered(["c1", "c2"], {"points": [3, "lots"]}))
+    with pytest.raises(ValueError, match="Unknown placeholder type 'money'"):
+        VariantRenderer(None, "{{points:money}}")
+
+
+def test_render_endpoint_streams_ndjson(client):
+    variant = {
+        "variant_id": "var_1",
+        "subject": "For {{name:title}}",
+        "content": "Hi {{name:title|friend}}, enjoy {{discount:percent}} off",
+        "metadata": {},
+        "confidence": 0.9
+    }
+    response = client.post("/api/v1/generation/render", json={
+        "variant": variant,
+        "customer_ids": ["c1", "c2"],
+        "columns": {"name": ["ana", None], "discount": [0.1, 0.25]}
+    })
+    assert response.status_code == 200
+    assert [json.loads(line) for line in response.text.splitlines()] == [
+        {"customer_id": "c1", "subject": "For Ana", "content": "Hi Ana, enjoy 10% off"},
+        {"customer_id": "c2", "subject": "For ", "content": "Hi friend, enjoy 25% off"},
+    ]
+    bad = client.post("/api/v1/generation/render", json={
+        "variant": variant, "customer_ids": ["c1"], "columns": {"name": ["ana"], "discount": ["n/a"]}
+    })
+    assert bad.status_code == 422
@@ -0,0 +1,846 @@
+"""Tests for the retrieval agent, its indexes and caches"""
+import asyncio
+import json
+import threading
+import time
+from typing import Any, Dict
+
+import httpx
+import numpy as np
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+from app.agents.retrieval import RetrievalAgent, build_index
+from app.main import app
+from app.models.schemas import RetrievalRequest
+from app.routers import retrieval as retrieval_router
+from app.utils import result_cache, vector_index
+from app.utils.azure_clients import AzureOpenAIClient, mock_embedding
+from app.utils.batching import MicroBatcher
+from app.utils.config import settings
+from app.utils.embedding_cache import DiskEmbeddingTier, EmbeddingCache, content_digest
+from app.utils.lexical_index import LexicalIndex, reciprocal_rank_fusion
+from app.utils.metadata_index import MetadataIndex
+from app.utils.result_cache import MemoryCache, RedisCache
+from app.utils.retrieval_snapshot import RetrievalSnapshotStore
+from app.utils.vector_index import IVFIndex, QuantizedVectorIndex, VectorIndex, normalize_rows
+
+DOCUMENTS = [
+    {"id": "doc_premium", "content": "Premium customers prefer exclusive offers", "source": "customer_insights"},
+    {"id": "doc_subject", "content": "Personalized subject lines increase open rates", "source": "best_practices"},
+    {"id": "doc_recs", "content": "Product recommendations based on purchase history", "source": "recommendations"},
+]
+
+
+@pytest.fixture
+def agent(tmp_path):
+    """Retrieval agent seeded with a few documents"""
+    agent = RetrievalAgent(cache_dir=str(tmp_path))
+    asyncio.run(agent.add_documents(DOCUMENTS))
+    return agent
+
+
+def test_vector_index_matches_full_sort(monkeypatch):
+    """Blocked argpartition search returns the same ranking as a full sort"""
+    monkeypatch.setattr(vector_index, "SEARCH_BLOCK_ROWS", 64)  # force several blocks
+    rng = np.random.default_rng(0)
+    vectors = rng.normal(size=(500, 16))
+    queries = rng.normal(size=(7, 16))
+
+    index = VectorIndex(capacity=8)  # force several reallocations
+    for start in range(0, len(vectors), 100):
+        index.add(vectors[start:start + 100])
+    positions, scores = index.search(queries, top_k=10)
+
+    expected = normalize_rows(queries) @ normalize_rows(vectors).T
+    expected_positions = np.argsort(-expected, axis=1)[:, :10]
+    np.testing.assert_array_equal(positions, expected_positions)
+    np.testing.assert_allclose(scores, np.take_along_axis(expected, expected_positions, axis=1), rtol=1e-5)
+
+
+def test_vector_index_top_k_larger_than_corpus():
+    """Asking for more results than documents returns every document"""
+    index = VectorIndex()
+    index.add(np.eye(3))
+    positions, scores = index.search(np.array([[1.0, 0.5, 0.0]]), top_k=10)
+    assert positions.tolist() == [[0, 1, 2]]
+    assert scores.shape == (1, 3)
+
+
+def test_retrieve_context_ranks_by_similarity(agent):
+    """The closest document by content comes first"""
+    response = asyncio.run(agent.retrieve_context(
+        RetrievalRequest(query="exclusive offers for premium customers", top_k=2)
+    ))
+    assert [result["id"] for result in response.results][0] == "doc_premium"
+    assert len(response.scores) == 2
+    assert response.scores[0] >= response.scores[1]
+    assert "embedding" not in response.results[0]
+
+
+def test_precomputed_embeddings_are_indexed_as_given(tmp_path):
+    """Documents with an embedding skip the embedding call"""
+    agent = RetrievalAgent(cache_dir=str(tmp_path))
+    asyncio.run(agent.add_documents([
+        {"content": "a", "embedding": [1.0, 0.0]},
+        {"content": "b", "embedding": [0.0, 1.0]},
+    ]))
+    np.testing.assert_allclose(agent.index.vectors, np.eye(2))
+    assert [document["id"] for document in agent.document_store] == ["doc_0", "doc_1"]
+
+
+def test_failed_document_batch_leaves_agent_usable(agent, monkeypatch):
+    """A rejected or failing batch changes nothing, and later batches index normally"""
+    with pytest.raises(ValueError, match="segment"):
+        asyncio.run(agent.add_documents([{"content": "bad", "segment": {"x": 1}}]))
+
+    def broken_add(start, texts):
+        raise RuntimeError("lexical index failure")
+
+    monkeypatch.setattr(agent.lexical_index, "add", broken_add)
+    with pytest.raises(RuntimeError):
+        asyncio.run(agent.add_documents([{"content": "also bad", "segment": "gold"}]))
+    monkeypatch.undo()
+
+    sizes = (len(agent.document_store), len(agent.index), len(agent.lexical_index))
+    assert sizes == (3, 3, 3) and agent.metadata_index.values("segment") == []
+    asyncio.run(agent.add_documents([{"content": "gold tier perks", "segment": "gold"}]))
+    assert agent.published == len(agent.index) == len(agent.lexical_index) == 4
+    assert agent.metadata_index.lookup({"segment": "gold"}).tolist() == [3]
+
+
+def test_index_truncate_drops_trailing_rows():
+    """Truncating a trained IVF index or a lexical index forgets only the rows past the cut"""
+    rng = np.random.default_rng(5)
+    index = IVFIndex(nlist=4, nprobe=4, train_size=40)
+    index.add(clustered_vectors(rng, 4, 15, 8))
+    index.truncate(50)
+    assert len(index) == 50 and index._list_sizes.sum() == 50
+    assert index.search(index.vectors[:3], 1)[0].ravel().tolist() == [0, 1, 2]
+
+    lexical = LexicalIndex()
+    lexical.add(0, ["red shoes", "blue shoes", "green hats"])
+    lexical.truncate(2)
+    assert len(lexical) == 2 and lexical.total_length == 4
+    assert lexical.search("hats", 5)[0].tolist() == []
+    assert lexical.search("shoes", 5)[0].tolist() in ([0, 1], [1, 0])
+
+
+def test_batch_endpoint_answers_each_query(client, agent, monkeypatch):
+    """/batch returns one ranked response per query, in order"""
+    monkeypatch.setattr(retrieval_router, "retrieval_agent", agent)
+    response = client.post("/api/v1/retrieval/batch", json={"requests": [
+        {"query": "subject lines open rates", "top_k": 1},
+        {"query": "purchase history recommendations", "top_k": 3},
+    ]})
+    assert response.status_code == 200
+    responses = response.json()["responses"]
+    assert [r["results"][0]["id"] for r in responses] == ["doc_subject", "doc_recs"]
+    assert [len(r["results"]) for r in responses] == [1, 3]
+
+
+def clustered_vectors(rng, num_clusters, per_cluster, dim, spread=0.3):
+    """Points around random unit centers, so coarse quantization is meaningful"""
+    centers = normalize_rows(rng.normal(size=(num_clusters, dim)))
+    noise = rng.normal(scale=spread / np.sqrt(dim), size=(num_clusters * per_cluster, dim))
+    return np.repeat(centers, per_cluster, axis=0) + noise
+
+
+def test_ivf_index_recall_and_incremental_inserts():
+    """IVF trains once enough rows exist, files later inserts, and probing every list is exact"""
+    rng = np.random.default_rng(1)
+    vectors = clustered_vectors(rng, 32, 50, 24)
+    rng.shuffle(vectors)
+    queries = vectors[:20] + rng.normal(scale=0.01, size=(20, 24))
+
+    index = IVFIndex(nlist=16, nprobe=4, train_size=800)
+    index.add(vectors[:500])
+    assert not index.is_trained  # below train_size: exact fallback
+    index.add(vectors[500:1000])
+    assert index.is_trained
+    index.add(vectors[1000:])
+    assert index._list_sizes.sum() == len(vectors)
+
+    exact = VectorIndex()
+    exact.add(vectors)
+    exact_positions, _ = exact.search(queries, 10)
+
+    approx_positions, _ = index.search(queries, 10)
+    recall = np.mean([
+        len(set(a.tolist()) & set(e.tolist())) / 10
+        for a, e in zip(approx_positions, exact_positions)
+    ])
+    assert recall >= 0.9
+
+    full_positions, _ = index.search(queries, 10, nprobe=16)
+    np.testing.assert_array_equal(full_positions, exact_positions)
+
+
+def test_ivf_search_during_training_uses_exact_scan():
+    """A search while train() is still filing rows sees an untrained index, not empty lists"""
+    rng = np.random.default_rng(4)
+    vectors = clustered_vectors(rng, 8, 20, 16)
+    index = IVFIndex(nlist=8, nprobe=2, train_size=10**6)
+    index.add(vectors)
+    query = vectors[:1]
+    seen = []
+    file_into = index._file_into
+
+    def search_then_file(*args):
+        seen.append(index.search(query, 5))
+        file_into(*args)
+
+    index._file_into = search_then_file
+    index.train()
+
+    positions, _ = seen[0]
+    assert positions[0, 0] == 0 and (positions >= 0).all()
+    assert index.is_trained and index._list_sizes.sum() == len(vectors)
+
+
+class FixedEmbeddingClient:
+    """Embedding client stand-in that embeds every text as the same vector"""
+
+    def __init__(self, vector):
+        self.vector = vector
+
+    async def generate_embedding(self, text):
+        return self.vector
+
+    async def generate_embeddings(self, texts):
+        return [self.vector for _ in texts]
+
+
+def test_ivf_agent_drops_padding(tmp_path):
+    """Results skip padding when the probed lists hold fewer than top_k rows"""
+    rng = np.random.default_rng(2)
+    vectors = clustered_vectors(rng, 4, 10, 8, spread=0.05)
+    agent = RetrievalAgent(
+        embedding_client=FixedEmbeddingClient(vectors[0].tolist()),
+        index=IVFIndex(nlist=4, nprobe=1, train_size=40),
+        cache_dir=str(tmp_path)
+    )
+    asyncio.run(agent.add_documents([
+        {"content": f"doc {i}", "embedding": vector.tolist()} for i, vector in enumerate(vectors)
+    ]))
+
+    response = asyncio.run(agent.retrieve_context(RetrievalRequest(query="anything", top_k=20)))
+    assert 0 < len(response.results) < 20
+    assert len(response.scores) == len(response.results)
+    assert response.results[0]["id"] == "doc_0"
+
+
+class CountingEmbeddingClient:
+    """Embedding client stand-in that records every text it embeds"""
+
+    def __init__(self):
+        self.calls = []
+
+    async def generate_embedding(self, text):
+        self.calls.append(text)
+        return mock_embedding(text).tolist()
+
+    async def generate_embeddings(self, texts):
+        return [await self.generate_embedding(text) for text in texts]
+
+
+def test_embedding_cache_reuses_vectors(tmp_path):
+    """Repeated texts are embedded once per process, and never again after a restart"""
+    client = CountingEmbeddingClient()
+    agent = RetrievalAgent(embedding_client=client, cache_dir=str(tmp_path))
+    first = asyncio.run(agent._embed(["red shoes", "blue hats", "red shoes"]))
+    second = asyncio.run(agent._embed(["blue hats"]))
+    assert client.calls == ["red shoes", "blue hats"]
+    np.testing.assert_array_equal(first[1], second[0])
+    assert agent.embeddings_cache.stats()["memory_hits"] == 1
+
+    agent.embeddings_cache.flush()
+    restarted = RetrievalAgent(embedding_client=client, cache_dir=str(tmp_path))
+    again = asyncio.run(restarted._embed(["red shoes"]))
+    assert len(client.calls) == 2
+    np.testing.assert_array_equal(again[0], first[0])
+    assert restarted.embeddings_cache.stats()["disk_hits"] == 1
+
+
+def test_embedding_cache_spills_evicted_entries(tmp_path):
+    """Entries pushed out of the memory tier are served from the disk tier"""
+    cache = EmbeddingCache(str(tmp_path), max_memory_entries=2)
+    texts = [f"text {i}" for i in range(5)]
+    cache.put_many("model-a", texts, [np.full(4, i, dtype=np.float32) for i in range(5)])
+    assert cache.stats()["memory_entries"] == 2
+    assert cache.stats()["disk_entries"] == {"model-a": 3}
+
+    found = cache.get_many("model-a", texts + ["unseen"])
+    assert [vector[0] for vector in found[:5]] == [0, 1, 2, 3, 4]
+    assert found[5] is None
+    assert cache.get_many("model-b", ["text 0"]) == [None]  # keyed by model too
+    stats = cache.stats()
+    assert (stats["memory_hits"], stats["disk_hits"], stats["misses"]) == (2, 3, 2)
+
+
+def test_disk_tier_shared_between_processes(tmp_path):
+    """Two writers on one directory never reuse a row and see each other's rows"""
+    first, second = DiskEmbeddingTier(tmp_path), DiskEmbeddingTier(tmp_path)
+    hello, world = content_digest("hello"), content_digest("world")
+    first.append([hello], np.ones((1, 4)))
+    second.append([world, hello], np.array([np.full(4, 2.0), np.full(4, 9.0)]))
+
+    assert second.rows == {hello: 0, world: 1}  # hello was already on disk
+    np.testing.assert_array_equal(first.get(world), np.full(4, 2.0))
+    np.testing.assert_array_equal(second.get(hello), np.ones(4))
+    assert len(DiskEmbeddingTier(tmp_path)) == 2
+
+
+def embedding_stand_in():
+    """Local stand-in for the Azure OpenAI embeddings endpoint; records each request's inputs"""
+    server = FastAPI()
+    server.state.requests = []
+
+    @server.post("/openai/deployments/{deployment}/embeddings")
+    async def embeddings(deployment: str, body: Dict[str, Any]):
+        inputs = body["input"]
+        server.state.requests.append(inputs)
+        return {
+            "object": "list",
+            "model": deployment,
+            # Reversed on purpose: clients must order by "index"
+            "data": [
+                {"object": "embedding", "index": i, "embedding": mock_embedding(text, dim=8).tolist()}
+                for i, text in reversed(list(enumerate(inputs)))
+            ],
+            "usage": {"prompt_tokens": len(inputs), "total_tokens": len(inputs)}
+        }
+
+    return server
+
+
+def stand_in_client(server, **kwargs):
+    return AzureOpenAIClient(
+        "http://embeddings.test",
+        "test-key",
+        "chat",
+        embedding_deployment="embed",
+        http_client=httpx.AsyncClient(transport=httpx.ASGITransport(app=server)),
+        **kwargs
+    )
+
+
+def test_generate_embeddings_splits_into_batches():
+    """The batch API sends batch_size inputs per request and keeps input order"""
+    server = embedding_stand_in()
+    client = stand_in_client(server, embedding_batch_size=4)
+    texts = [f"product {i}" for i in range(10)]
+
+    vectors = asyncio.run(client.generate_embeddings(texts))
+
+    assert [len(inputs) for inputs in server.state.requests] == [4, 4, 2]
+    np.testing.assert_allclose(vectors, [mock_embedding(text, dim=8) for text in texts], rtol=1e-6)
+
+
+def test_concurrent_single_embeddings_are_coalesced():
+    """Concurrent generate_embedding calls share requests, bounded by size and wait"""
+    server = embedding_stand_in()
+    client = stand_in_client(server, embedding_batch_size=8, embedding_batch_max_wait=0.05)
+
+    async def run():
+        texts = [f"query {i}" for i in range(12)]
+        vectors = await asyncio.gather(*(client.generate_embedding(text) for text in texts))
+        lone = await client.generate_embedding("late query")
+        return texts, vectors, lone
+
+    texts, vectors, lone = asyncio.run(run())
+
+    # 8 dispatched when full, 4 after max_wait, then the lone call on its own
+    assert [len(inputs) for inputs in server.state.requests] == [8, 4, 1]
+    np.testing.assert_allclose(vectors, [mock_embedding(text, dim=8) for text in texts], rtol=1e-6)
+    np.testing.assert_allclose(lone, mock_embedding("late query", dim=8), rtol=1e-6)
+
+
+def test_short_batch_result_fails_every_caller():
+    """A batch answering fewer items than it was given fails all its callers instead of hanging some"""
+    async def drop_last(items):
+        return items[:-1]
+
+    async def run():
+        batcher = MicroBatcher(drop_last, max_batch_size=3, max_wait=0.01)
+        return await asyncio.wait_for(
+            asyncio.gather(*(batcher.submit(i) for i in range(3)), return_exceptions=True), timeout=1
+        )
+
+    results = asyncio.run(run())
+    assert all(isinstance(result, ValueError) for result in results)
+
+
+def test_metadata_index_lookup():
+    """Scalar and list filters resolve to sorted positions, fields intersect"""
+    index = MetadataIndex(["segment", "category"])
+    index.add(0, [
+        {"segment": "seg_0", "category": "shoes"},
+        {"segment": "seg_1", "category": ["shoes", "sale"]},
+        {"segment": "seg_0", "category": "hats"},
+    ])
+    index.add(3, [{"segment": "seg_1"}, {"category": "sale"}])
+
+    assert index.lookup({}) is None
+    assert index.lookup({"segment": "seg_1"}).tolist() == [1, 3]
+    assert index.lookup({"category": ["hats", "sale"]}).tolist() == [1, 2, 4]
+    assert index.lookup({"segment": "seg_0", "category": "shoes"}).tolist() == [0]
+    assert index.lookup({"segment": "seg_9"}).tolist() == []
+    with pytest.raises(ValueError, match="Cannot filter on source"):
+        index.lookup({"source": "x"})
+
+
+def test_metadata_index_keeps_booleans_apart_from_numbers():
+    """True/False do not match 1/0, and unhashable filter values are rejected"""
+    index = MetadataIndex(["flag"])
+    index.add(0, [{"flag": 1}, {"flag": True}, {"flag": 0}, {"flag": False}])
+
+    assert index.lookup({"flag": True}).tolist() == [1]
+    assert index.lookup({"flag": [1, False]}).tolist() == [0, 3]
+    params, arrays = index.export()
+    arrays = {name: np.concatenate(part) if isinstance(part, list) else part for name, part in arrays.items()}
+    assert MetadataIndex.restore(params, arrays).lookup({"flag": 0}).tolist() == [2]
+    with pytest.raises(ValueError, match="must be a string, number or boolean"):
+        index.lookup({"flag": {"$in": [1]}})
+
+
+def test_segment_scoped_retrieval_only_scores_that_segment(tmp_path):
+    """segment_id and filters narrow the candidates before scoring"""
+    agent = RetrievalAgent(cache_dir=str(tmp_path))
+    asyncio.run(agent.add_documents([
+        {"content": "exclusive premium offers", "segment": "seg_0", "source": "insights"},
+        {"content": "exclusive premium offers", "segment": "seg_1", "source": "insights"},
+        {"content": "seasonal sale reminder", "segment": "seg_1", "source": "campaigns"},
+        {"content": "loyalty program update", "segment": "seg_1", "source": "insights"},
+    ]))
+
+    response = asyncio.run(agent.retrieve_context(RetrievalRequest(
+        query="premium offers", segment_id="seg_1", filters={"source": "insights"}, top_k=5
+    )))
+    assert [result["id"] for result in response.results] == ["doc_1", "doc_3"]
+    assert response.metadata["documents_searched"] == 2
+
+    empty = asyncio.run(agent.retrieve_context(RetrievalRequest(query="premium offers", segment_id="seg_9")))
+    assert empty.results == [] and empty.scores == []
+
+
+def test_ivf_search_respects_candidates():
+    """Filtered IVF searches only return candidate rows, on both the exact and probe paths"""
+    rng = np.random.default_rng(3)
+    vectors = clustered_vectors(rng, 16, 40, 16)
+    index = IVFIndex(nlist=8, nprobe=2, train_size=320)
+    index.add(vectors)
+
+    few = np.arange(0, 640, 97)  # fewer than two lists hold: scored exactly
+    positions, _ = index.search(vectors[:3], 5, candidates=few)
+    exact, _ = VectorIndex.search(index, vectors[:3], 5, candidates=few)
+    np.testing.assert_array_equal(positions, exact)
+
+    many = np.arange(0, 640, 2)  # probed lists masked to the candidates
+    positions, _ = index.search(vectors[:3], 5, candidates=many)
+    assert (positions[:, 0] >= 0).all()
+    assert np.isin(positions[positions >= 0], many).all()
+
+
+def test_unknown_filter_field_is_rejected(client, agent, monkeypatch):
+    """Filtering on an unindexed field is a client error"""
+    monkeypatch.setattr(retrieval_router, "retrieval_agent", agent)
+    response = client.post("/api/v1/retrieval/", json={"query": "offers", "filters": {"color": "red"}})
+    assert response.status_code == 422
+
+
+def test_unhashable_filter_value_is_rejected(client, agent, monkeypatch):
+    """A dict or nested list as a filter value is a client error, not a 500"""
+    monkeypatch.setattr(retrieval_router, "retrieval_agent", agent)
+    response = client.post("/api/v1/retrieval/", json={"query": "offers", "filters": {"segment": [["seg_0"]]}})
+    assert response.status_code == 422
+
+
+def test_search_limit_hides_unpublished_rows():
+    """Rows at or past `limit` are invisible to both index types"""
+    vectors = np.eye(4)
+    for index in (VectorIndex(), IVFIndex(nlist=2, nprobe=2, train_size=4)):
+        index.add(vectors)
+        positions, _ = index.search(vectors[3:], 4, limit=3)
+        assert 3 not in positions.tolist()[0]
+
+
+def test_streamed_document_ingestion(agent, monkeypatch):
+    """NDJSON uploads are indexed in background batches and become searchable"""
+    monkeypatch.setattr(retrieval_router, "retrieval_agent", agent)
+    monkeypatch.setattr(settings, "RETRIEVAL_INGEST_BATCH_SIZE", 4)
+    lines = "\n".join(
+        json.dumps({"content": f"catalog item {i}", "segment": f"seg_{i % 2}"}) for i in range(10)
+    )
+
+    with TestClient(app) as client:
+        response = client.post(
+            "/api/v1/retrieval/documents",
+            content=lines.encode(),
+            headers={"Content-Type": "application/x-ndjson"}
+        )
+        assert response.status_code == 202
+        assert response.json()["documents_received"] == 10
+        ingestion_id = response.json()["ingestion_id"]
+
+        deadline = time.time() + 10
+        while time.time() < deadline:
+            status = client.get(f"/api/v1/retrieval/documents/ingestions/{ingestion_id}").json()
+            if status["status"] in ("completed", "failed"):
+                break
+            time.sleep(0.02)
+        assert status["status"] == "completed"
+        assert (status["documents_indexed"], status["batches_published"]) == (10, 3)
+
+        found = client.post("/api/v1/retrieval/", json={"query": "catalog item 7", "segment_id": "seg_1"}).json()
+        assert found["results"][0]["content"] == "catalog item 7"
+        assert found["metadata"]["documents_searched"] == 5
+
+
+def test_malformed_upload_is_rejected(agent, monkeypatch):
+    """A bad NDJSON line fails the upload and its ingestion record"""
+    monkeypatch.setattr(retrieval_router, "retrieval_agent", agent)
+    with TestClient(app) as client:
+        response = client.post("/api/v1/retrieval/documents", content=b'{"content": "ok"}\n{not json}\n')
+    assert response.status_code == 422
+    [ingestion] = agent.ingestions.values()
+    assert ingestion["status"] == "failed"
+
+
+def test_bm25_scores_match_formula():
+    """BM25 scores follow the Okapi formula and keep SKU tokens whole"""
+    index = LexicalIndex()
+    texts = ["sku-1042 winter jacket", "winter sale winter boots", "summer dress"]
+    index.add(0, texts)
+
+    positions, scores = index.search("winter sku-1042", 5)
+
+    def bm25(term_frequency, doc_frequency, length):
+        idf = np.log(1 + (3 - doc_frequency + 0.5) / (doc_frequency + 0.5))
+        norm = 1.2 * (1 - 0.75 + 0.75 * length / 3)  # 9 tokens over 3 documents
+        return idf * term_frequency * 2.2 / (term_frequency + norm)
+
+    expected = {0: bm25(1, 2, 3) + bm25(1, 1, 3), 1: bm25(2, 2, 4)}
+    assert positions.tolist() == [0, 1]
+    np.testing.assert_allclose(scores, [expected[0], expected[1]], rtol=1e-5)
+    assert index.search("sku", 5)[0].tolist() == []  # no partial-token matches
+
+
+def test_lexical_batch_add_matches_one_by_one():
+    """Adding a batch at once yields the same postings as adding documents one at a time"""
+    texts = ["winter sale winter boots", "summer dress", "winter jacket", "boots boots"]
+    batched, single = LexicalIndex(), LexicalIndex()
+    batched.add(0, texts)
+    for position, text in enumerate(texts):
+        single.add(position, [text])
+    assert list(batched._positions) == list(single._positions)
+    for term in single._positions:
+        np.testing.assert_array_equal(batched._positions[term].positions, single._positions[term].positions)
+        np.testing.assert_array_equal(batched._frequencies[term].positions, single._frequencies[term].positions)
+    np.testing.assert_array_equal(batched._lengths.positions, single._lengths.positions)
+    assert batched.total_length == single.total_length
+
+
+def test_document_indexing_runs_off_the_event_loop(tmp_path, monkeypatch):
+    """Metadata and lexical indexing run in a worker thread, like the vector index"""
+    agent = RetrievalAgent(cache_dir=str(tmp_path))
+    threads = []
+    for index in (agent.metadata_index, agent.lexical_index):
+        add = index.add
+        monkeypatch.setattr(index, "add", lambda *args, add=add: (threads.append(threading.current_thread()), add(*args)))
+    asyncio.run(agent.add_documents(DOCUMENTS))
+    assert len(threads) == 2 and threading.main_thread() not in threads
+    assert agent.lexical_index.search("premium", 1)[0].tolist() == [0]
+
+
+def test_reciprocal_rank_fusion():
+    """Documents ranked well by both lists win"""
+    positions, scores = reciprocal_rank_fusion([np.array([1, 2, 3]), np.array([3, 1])], top_k=2, k=60)
+    assert positions.tolist() == [1, 3]
+    np.testing.assert_allclose(scores, [1 / 61 + 1 / 62, 1 / 63 + 1 / 61])
+
+
+def test_lexical_and_hybrid_modes(tmp_path):
+    """Lexical mode never embeds the query; hybrid surfaces exact-term matches"""
+    client = CountingEmbeddingClient()
+    agent = RetrievalAgent(embedding_client=client, cache_dir=str(tmp_path))
+    asyncio.run(agent.add_documents([
+        {"content": "Spring campaign for loyal customers"},
+        {"content": "Product SKU-88412 restock notice"},
+        {"content": "Loyal customers respond to spring offers"},
+    ]))
+    client.calls.clear()
+
+    lexical = asyncio.run(agent.retrieve_context(RetrievalRequest(query="sku-88412", mode="lexical")))
+    assert client.calls == []
+    assert [result["id"] for result in lexical.results] == ["doc_1"]
+    assert lexical.metadata["retrieval_method"] == "lexical_bm25"
+
+    hybrid = asyncio.run(agent.retrieve_context(
+        RetrievalRequest(query="restock of sku-88412", mode="hybrid", top_k=2)
+    ))
+    assert client.calls == ["restock of sku-88412"]
+    assert hybrid.results[0]["id"] == "doc_1"
+    assert hybrid.metadata["retrieval_method"] == "hybrid_rrf"
+
+
+class FakeRedis:
+    """In-memory stand-in for the redis.asyncio calls RedisCache makes"""
+
+    def __init__(self):
+        self.data = {}
+        self.ttls = {}
+
+    async def mget(self, keys):
+        return [self.data.get(key) for key in keys]
+
+    def pipeline(self, transaction=True):
+        return FakePipeline(self)
+
+
+class FakePipeline:
+    def __init__(self, redis):
+        self.redis = redis
+        self.commands = []
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        return False
+
+    def set(self, key, value, ex=None):
+        self.commands.append((key, value, ex))
+
+    async def execute(self):
+        for key, value, ex in self.commands:
+            self.redis.data[key] = value.encode("utf-8")
+            self.redis.ttls[key] = ex
+
+
+@pytest.mark.parametrize("backend", ["memory", "redis"])
+def test_result_cache_hits_until_documents_change(tmp_path, backend):
+    """Repeated queries are served from cache; publishing documents invalidates them"""
+    fake = FakeRedis()
+    cache = MemoryCache() if backend == "memory" else RedisCache(fake, prefix="retrieval:")
+    client = CountingEmbeddingClient()
+    agent = RetrievalAgent(embedding_client=client, cache_dir=str(tmp_path), result_cache=cache)
+    asyncio.run(agent.add_documents(DOCUMENTS))
+
+    first = asyncio.run(agent.retrieve_context(RetrievalRequest(query="premium  offers", segment_id="seg_0")))
+    again = asyncio.run(agent.retrieve_context(
+        RetrievalRequest(query=" premium offers ", filters={"segment": "seg_0"})
+    ))
+    assert (first.metadata["cached"], again.metadata["cached"]) == (False, True)
+    assert again.results == first.results
+    if backend == "redis":
+        assert all(key.startswith("retrieval:") for key in fake.data)
+        assert set(fake.ttls.values()) == {300}
+
+    asyncio.run(agent.add_documents([{"content": "premium offers", "segment": "seg_0"}]))
+    after = asyncio.run(agent.retrieve_context(RetrievalRequest(query="premium offers", segment_id="seg_0")))
+    assert after.metadata["cached"] is False
+    assert [result["content"] for result in after.results] == ["premium offers"]
+    assert cache.stats()["hits"] == 1
+
+
+def test_shared_result_cache_does_not_cross_index_states(tmp_path):
+    """Two processes holding different documents at the same count never share cache keys"""
+    cache = MemoryCache()
+    first = RetrievalAgent(cache_dir=str(tmp_path / "a"), result_cache=cache)
+    second = RetrievalAgent(cache_dir=str(tmp_path / "b"), result_cache=cache)
+    asyncio.run(first.add_documents([{"content": "premium offers"}]))
+    asyncio.run(second.add_documents([{"content": "loyalty points"}]))
+    assert first.published == second.published and first.index_version != second.index_version
+
+    request = RetrievalRequest(query="offers", top_k=1)
+    asyncio.run(first.retrieve_context(request))
+    response = asyncio.run(second.retrieve_context(request))
+    assert response.metadata["cached"] is False
+    assert response.results[0]["content"] == "loyalty points"
+
+
+def test_result_cache_backend_must_implement_get_and_set():
+    class GetOnly(result_cache.ResultCache):
+        async def get_many(self, keys):
+            return self._count([None] * len(keys))
+
+    with pytest.raises(TypeError, match="set_many"):
+        GetOnly()
+
+
+def test_memory_cache_expires_and_evicts(monkeypatch):
+    """Entries expire after their TTL and the least recently used go first"""
+    now = [1000.0]
+    monkeypatch.setattr(result_cache.time, "monotonic", lambda: now[0])
+    cache = MemoryCache(max_entries=2)
+
+    async def run():
+        await cache.set_many([("a", "1"), ("b", "2")], ttl=10)
+        await cache.get_many(["a"])  # refresh a
+        await cache.set_many([("c", "3")], ttl=10)  # evicts b
+        evicted = await cache.get_many(["a", "b", "c"])
+        now[0] += 11
+        expired = await cache.get_many(["a", "c"])
+        return evicted, expired
+
+    assert asyncio.run(run()) == (["1", None, "3"], [None, None])
+
+
+@pytest.mark.parametrize("storage", ["float16", "int8"])
+def test_quantized_index_reranks_to_exact_results(storage):
+    """Quantized scans plus float32 re-rank reproduce exact top-k and scores"""
+    rng = np.random.default_rng(6)
+    vectors = clustered_vectors(rng, 20, 30, 32)
+    queries = vectors[:10] + rng.normal(scale=0.02, size=(10, 32))
+
+    exact = VectorIndex()
+    exact.add(vectors)
+    quantized = QuantizedVectorIndex(storage=storage, rerank_factor=4, capacity=16)
+    for start in range(0, len(vectors), 128):
+        quantized.add(vectors[start:start + 128])
+
+    expected_positions, expected_scores = exact.search(queries, 5)
+    positions, scores = quantized.search(queries, 5)
+    np.testing.assert_array_equal(positions, expected_positions)
+    np.testing.assert_allclose(scores, expected_scores, rtol=1e-5)
+    assert quantized.nbytes <= exact.vectors.nbytes / (2 if storage == "float16" else 3.5)
+
+    few = np.array([3, 40, 41, 300])
+    positions, _ = quantized.search(queries[:2], 3, candidates=few)
+    assert np.isin(positions, few).all()
+
+
+def test_quantized_scan_widens_codes_block_by_block():
+    """Quantized searches widen at most block_rows codes to float32 at a time"""
+    rng = np.random.default_rng(7)
+    index = QuantizedVectorIndex(storage="int8")
+    assert index.block_rows == vector_index.QUANTIZED_BLOCK_ROWS < vector_index.SEARCH_BLOCK_ROWS
+    index.block_rows = 64  # small enough to see blocks on a small index
+    index.add(rng.normal(size=(300, 8)))
+    block_sizes = []
+    block_scores = index._block_scores
+
+    def record(queries, matrix, rows):
+        scores = block_scores(queries, matrix, rows)
+        block_sizes.append(scores.shape[1])
+        return scores
+
+    index._block_scores = record
+    index.search(index.vectors[:2].astype(np.float32), 3)
+    index.search(index.vectors[:2].astype(np.float32), 3, candidates=np.arange(0, 300, 2))
+    assert max(block_sizes) == 64 and sum(block_sizes) == 300 + 150
+
+
+@pytest.mark.parametrize("kind,storage", [("exact", "float32"), ("exact", "int8"), ("ivf", "float32")])
+def test_snapshot_round_trip(tmp_path, kind, storage):
+    """A restored agent answers every mode and filter exactly like the one that saved it"""
+    rng = np.random.default_rng(4)
+    vectors = clustered_vectors(rng, 4, 15, 8)
+    index = IVFIndex(nlist=4, nprobe=2, train_size=40) if kind == "ivf" else build_index(kind, storage)
+    client = FixedEmbeddingClient(vectors[3].tolist())
+    agent = RetrievalAgent(
+        embedding_client=client, index=index, cache_dir=str(tmp_path), snapshot_dir=str(tmp_path / "snapshots")
+    )
+    asyncio.run(agent.add_documents([
+        {"content": f"offer {i} sku-{i % 7}", "source": ["email", "sms"][i % 2], "embedding": vector.tolist()}
+        for i, vector in enumerate(vectors)
+    ]))
+    summary = asyncio.run(agent.save_snapshot())
+    assert (summary["version"], summary["documents"]) == ("v1", 60)
+
+    restored = RetrievalAgent(
+        embedding_client=client, cache_dir=str(tmp_path), snapshot_dir=str(tmp_path / "snapshots")
+    )
+    assert restored.load_snapshot()["version"] == "v1"
+    assert isinstance(restored.index, type(agent.index))
+    assert isinstance(restored.index.vectors, np.memmap)
+    requests = [
+        RetrievalRequest(query="offer sku-3", top_k=5, mode=mode, filters=filters)
+        for mode in ("semantic", "lexical", "hybrid")
+        for filters in (None, {"source": "sms"})
+    ]
+    expected = asyncio.run(agent._search(requests))
+    actual = asyncio.run(restored._search(requests))
+    for before, after in zip(expected, actual):
+        assert after.results == before.results
+        np.testing.assert_allclose(after.scores, before.scores, rtol=1e-5)
+
+
+def test_restored_agent_appends_without_touching_snapshot(tmp_path):
+    """Documents added after a restore are searchable and the mapped files stay unchanged"""
+    snapshot_dir = str(tmp_path / "snapshots")
+    agent = RetrievalAgent(cache_dir=str(tmp_path), snapshot_dir=snapshot_dir)
+    asyncio.run(agent.add_documents(DOCUMENTS))
+    asyncio.run(agent.save_snapshot())
+
+    vectors_file = tmp_path / "snapshots" / "v1" / "vectors.npy"
+    saved = vectors_file.read_bytes()
+    restored = RetrievalAgent(cache_dir=str(tmp_path), snapshot_dir=snapshot_dir)
+    restored.load_snapshot()
+    version = restored.index_version
+    asyncio.run(restored.add_documents([{"content": "Loyalty points double on weekends", "source": "promotions"}]))
+    assert restored.index_version != version
+    assert vectors_file.read_bytes() == saved
+    response = asyncio.run(restored.retrieve_context(RetrievalRequest(query="loyalty points weekends", top_k=1)))
+    assert response.results[0]["id"] == "doc_3"
+    lexical = asyncio.run(restored.retrieve_context(
+        RetrievalRequest(query="offers", top_k=5, mode="lexical", filters={"source": "customer_insights"})
+    ))
+    assert [result["id"] for result in lexical.results] == ["doc_premium"]
+
+    asyncio.run(restored.save_snapshot())
+    assert restored.snapshots.versions() == ["v1", "v2"]
+    again = RetrievalAgent(cache_dir=str(tmp_path), snapshot_dir=snapshot_dir)
+    assert again.load_snapshot("v1")["documents"] == 3
+    assert again.load_snapshot()["documents"] == 4
+    assert again.document_store[3]["content"] == "Loyalty points double on weekends"
+
+
+def test_snapshot_endpoints(client, agent, tmp_path, monkeypatch):
+    """Snapshots are created and listed over the API, keeping only the newest versions"""
+    monkeypatch.setattr(retrieval_router, "retrieval_agent", agent)
+    monkeypatch.setattr(agent.snapshots, "root", tmp_path / "snapshots")
+    monkeypatch.setattr(agent.snapshots, "retention", 2)
+    for expected in ("v1", "v2", "v3"):
+        response = client.post("/api/v1/retrieval/snapshots")
+        assert response.status_code == 201
+        assert response.json()["version"] == expected
+    assert client.get("/api/v1/retrieval/snapshots").json() == ["v2", "v3"]
+
+
+def test_concurrent_snapshot_saves_take_distinct_versions(tmp_path):
+    """Savers sharing a root never overwrite each other; a taken version is retried as the next one"""
+    snapshot_dir = str(tmp_path / "snapshots")
+    agents = []
+    for count in range(1, 5):
+        agent = RetrievalAgent(cache_dir=str(tmp_path / str(count)), snapshot_dir=snapshot_dir)
+        agent.snapshots.retention = 10
+        asyncio.run(agent.add_documents(DOCUMENTS[:1] * count))
+        agents.append(agent)
+    barrier = threading.Barrier(len(agents))
+
+    def save(agent):
+        barrier.wait()
+        return asyncio.run(agent.save_snapshot())
+
+    threads = [threading.Thread(target=save, args=(agent,)) for agent in agents]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    store = agents[0].snapshots
+    assert store.versions() == ["v1", "v2", "v3", "v4"]
+    assert sorted(store.load(version)[0]["documents"] for version in store.versions()) == [1, 2, 3, 4]
+
+    stale = iter([["v1"]])
+    store.versions = lambda: next(stale, None) or RetrievalSnapshotStore.versions(store)
+    assert asyncio.run(agents[0].save_snapshot())["version"] == "v5"
+    assert not list((tmp_path / "snapshots").glob(".*.tmp"))
+
+
+def test_snapshot_retention_keeps_at_least_one_version(tmp_path):
+    with pytest.raises(ValueError, match="at least 1"):
+        RetrievalSnapshotStore(str(tmp_path), retention=0)
@@ -0,0 +1,80 @@
+"""Tests for the safety agent and its PII / policy scanner"""
+import pytest
+
+from app.utils.pii_scanner import PIIScanner, luhn_valid
+
+
+def kinds(findings):
+    return [(finding.kind, finding.text) for finding in findings]
+
+
+def test_scanner_finds_each_kind_with_spans():
+    text = (
+        "Mail jane.doe@example.com or call (555) 123-4567 or +44 20 7946 0958. "
+        "Card 4111 1111 1111 1111, SSN 123-45-6789. Totally RISK-FREE."
+    )
+    findings = PIIScanner(["risk-free"]).scan(text)
+
+    assert kinds(findings) == [
+        ("email", "jane.doe@example.com"),
+        ("phone", "(555) 123-4567"),
+        ("phone", "+44 20 7946 0958"),
+        ("card", "4111 1111 1111 1111"),
+        ("ssn", "123-45-6789"),
+        ("policy_term", "RISK-FREE"),
+    ]
+    assert all(text[finding.start:finding.end] == finding.text for finding in findings)
+
+
+@pytest.mark.parametrize("text", [
+    "card 4111 1111 1111 1112",  # fails Luhn
+    "order 12345 shipped 2024-01-15",
+    "ssn 000-12-3456",
+    "ref x4111111111111111",  # inside a token
+    "email support at example dot com",
+    "a risk-freely phrased sentence",
+])
+def test_scanner_ignores_lookalikes(text):
+    assert PIIScanner(["risk-free"]).scan(text) == []
+
+
+def test_rejected_card_run_does_not_hide_what_follows():
+    """A digit run failing Luhn is dropped without swallowing the SSN or phone inside it"""
+    assert kinds(PIIScanner().scan("order 12345 123-45-6789")) == [("ssn", "123-45-6789")]
+    assert kinds(PIIScanner().scan("ref 12345 555 123 4567")) == [("phone", "555 123 4567")]
+
+
+def test_policy_terms_are_whole_words_across_whitespace():
+    scanner = PIIScanner(["guaranteed income", "guaranteed"])
+    assert kinds(scanner.scan("A Guaranteed\n income plan, guaranteed.")) == [
+        ("policy_term", "Guaranteed\n income"),
+        ("policy_term", "guaranteed"),
+    ]
+    assert PIIScanner([]).scan("guaranteed income") == []
+
+
+def test_luhn():
+    assert luhn_valid("4111-1111-1111-1111")
+    assert luhn_valid("79927398713")
+    assert not luhn_valid("79927398710")
+
+
+def test_safety_endpoint_reports_spans(client):
+    content = "Reach me at jane@example.com for a risk-free trial"
+    response = client.post("/api/v1/safety/", json={"content": content, "check_types": ["pii", "content_policy"]})
+    assert response.status_code == 200
+    data = response.json()
+
+    assert data["is_safe"] is False
+    assert data["failed_checks"] == ["pii", "content_policy"]
+    pii, policy = data["issues"]
+    assert [content[s["start"]:s["end"]] for s in pii["spans"]] == ["jane@example.com"]
+    assert pii["spans"][0]["type"] == "email"
+    assert [content[s["start"]:s["end"]] for s in policy["spans"]] == ["risk-free"]
+
+
+def test_safety_endpoint_passes_clean_content(client):
+    response = client.post("/api/v1/safety/", json={"content": "Our credit card rewards program is back"})
+    data = response.json()
+    assert data["is_safe"] is True
+    assert "pii" in data["passed_checks"] and "content_policy" in data["passed_checks"]
@@ -0,0 +1,370 @@
+"""Tests for the segmentation agent and endpoints"""
+import asyncio
+import io
+import json
+import threading
+import time
+
+import numpy as np
+import pytest
+from fastapi.testclient import TestClient
+
+from app.agents.segmentation import SegmentationAgent
+from app.main import app
+from app.models.schemas import (
+    ColumnarSegmentationRequest,
+    CustomerFeatures,
+    IncrementalSegmentationRequest,
+    SegmentAssignmentRequest,
+    SegmentationRequest,
+    SegmentationStreamRequest
+)
+from app.utils.clustering import (
+    CLUSTERING_ALGORITHMS,
+    PROFILE_QUANTILES,
+    SegmentStatsAccumulator,
+    fit_segmentation,
+    sampled_silhouette,
+    segment_quantiles
+)
+from app.utils.config import settings
+from app.utils.features import FEATURE_NAMES, extract_from_columns, extract_from_customers
+from app.utils.jobs import JobManager, JobQueueFullError
+from app.utils.model_registry import SegmentationModelRegistry
+
+
+def make_customers(n, seed=0):
+    """Build n synthetic customers as request dicts"""
+    rng = np.random.default_rng(seed)
+    return [
+        {
+            "customer_id": f"cust_{i}",
+            "demographics": {
+                "age": int(rng.integers(18, 70)),
+                "income": int(rng.integers(30000, 150000)),
+                "gender": "M" if i % 2 else "F"
+            },
+            "behavior": {"page_views": int(rng.integers(1, 100))},
+            "purchase_history": {"lifetime_value": float(rng.uniform(0, 5000))},
+            "engagement": {"email_open_rate": float(rng.uniform(0, 1))}
+        }
+        for i in range(n)
+    ]
+
+
+def test_columnar_extraction_matches_object_extraction():
+    """Columnar and per-customer extraction build the same matrix"""
+    customers = make_customers(20)
+    from_objects = extract_from_customers([CustomerFeatures(**c) for c in customers])
+
+    columns = {
+        "age": [c["demographics"]["age"] for c in customers],
+        "income": [c["demographics"]["income"] for c in customers],
+        "gender_male": [c["demographics"]["gender"] for c in customers],
+        "page_views": [c["behavior"]["page_views"] for c in customers],
+        "lifetime_value": [c["purchase_history"]["lifetime_value"] for c in customers],
+        "email_open_rate": [c["engagement"]["email_open_rate"] for c in customers],
+    }
+    from_columns = extract_from_columns(columns, len(customers))
+
+    assert from_columns.dtype == np.float32
+    assert from_columns.shape == (20, len(FEATURE_NAMES))
+    np.testing.assert_array_equal(from_columns, from_objects)
+
+
+def test_segment_customers_endpoint(client):
+    """Segmentation endpoint assigns every customer"""
+    response = client.post(
+        "/api/v1/segmentation/",
+        json={"customers": make_customers(30), "num_segments": 3}
+    )
+    assert response.status_code == 200
+    data = response.json()
+    assert len(data["segments"]) == 3
+    assert len(data["assignments"]) == 30
+    profile = data["segments"][0]["characteristics"]["features"]
+    assert set(profile) == set(FEATURE_NAMES)
+    assert set(profile["income"]) == {"mean", "std", "p25", "p50", "p75"}
+    assert -1.0 <= data["quality_score"] <= 1.0
+    assert data["quality_details"]["rows_scored"] == 30
+
+
+def test_segment_npy_upload(client):
+    """NPY uploads are segmented without per-customer objects"""
+    buffer = io.BytesIO()
+    np.save(buffer, np.random.default_rng(1).normal(size=(40, len(FEATURE_NAMES))))
+    ids = "\n".join(f"cust_{i}" for i in range(40))
+    response = client.post(
+        "/api/v1/segmentation/upload",
+        files={
+            "features": ("features.npy", buffer.getvalue()),
+            "customer_ids": ("ids.txt", ids.encode())
+        },
+        data={"num_segments": "4"}
+    )
+    assert response.status_code == 200
+    assert response.json()["assignments"]["cust_39"].startswith("seg_")
+
+
+def test_streaming_segmentation(client):
+    """Chunked NDJSON uploads are segmented incrementally"""
+    created = client.post(
+        "/api/v1/segmentation/streams",
+        json={"num_segments": 3, "chunk_size": 25}
+    ).json()
+    stream_id = created["stream_id"]
+
+    customers = make_customers(100)
+    for start in (0, 50):
+        body = "\n".join(json.dumps(c) for c in customers[start:start + 50])
+        response = client.post(f"/api/v1/segmentation/streams/{stream_id}/chunks", content=body)
+        assert response.status_code == 200
+    assert response.json()["rows_received"] == 100
+
+    response = client.post(f"/api/v1/segmentation/streams/{stream_id}/finalize")
+    assert response.status_code == 200
+    data = response.json()
+    assert sum(segment["size"] for segment in data["segments"]) == 100
+    assert len(data["assignments"]) == 100
+
+    response = client.post(f"/api/v1/segmentation/streams/{stream_id}/finalize")
+    assert response.status_code == 404
+
+
+def test_idle_streams_are_closed(tmp_path):
+    """A stream nobody finalizes is closed, spool and all, once it has been idle too long"""
+    agent = SegmentationAgent(model_dir=str(tmp_path))
+    idle = asyncio.run(agent.create_stream(SegmentationStreamRequest(num_segments=2))).stream_id
+    active = asyncio.run(agent.create_stream(SegmentationStreamRequest(num_segments=2))).stream_id
+    asyncio.run(agent.add_stream_records(idle, make_customers(4)))
+    stream = agent.streams[idle]
+    stream.last_active -= settings.SEGMENTATION_STREAM_IDLE_SECONDS + 1
+
+    assert asyncio.run(agent.add_stream_records(active, make_customers(2))).rows_received == 2
+    assert idle not in agent.streams and stream._features_spool.closed
+    with pytest.raises(LookupError):
+        asyncio.run(agent.add_stream_records(idle, make_customers(2)))
+    agent.jobs.shutdown()
+
+
+def test_streaming_rejects_invalid_records(client):
+    """A chunk with a record missing customer_id is a validation error, and nothing is added"""
+    stream_id = client.post("/api/v1/segmentation/streams", json={"num_segments": 2}).json()["stream_id"]
+    customers = make_customers(3)
+    del customers[1]["customer_id"]
+
+    body = "\n".join(json.dumps(c) for c in customers)
+    response = client.post(f"/api/v1/segmentation/streams/{stream_id}/chunks", content=body)
+    assert response.status_code == 422
+    assert "customer_id" in response.json()["detail"]
+
+    response = client.post(f"/api/v1/segmentation/streams/{stream_id}/chunks", content=json.dumps(customers[0]))
+    assert response.json()["rows_received"] == 1
+
+
+def test_saved_model_assigns_like_fitted_model(tmp_path):
+    """A saved model reloaded from disk reproduces the fitted assignments"""
+    agent = SegmentationAgent(model_dir=str(tmp_path))
+    request = SegmentationRequest(
+        customers=[CustomerFeatures(**c) for c in make_customers(60)],
+        num_segments=4,
+        save_model=True
+    )
+    response = asyncio.run(agent.segment_customers(request))
+    assert response.model_version == "v1"
+
+    reloaded = SegmentationAgent(model_dir=str(tmp_path))
+    assert reloaded.registry.load_all() == ["v1"]
+    assigned = asyncio.run(reloaded.assign_customers(
+        SegmentAssignmentRequest(customers=request.customers)
+    ))
+    assert assigned.model_version == "v1"
+    assert assigned.assignments == response.assignments
+    agent.jobs.shutdown()
+
+
+def test_registries_sharing_a_directory_see_each_others_versions(tmp_path):
+    """Workers sharing model storage never overwrite a version and find versions saved by others"""
+    first, second = SegmentationModelRegistry(str(tmp_path)), SegmentationModelRegistry(str(tmp_path))
+    arrays = dict(scaler_mean=np.zeros(2), scaler_scale=np.ones(2), centroids=np.eye(2), counts=np.ones(2))
+
+    assert first.save(**arrays).version == "v1"
+    assert second.get("v1").version == "v1"
+
+    # second computes its next version before first saves v2, then loses the rename race
+    stale = iter(["v2"])
+    second._next_version = lambda: next(stale, None) or SegmentationModelRegistry._next_version(second)
+    assert first.save(**arrays, metadata={"by": "first"}).version == "v2"
+    assert second.save(**arrays, metadata={"by": "second"}).version == "v3"
+
+    assert first.get().version == "v3"
+    assert second.get("v2").metadata["by"] == "first"
+    assert not list((tmp_path / "segmentation").glob(".*.tmp"))
+
+
+def test_segment_stats_match_per_segment_numpy():
+    """Chunked bincount statistics agree with per-segment numpy reductions"""
+    rng = np.random.default_rng(2)
+    features = rng.normal(loc=100, scale=20, size=(500, 3)).astype(np.float32)
+    labels = rng.integers(0, 4, size=500)
+
+    stats = SegmentStatsAccumulator(4, 3)
+    stats.update(features[:200], labels[:200])
+    stats.update(features[200:], labels[200:])
+    quantiles = segment_quantiles(features, labels, 4)
+
+    for i in range(4):
+        members = features[labels == i].astype(np.float64)
+        assert stats.counts[i] == len(members)
+        np.testing.assert_allclose(stats.means[i], members.mean(axis=0))
+        np.testing.assert_allclose(stats.stds[i], members.std(axis=0))
+        np.testing.assert_allclose(quantiles[i], np.quantile(members, PROFILE_QUANTILES, axis=0))
+
+
+def test_segmentation_job_polling():
+    """Background jobs are submitted, then polled until they complete"""
+    with TestClient(app) as client:
+        response = client.post(
+            "/api/v1/segmentation/jobs",
+            json={"customers": make_customers(40), "num_segments": 2}
+        )
+        assert response.status_code == 202
+        job_id = response.json()["job_id"]
+
+        deadline = time.time() + 30
+        while time.time() < deadline:
+            job = client.get(f"/api/v1/segmentation/jobs/{job_id}").json()
+            if job["status"] != "running":
+                break
+            time.sleep(0.05)
+        assert job["status"] == "completed"
+        assert len(job["result"]["assignments"]) == 40
+
+
+def test_full_queue_rejects_new_work():
+    """Work beyond max_pending is rejected instead of queued"""
+    jobs = JobManager(max_workers=1, max_pending=1)
+
+    async def hold_slot():
+        async with jobs.slot():
+            with pytest.raises(JobQueueFullError):
+                async with jobs.slot():
+                    pass
+
+    asyncio.run(hold_slot())
+    assert jobs.active == 0
+
+
+def test_incremental_update_reports_drift(tmp_path):
+    """Unchanged deltas leave centroids in place; large shifts are flagged"""
+    agent = SegmentationAgent(model_dir=str(tmp_path))
+    customers = [CustomerFeatures(**c) for c in make_customers(80)]
+    fitted = asyncio.run(agent.segment_customers(
+        SegmentationRequest(customers=customers, num_segments=3, save_model=True)
+    ))
+
+    unchanged = asyncio.run(agent.update_incremental(
+        IncrementalSegmentationRequest(changed=customers[:10], previous=customers[:10])
+    ))
+    assert unchanged.base_model_version == fitted.model_version
+    assert not unchanged.refit_recommended
+    assert all(segment.centroid_shift < 1e-6 for segment in unchanged.drift)
+    assert unchanged.assignments == {c.customer_id: fitted.assignments[c.customer_id] for c in customers[:10]}
+
+    rich = [
+        CustomerFeatures(customer_id=f"new_{i}", demographics={"income": 5_000_000})
+        for i in range(40)
+    ]
+    drifted = asyncio.run(agent.update_incremental(
+        IncrementalSegmentationRequest(changed=rich, save_model=True)
+    ))
+    assert drifted.refit_recommended
+    assert drifted.model_version == "v2"
+    assert sum(segment.size_after for segment in drifted.drift) == 120
+    agent.jobs.shutdown()
+
+
+def test_sampled_silhouette_matches_exact_score():
+    """Blocked silhouette equals sklearn's exact score when the sample is everything"""
+    from sklearn.metrics import silhouette_score
+
+    rng = np.random.default_rng(3)
+    features = rng.normal(size=(300, 4))
+    features[:100] += 4
+    labels = np.repeat([0, 1, 2], 100)
+
+    score, rows = sampled_silhouette(features, labels, 3, sample_size=1000, block_bytes=4096)
+    assert rows == 300
+    assert score == pytest.approx(silhouette_score(features, labels))
+
+
+def test_assignments_fetched_separately(client):
+    """Summary-only responses leave assignments to the paged/streamed endpoints"""
+    response = client.post(
+        "/api/v1/segmentation/",
+        json={"customers": make_customers(25), "num_segments": 2, "inline_assignments": False}
+    )
+    data = response.json()
+    assert data["assignments"] == {}
+    base = f"/api/v1/segmentation/results/{data['segmentation_id']}/assignments"
+
+    page = client.get(base, params={"offset": 20, "limit": 10}).json()
+    assert page["total"] == 25
+    assert list(page["assignments"]) == [f"cust_{i}" for i in range(20, 25)]
+
+    lines = client.get(f"{base}.ndjson").text.splitlines()
+    assert len(lines) == 25
+    assert json.loads(lines[0])["customer_id"] == "cust_0"
+
+    archive = np.load(io.BytesIO(client.get(f"{base}.npz").content))
+    assert archive["labels"].shape == (25,)
+    assert archive["customer_ids"][24] == "cust_24"
+    assert f"seg_{archive['labels'][3]}" == json.loads(lines[3])["segment_id"]
+
+
+def test_auto_k_selects_separated_clusters(tmp_path):
+    """Auto mode sweeps k in parallel and picks the best-scoring candidate"""
+    rng = np.random.default_rng(4)
+    centers = np.array([[20, 30000], [45, 90000], [70, 150000]])
+    points = np.concatenate([c + rng.normal(scale=[1, 1000], size=(60, 2)) for c in centers])
+    request = ColumnarSegmentationRequest(
+        customer_ids=[f"cust_{i}" for i in range(len(points))],
+        columns={"age": points[:, 0].tolist(), "income": points[:, 1].tolist()},
+        num_segments="auto",
+        max_segments=6
+    )
+
+    agent = SegmentationAgent(model_dir=str(tmp_path))
+    threads = []
+    scaled_sample = agent._scaled_sample
+    agent._scaled_sample = lambda *args: (threads.append(threading.current_thread()), scaled_sample(*args))[1]
+    response = asyncio.run(agent.segment_columnar(request))
+    agent.jobs.shutdown()
+
+    assert threads and threading.main_thread() not in threads  # full-data scaling stays off the loop
+    assert response.k_selection["best_k"] == 3
+    assert [point["k"] for point in response.k_selection["curve"]] == [2, 3, 4, 5, 6]
+    assert len(response.segments) == 3
+
+
+@pytest.mark.parametrize("algorithm", sorted(CLUSTERING_ALGORITHMS))
+def test_registered_algorithms_recover_separated_clusters(algorithm):
+    """Every registered algorithm finds well-separated groups and usable centroids"""
+    rng = np.random.default_rng(5)
+    centers = np.array([[0.0, 0.0], [10.0, 0.0], [0.0, 10.0]])
+    truth = np.repeat(np.arange(3), 200)
+    features = centers[truth] + rng.normal(scale=0.5, size=(600, 2))
+
+    result = fit_segmentation(features, 3, algorithm=algorithm)
+
+    assert result.centroids.shape == (3, 2)
+    assert sorted(result.counts.tolist()) == [200, 200, 200]
+    # Same partition as the ground truth, up to label permutation
+    assert len(set(zip(truth.tolist(), result.labels.tolist()))) == 3
+    assert result.quality_score > 0.8
+
+
+def test_unknown_algorithm_rejected():
+    """Unregistered algorithm names fail fast with a ValueError"""
+    with pytest.raises(ValueError, match="Unsupported algorithm"):
+        fit_segmentation(np.zeros((10, 2)), 2, algorithm="dbscan")